@@ -1,25 +1,128 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Response, status
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.monitoring import ConnectionPoolListener
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 import os
+import sys
+import socket
+import time
+import asyncio
 import logging
+from contextvars import ContextVar
 from pathlib import Path
-from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from pydantic import BaseModel, Field, EmailStr, AfterValidator, ValidationError
+from typing import Annotated, List, Optional
 from datetime import datetime, timezone, timedelta
+from collections import Counter, OrderedDict, defaultdict
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from statistics import median
+from calendar import monthrange
 from bson import ObjectId
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import re
+import json
+import hashlib
+import secrets
+from email.utils import format_datetime, parsedate_to_datetime
+
+try:
+    import numpy as np
+except ImportError:  # Analytics then run on MongoDB only
+    np = None
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '50'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '5'))
+
+class PoolMonitor(ConnectionPoolListener):
+    """Count open and checked-out connections for the readiness check"""
+    
+    def __init__(self):
+        self.open = 0
+        self.in_use = 0
+    
+    def connection_created(self, event):
+        self.open += 1
+    
+    def connection_closed(self, event):
+        self.open -= 1
+    
+    def connection_checked_out(self, event):
+        self.in_use += 1
+    
+    def connection_checked_in(self, event):
+        self.in_use -= 1
+    
+    def pool_cleared(self, event):
+        pass
+    
+    def pool_closed(self, event):
+        pass
+    
+    def pool_created(self, event):
+        pass
+    
+    def pool_ready(self, event):
+        pass
+    
+    def connection_ready(self, event):
+        pass
+    
+    def connection_check_out_started(self, event):
+        pass
+    
+    def connection_check_out_failed(self, event):
+        pass
+
+def mongo_client_options():
+    """Client options from the environment.
+    
+    Pool size and the connect and server selection timeouts always get a value (the
+    app defaults below, not the driver's); the other options are passed only when set.
+    """
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "serverSelectionTimeoutMS": int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000')),
+        "connectTimeoutMS": int(os.environ.get('MONGO_CONNECT_TIMEOUT_MS', '5000')),
+    }
+    for option, variable in [
+        ("socketTimeoutMS", 'MONGO_SOCKET_TIMEOUT_MS'),
+        ("maxIdleTimeMS", 'MONGO_MAX_IDLE_TIME_MS'),
+        ("waitQueueTimeoutMS", 'MONGO_WAIT_QUEUE_TIMEOUT_MS'),
+        ("wTimeoutMS", 'MONGO_WRITE_TIMEOUT_MS'),
+    ]:
+        if os.environ.get(variable):
+            options[option] = int(os.environ[variable])
+    
+    # e.g. MONGO_COMPRESSORS=zstd,snappy; zstd needs zstandard, snappy needs python-snappy
+    compressors = [c.strip() for c in os.environ.get('MONGO_COMPRESSORS', '').split(',') if c.strip()]
+    if compressors:
+        options["compressors"] = ",".join(compressors)
+    if os.environ.get('MONGO_READ_CONCERN'):
+        options["readConcernLevel"] = os.environ['MONGO_READ_CONCERN']  # local, majority, ...
+    if os.environ.get('MONGO_READ_PREFERENCE'):
+        options["readPreference"] = os.environ['MONGO_READ_PREFERENCE']
+    write_concern = os.environ.get('MONGO_WRITE_CONCERN')  # "majority" or a number of nodes
+    if write_concern:
+        options["w"] = int(write_concern) if write_concern.isdigit() else write_concern
+    if os.environ.get('MONGO_JOURNAL'):
+        options["journal"] = os.environ['MONGO_JOURNAL'].lower() in ("1", "true", "yes")
+    return options
+
+pool_monitor = PoolMonitor()
+client = AsyncIOMotorClient(mongo_url, event_listeners=[pool_monitor], **mongo_client_options())
 db = client[os.environ.get('DB_NAME', 'kinesio_crm')]
 
 # JWT Configuration
@@ -70,6 +173,41 @@ def serialize_doc(doc):
         return result
     return doc
 
+# Upper bound on queries a single request runs against MongoDB at the same time
+QUERY_CONCURRENCY = int(os.environ.get('QUERY_CONCURRENCY', '4'))
+
+# Every request runs in its own task, so these hold that request's slots; tasks started
+# by gather_limited inherit them, which makes nested fan-outs share the same bound
+query_slots = ContextVar("query_slots", default=None)
+held_query_slot = ContextVar("held_query_slot", default=None)
+
+async def gather_limited(*aws):
+    """Await independent queries concurrently, at most QUERY_CONCURRENCY per request.
+    
+    Results come back in argument order, like asyncio.gather. An awaitable that fans
+    out again gives its slot back while it waits for its own queries.
+    """
+    semaphore = query_slots.get()
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(QUERY_CONCURRENCY)
+        query_slots.set(semaphore)
+    
+    async def run(aw):
+        async with semaphore:
+            held_query_slot.set({"held": True})
+            return await aw
+    
+    parent = held_query_slot.get()
+    if not parent or not parent["held"]:
+        return await asyncio.gather(*(run(aw) for aw in aws))
+    parent["held"] = False
+    semaphore.release()
+    try:
+        return await asyncio.gather(*(run(aw) for aw in aws))
+    finally:
+        await semaphore.acquire()
+        parent["held"] = True
+
 def format_client_name(client):
     """Format client name with optional middle name"""
     parts = [client.get('first_name', '')]
@@ -78,6 +216,62 @@ def format_client_name(client):
     parts.append(client.get('last_name', ''))
     return ' '.join(parts)
 
+CLIENT_NAME_PROJECTION = {"first_name": 1, "middle_name": 1, "last_name": 1}
+
+class ClientLoader:
+    """Request-scoped batching loader for clients.
+    
+    load() calls made within the same event-loop tick are answered by one $in query,
+    and every client is fetched at most once for the lifetime of the loader.
+    """
+    
+    def __init__(self, projection=CLIENT_NAME_PROJECTION):
+        self.projection = projection
+        self.results = {}  # client id -> future of the client document (or None)
+        self.queue = []
+        self.dispatch_task = None
+    
+    def load(self, client_id):
+        """Return an awaitable resolving to the client document, or None if there is none"""
+        if client_id not in self.results:
+            future = asyncio.get_running_loop().create_future()
+            self.results[client_id] = future
+            if not client_id or not ObjectId.is_valid(client_id):
+                future.set_result(None)
+            else:
+                self.queue.append(client_id)
+                if len(self.queue) == 1:
+                    # Start the query one tick later so sibling tasks can queue their ids too
+                    asyncio.get_running_loop().call_soon(self.start_dispatch)
+        return self.results[client_id]
+    
+    def start_dispatch(self):
+        self.dispatch_task = asyncio.create_task(self.dispatch())
+    
+    async def dispatch(self):
+        client_ids, self.queue = self.queue, []
+        try:
+            cursor = db.clients.find({"_id": {"$in": [ObjectId(cid) for cid in client_ids]}}, self.projection)
+            clients = {str(c["_id"]): c async for c in cursor}
+        except Exception as e:
+            for cid in client_ids:
+                self.results.pop(cid).set_exception(e)
+            return
+        for cid in client_ids:
+            self.results[cid].set_result(clients.get(cid))
+    
+    async def load_many(self, client_ids):
+        return await asyncio.gather(*(self.load(cid) for cid in client_ids))
+    
+    async def names(self, client_ids):
+        """Map each found client id to its formatted name"""
+        client_ids = list(dict.fromkeys(client_ids))
+        clients = await self.load_many(client_ids)
+        return {cid: format_client_name(c) for cid, c in zip(client_ids, clients) if c}
+
+def get_client_loader():
+    return ClientLoader()
+
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
@@ -146,21 +340,32 @@ class ClientUpdate(BaseModel):
     phone: Optional[str] = Field(None, max_length=20)
 
 # Visit Models
-DEFAULT_PRICE = 15000  # Default price in rubles
-AVAILABLE_PRACTICES = ["Коррекция", "ТСЯ", "Лепило", "Ребефинг"]  # Available practices
+DEFAULT_PRICE = 15000  # Default price in rubles, until changed in settings
+AVAILABLE_PRACTICES = ["Коррекция", "ТСЯ", "Лепило", "Ребефинг"]  # Available practices, until changed in settings
 PAYMENT_TYPES = ["благотворительность", "абонемент"]  # Payment types for free visits
 
+ISO_DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+def check_iso_date(value):
+    """Accept only calendar dates written as YYYY-MM-DD, which sort and range-query as strings"""
+    if not ISO_DATE_PATTERN.fullmatch(value):
+        raise ValueError("date must be written as YYYY-MM-DD")
+    datetime.strptime(value, "%Y-%m-%d")
+    return value
+
+IsoDate = Annotated[str, AfterValidator(check_iso_date)]
+
 class VisitCreate(BaseModel):
-    date: str  # ISO date string YYYY-MM-DD
+    date: IsoDate
     topic: str = Field(..., min_length=1, max_length=200)
     practices: List[str] = Field(default=[])  # Selected practices
     notes: Optional[str] = Field(None, max_length=5000)
-    price: int = Field(default=DEFAULT_PRICE, ge=0)  # Price in rubles
+    price: Optional[int] = Field(None, ge=0)  # Price in rubles, the configured default if omitted
     tips: int = Field(default=0, ge=0)  # Tips in rubles
     payment_type: Optional[str] = None  # For free visits: "благотворительность" or "абонемент"
 
 class VisitUpdate(BaseModel):
-    date: Optional[str] = None
+    date: Optional[IsoDate] = None
     topic: Optional[str] = Field(None, min_length=1, max_length=200)
     practices: Optional[List[str]] = None
     notes: Optional[str] = Field(None, max_length=5000)
@@ -268,6 +473,7 @@ async def create_client(
     }
     result = await db.clients.insert_one(client_doc)
     client_doc["_id"] = result.inserted_id
+    await track_client_write()
     return serialize_doc(client_doc)
 
 @api_router.get("/clients/{client_id}")
@@ -311,6 +517,7 @@ async def update_client(
         {"_id": ObjectId(client_id)},
         {"$set": update_data}
     )
+    await track_client_write(client_id, renamed=True)
     
     updated_client = await db.clients.find_one({"_id": ObjectId(client_id)})
     return serialize_doc(updated_client)
@@ -329,10 +536,13 @@ async def delete_client(
         raise HTTPException(status_code=404, detail="Client not found")
     
     # Delete all visits for this client
+    visits = await db.visits.find({"client_id": client_id}, ROLLUP_VISIT_PROJECTION).to_list(length=None)
     await db.visits.delete_many({"client_id": client_id})
+    await track_visit_changes(removed=visits)
     
     # Delete the client
     await db.clients.delete_one({"_id": ObjectId(client_id)})
+    await track_client_write(client_id)
     
     return {"message": "Client and all visits deleted successfully"}
 
@@ -344,6 +554,7 @@ async def get_client_visits(
     date_from: Optional[str] = None,
     date_to: Optional[str] = None,
     topic: Optional[str] = None,
+    practice: Optional[str] = None,
     page: int = 1,
     page_size: int = 50,
     current_user: dict = Depends(get_current_user)
@@ -370,6 +581,14 @@ async def get_client_visits(
     if topic:
         query["topic"] = {"$regex": topic, "$options": "i"}
     
+    if practice:
+        bits = await get_practice_bits()
+        # Until migration 0003 has given every visit a mask, filter on the array
+        if practice in bits and await migration_done("0003_visit_practices_mask"):
+            query["practices_mask"] = {"$bitsAllSet": 1 << bits[practice]}
+        else:
+            query["practices"] = practice
+    
     total = await db.visits.count_documents(query)
     skip = (page - 1) * page_size
     
@@ -399,13 +618,16 @@ async def create_visit(
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
     
+    practices = visit_data.practices or []
+    bits = await get_practice_bits(practices)
     visit_doc = {
         "client_id": client_id,
         "date": visit_data.date,
         "topic": visit_data.topic,
-        "practices": visit_data.practices or [],
+        "practices": practices,
+        "practices_mask": practices_mask(practices, bits),
         "notes": visit_data.notes or "",
-        "price": visit_data.price,
+        "price": visit_data.price if visit_data.price is not None else default_visit_price(),
         "tips": visit_data.tips,
         "payment_type": visit_data.payment_type,
         "created_at": datetime.now(timezone.utc),
@@ -413,6 +635,7 @@ async def create_visit(
     }
     result = await db.visits.insert_one(visit_doc)
     visit_doc["_id"] = result.inserted_id
+    await track_visit_changes(added=[visit_doc])
     return serialize_doc(visit_doc)
 
 @api_router.put("/visits/{visit_id}")
@@ -431,6 +654,9 @@ async def update_visit(
     
     update_data = {k: v for k, v in visit_data.model_dump().items() if v is not None}
     update_data["updated_at"] = datetime.now(timezone.utc)
+    if "practices" in update_data:
+        bits = await get_practice_bits(update_data["practices"])
+        update_data["practices_mask"] = practices_mask(update_data["practices"], bits)
     
     await db.visits.update_one(
         {"_id": ObjectId(visit_id)},
@@ -438,6 +664,7 @@ async def update_visit(
     )
     
     updated_visit = await db.visits.find_one({"_id": ObjectId(visit_id)})
+    await track_visit_changes(removed=[visit], added=[updated_visit])
     return serialize_doc(updated_visit)
 
 @api_router.delete("/visits/{visit_id}")
@@ -454,8 +681,843 @@ async def delete_visit(
         raise HTTPException(status_code=404, detail="Visit not found")
     
     await db.visits.delete_one({"_id": ObjectId(visit_id)})
+    await track_visit_changes(removed=[visit])
     return {"message": "Visit deleted successfully"}
 
+# ==================== PRACTICE BITMASKS ====================
+
+# Each practice gets a permanent bit, in order of first use, recorded in the settings
+# document. Visits store practices_mask next to the practices array. Bits stay below
+# 2^52 so masks remain exact in aggregation arithmetic.
+MAX_PRACTICE_BITS = 52
+practice_bit_cache = {"order": None}
+
+async def load_practice_bits():
+    settings = await db.settings.find_one({"type": "app_settings"}, {"practice_bit_order": 1})
+    practice_bit_cache["order"] = (settings or {}).get("practice_bit_order", [])
+    return practice_bit_cache["order"]
+
+async def get_practice_bits(practices=()):
+    """Get {practice: bit}, assigning bits to practices that do not have one yet"""
+    order = practice_bit_cache["order"]
+    if order is None:
+        order = await load_practice_bits()
+    missing = [p for p in dict.fromkeys(practices) if p not in order]
+    if missing:
+        await db.settings.update_one(
+            {"type": "app_settings"}, {"$setOnInsert": {"type": "app_settings"}}, upsert=True
+        )
+        for practice in missing:
+            # Conditional push: concurrent writers cannot give one practice two bits
+            await db.settings.update_one(
+                {"type": "app_settings", "practice_bit_order": {"$ne": practice}},
+                {"$push": {"practice_bit_order": practice}}
+            )
+        order = await load_practice_bits()
+        unbitted = [p for p in missing if p in order[MAX_PRACTICE_BITS:]]
+        if unbitted:
+            logger.warning(f"No practice bit left for {unbitted}; practice statistics unwind the arrays")
+    return {practice: bit for bit, practice in enumerate(order) if bit < MAX_PRACTICE_BITS}
+
+def every_practice_has_bit():
+    """Whether no practice was left without a bit once all MAX_PRACTICE_BITS were taken;
+    masks can only stand in for the practices arrays while this holds"""
+    return len(practice_bit_cache["order"] or []) <= MAX_PRACTICE_BITS
+
+def practices_mask(practices, bits):
+    mask = 0
+    for practice in practices or []:
+        if practice in bits:
+            mask |= 1 << bits[practice]
+    return mask
+
+def practice_count_fields(bits):
+    """$group fields counting visits whose practices_mask has each practice's bit set"""
+    return {
+        f"bit_{bit}": {"$sum": {"$mod": [{"$floor": {"$divide": ["$practices_mask", 2 ** bit]}}, 2]}}
+        for bit in bits.values()
+    }
+
+async def backfill_practice_masks(recompute=False):
+    """Set practices_mask on visits that lack one (or on all visits when recompute is set)"""
+    query = {} if recompute else {"practices_mask": {"$exists": False}}
+    bits = await get_practice_bits(await db.visits.distinct("practices", query))
+    updated = 0
+    operations = []
+    async for visit in db.visits.find(query, {"practices": 1}):
+        operations.append(UpdateOne(
+            {"_id": visit["_id"]},
+            {"$set": {"practices_mask": practices_mask(visit.get("practices"), bits)}}
+        ))
+        if len(operations) == 500:
+            updated += (await db.visits.bulk_write(operations, ordered=False)).modified_count
+            operations = []
+    if operations:
+        updated += (await db.visits.bulk_write(operations, ordered=False)).modified_count
+    if updated:
+        logger.info(f"Backfilled practices_mask on {updated} visits")
+    return updated
+
+# ==================== TOPIC DICTIONARY ====================
+
+def normalize_topic(topic):
+    """Case- and whitespace-insensitive form of a topic, used to match spellings"""
+    return " ".join(topic.split()).casefold()
+
+async def apply_topic_changes(removed=(), added=()):
+    """Keep per-topic usage counts and last-used dates in the topics collection"""
+    deltas = Counter()
+    last_used = {}
+    for visits, sign in ((removed, -1), (added, 1)):
+        for visit in visits:
+            if visit and visit.get("topic"):
+                deltas[visit["topic"]] += sign
+                if sign > 0 and visit.get("date"):
+                    last_used[visit["topic"]] = max(last_used.get(visit["topic"], ""), visit["date"])
+    
+    operations = []
+    for topic, delta in deltas.items():
+        update = {"$setOnInsert": {"normalized": normalize_topic(topic)}}
+        if delta:
+            update["$inc"] = {"count": delta}
+        if topic in last_used:
+            update["$max"] = {"last_used": last_used[topic]}
+        if len(update) > 1:
+            operations.append(UpdateOne({"_id": topic}, update, upsert=True))
+    if operations:
+        await db.topics.bulk_write(operations, ordered=False)
+
+async def rebuild_topic_dictionary():
+    """Recompute the topics collection from the visits collection (while no visits are written)"""
+    pipeline = [
+        {"$match": {"topic": {"$nin": [None, ""]}}},
+        {"$group": {"_id": "$topic", "count": {"$sum": 1}, "last_used": {"$max": "$date"}}}
+    ]
+    topics = await db.visits.aggregate(pipeline).to_list(length=None)
+    if not topics:
+        await db.topics.delete_many({})
+        return 0
+    for topic in topics:
+        topic["normalized"] = normalize_topic(topic["_id"])
+    
+    await db.topics_rebuild.drop()
+    await db.topics_rebuild.insert_many(topics)
+    await db.topics_rebuild.rename("topics", dropTarget=True)
+    # rename drops the target's indexes along with it
+    await create_topic_indexes()
+    logger.info(f"Rebuilt topic dictionary with {len(topics)} topics")
+    return len(topics)
+
+async def create_topic_indexes():
+    await db.topics.create_index([("count", -1)])
+    await db.topics.create_index([("normalized", 1)])
+
+@api_router.post("/admin/topics/rebuild")
+async def rebuild_topics_route(current_user: dict = Depends(get_current_user)):
+    """Rebuild the topic dictionary from the visits collection"""
+    topics = await rebuild_topic_dictionary()
+    return {"message": "Topic dictionary rebuilt", "topics": topics}
+
+# ==================== RESPONSE CACHE ====================
+
+# Per-collection write counters. Every write route bumps the collections it touched,
+# which retires all cached responses computed from them. The counters live in this
+# process, so the cache assumes the single-worker deployment from DEPLOYMENT.md.
+data_versions = Counter()
+data_changed_at = {}  # collection -> time of its last bump, for Last-Modified headers
+process_started_at = datetime.now(timezone.utc).replace(microsecond=0)
+
+def bump_data_version(*collections):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for collection in collections:
+        data_versions[collection] += 1
+        data_changed_at[collection] = now
+
+def last_changed_at(collections):
+    """Latest write to any of the collections seen by this process (or its start time)"""
+    return max([data_changed_at.get(c, process_started_at) for c in collections])
+
+class ResponseCache:
+    """LRU cache for computed responses, keyed by endpoint, parameters and data versions"""
+    
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def make_key(self, endpoint, collections, params):
+        versions = tuple((c, data_versions[c]) for c in collections)
+        return (endpoint, tuple(sorted(params.items())), versions)
+    
+    async def get_or_compute(self, endpoint, collections, params, compute):
+        """Return the cached response or await compute() and remember its result"""
+        key = self.make_key(endpoint, collections, params)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        
+        self.misses += 1
+        value = await compute()
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+        return value
+    
+    def clear(self):
+        self.entries.clear()
+    
+    def prune(self):
+        """Drop entries that can no longer be hit: older data versions or a past day"""
+        today = today_iso()
+        stale = [
+            key for key in self.entries
+            if any(data_versions[c] != v for c, v in key[2]) or dict(key[1]).get("today", today) != today
+        ]
+        for key in stale:
+            del self.entries[key]
+        return len(stale)
+    
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups > 0 else 0,
+            "data_versions": dict(data_versions)
+        }
+
+stats_cache = ResponseCache(max_entries=int(os.environ.get('STATS_CACHE_SIZE', '256')))
+
+def today_iso():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+# ==================== YEAR SNAPSHOTS ====================
+
+# Figures for years that are over only change through back-dated edits, so they are
+# materialized once per (kind, year, parameters) and served with validators. Writes
+# that touch a date in a closed year delete that year's snapshots.
+SNAPSHOT_MAX_AGE = int(os.environ.get('SNAPSHOT_MAX_AGE', '86400'))
+
+def is_closed_year(year):
+    return year is not None and year < datetime.now(timezone.utc).year
+
+def closed_years_of(dates):
+    years = {int(d[:4]) for d in dates if d and d[:4].isdigit()}
+    return sorted(y for y in years if is_closed_year(y))
+
+def body_etag(body):
+    payload = json.dumps(body, sort_keys=True, ensure_ascii=False, default=str)
+    return '"' + hashlib.sha1(payload.encode("utf-8")).hexdigest() + '"'
+
+def etag_matches(request: Request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in candidates or etag in candidates
+
+def not_modified(request: Request, etag, last_modified):
+    """Whether the client's copy is current: If-None-Match decides when sent (RFC 9110),
+    otherwise If-Modified-Since against last_modified"""
+    if request.headers.get("if-none-match"):
+        return etag_matches(request, etag)
+    header = request.headers.get("if-modified-since")
+    if not header:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    # Last-Modified only carries whole seconds
+    return last_modified.replace(microsecond=0) <= since
+
+async def year_changed_since(year, source, since):
+    """Catch writes that bypassed invalidation (e.g. another process) through updated_at"""
+    if source == "retreats":
+        collection, year_filter = db.retreats, retreats_overlapping(f"{year}-01-01", f"{year}-12-31")
+    else:
+        collection, year_filter = db.visits, {"date": {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}}
+    changed = await collection.find_one({"updated_at": {"$gt": since}, **year_filter}, {"_id": 1})
+    return changed is not None
+
+async def serve_year_snapshot(request: Request, kind, year, params, compute, source="visits", client_id=None):
+    """Serve a closed year's result from its snapshot, materializing it on first use"""
+    snapshot_id = ":".join([kind, str(year), *(f"{k}={v}" for k, v in sorted(params.items()))])
+    snapshot = await db.year_snapshots.find_one({"_id": snapshot_id})
+    if snapshot and await year_changed_since(year, source, snapshot["created_at"]):
+        snapshot = None
+    if not snapshot:
+        body = await compute()
+        snapshot = {
+            "_id": snapshot_id,
+            "kind": kind,
+            "year": year,
+            "client_id": client_id,
+            "body": body,
+            "etag": body_etag(body),
+            "created_at": datetime.now(timezone.utc)
+        }
+        await db.year_snapshots.replace_one({"_id": snapshot_id}, snapshot, upsert=True)
+    
+    created_at = snapshot["created_at"]
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    headers = {
+        "ETag": snapshot["etag"],
+        "Last-Modified": format_datetime(created_at, usegmt=True),
+        "Cache-Control": f"private, max-age={SNAPSHOT_MAX_AGE}"
+    }
+    if not_modified(request, snapshot["etag"], created_at):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(snapshot["body"], headers=headers)
+
+async def track_client_write(client_id=None, renamed=False):
+    """Retire cached figures after a client is created, changed or removed"""
+    bump_data_version("clients")
+    if client_id:
+        await invalidate_year_snapshots(client_id=client_id)
+    if renamed:
+        # Yearly summaries of every year show client names
+        await invalidate_year_snapshots(kinds=["yearly-summary"])
+
+async def track_retreat_write(*retreats):
+    """Retire cached figures after a retreat (as before and after the write) changes"""
+    bump_data_version("retreats")
+    years = closed_years_of(r.get(field) for r in retreats if r for field in ("start_date", "end_date"))
+    await invalidate_year_snapshots(years=years, kinds=["retreat-stats"])
+
+async def invalidate_year_snapshots(years=None, kinds=None, client_id=None):
+    """Delete snapshots of the given closed years, kinds and/or client (all when no filter)"""
+    conditions = []
+    if years is not None:
+        if not years:
+            return
+        conditions.append({"year": {"$in": list(years)}})
+    if kinds:
+        conditions.append({"kind": {"$in": list(kinds)}})
+    if client_id:
+        conditions.append({"client_id": client_id})
+    await db.year_snapshots.delete_many({"$and": conditions} if conditions else {})
+
+# ==================== DAILY ROLLUPS ====================
+
+# Fields a visit contributes to its day's rollup document
+ROLLUP_VISIT_PROJECTION = {
+    "date": 1, "topic": 1, "practices": 1, "price": 1, "tips": 1, "retreat_id": 1
+}
+
+ROLLUP_SCALAR_FIELDS = [
+    "visits", "revenue", "tips",
+    "personal_visits", "personal_revenue", "personal_tips",
+    "retreat_visits", "retreat_revenue", "retreat_tips",
+]
+
+def encode_rollup_key(value):
+    """Make a free-text value (topic, practice) safe to use as a MongoDB field name"""
+    return value.replace(".", "．").replace("$", "＄")
+
+def decode_rollup_key(key):
+    return key.replace("．", ".").replace("＄", "$")
+
+def visit_rollup_increments(visit, sign=1):
+    """Build the flat {field: delta} counter a visit adds to (or removes from) its day"""
+    price = visit.get("price")
+    if price is None:
+        price = default_visit_price()
+    tips = visit.get("tips") or 0
+    is_retreat = visit.get("retreat_id") is not None
+    split = "retreat" if is_retreat else "personal"
+    
+    increments = Counter({
+        "visits": sign,
+        "revenue": sign * price,
+        "tips": sign * tips,
+        f"{split}_visits": sign,
+        f"{split}_revenue": sign * price,
+        f"{split}_tips": sign * tips,
+    })
+    if visit.get("topic"):
+        increments[f"topics.{encode_rollup_key(visit['topic'])}"] += sign
+    # Practice counts only cover personal visits, like every practice statistic
+    if not is_retreat:
+        for practice in visit.get("practices") or []:
+            increments[f"practices.{encode_rollup_key(practice)}"] += sign
+    return increments
+
+async def track_visit_changes(removed=(), added=()):
+    """Keep data derived from visits in sync after visits are created, changed or removed.
+    
+    Every route that writes to db.visits must call this with the documents as they were
+    before the write (removed) and as they are after it (added).
+    """
+    analytics_engine.apply(removed, added)
+    try:
+        await gather_limited(
+            apply_rollup_changes(removed, added),
+            apply_topic_changes(removed, added),
+            invalidate_year_snapshots(
+                years=closed_years_of(v.get("date") for v in (*removed, *added) if v)
+            )
+        )
+    finally:
+        # Only now: a response computed before the rollups caught up must not be
+        # cached under the new version
+        bump_data_version("visits")
+
+async def apply_rollup_changes(removed=(), added=()):
+    """Apply a visit write to the daily rollups with one $inc per touched day"""
+    changes = defaultdict(Counter)
+    for visits, sign in ((removed, -1), (added, 1)):
+        for visit in visits:
+            if visit and visit.get("date"):
+                changes[visit["date"]].update(visit_rollup_increments(visit, sign))
+    
+    operations = []
+    for date, increments in changes.items():
+        increments = {k: v for k, v in increments.items() if v}
+        if increments:
+            operations.append(UpdateOne({"_id": date}, {"$inc": increments}, upsert=True))
+    if operations:
+        await db.visit_daily_rollups.bulk_write(operations, ordered=False)
+
+def rollup_document(date, increments):
+    """Expand a flat rollup counter into a visit_daily_rollups document"""
+    doc = {"_id": date, "topics": {}, "practices": {}}
+    for field, value in increments.items():
+        if "." in field:
+            group, key = field.split(".", 1)
+            doc[group][key] = value
+        else:
+            doc[field] = value
+    return doc
+
+async def rebuild_daily_rollups():
+    """Recompute visit_daily_rollups from scratch from the visits collection.
+    
+    Visit writes landing between the scan and the swap are lost, so this is an admin
+    command for a quiet moment, never a scheduled job.
+    """
+    days = defaultdict(Counter)
+    async for visit in db.visits.find({}, ROLLUP_VISIT_PROJECTION):
+        if visit.get("date"):
+            days[visit["date"]].update(visit_rollup_increments(visit))
+    
+    if not days:
+        await db.visit_daily_rollups.delete_many({})
+        return 0
+    
+    # Build into a scratch collection and swap it in, so readers never see a half-built table
+    await db.visit_daily_rollups_rebuild.drop()
+    await db.visit_daily_rollups_rebuild.insert_many(
+        [rollup_document(date, increments) for date, increments in days.items()]
+    )
+    await db.visit_daily_rollups_rebuild.rename("visit_daily_rollups", dropTarget=True)
+    logger.info(f"Rebuilt daily rollups for {len(days)} days")
+    return len(days)
+
+async def load_daily_rollups(date_from=None, date_to=None):
+    """Get rollup documents for a date range (inclusive, ISO date strings)"""
+    query = {}
+    if date_from or date_to:
+        date_filter = {}
+        if date_from:
+            date_filter["$gte"] = date_from
+        if date_to:
+            date_filter["$lte"] = date_to
+        query["_id"] = date_filter
+    return await db.visit_daily_rollups.find(query).sort("_id", 1).to_list(length=None)
+
+def sum_daily_rollups(rollups, date_from=None, date_to=None):
+    """Add up rollup documents, optionally restricted to a date range"""
+    totals = Counter()
+    topics = Counter()
+    practices = Counter()
+    for day in rollups:
+        if (date_from and day["_id"] < date_from) or (date_to and day["_id"] > date_to):
+            continue
+        for field, value in day.items():
+            if field == "topics":
+                topics.update({decode_rollup_key(k): v for k, v in value.items()})
+            elif field == "practices":
+                practices.update({decode_rollup_key(k): v for k, v in value.items()})
+            elif field != "_id":
+                totals[field] += value
+    summary = {field: totals[field] for field in ROLLUP_SCALAR_FIELDS}
+    summary["topics"] = Counter({k: v for k, v in topics.items() if v > 0})
+    summary["practices"] = Counter({k: v for k, v in practices.items() if v > 0})
+    return summary
+
+@api_router.get("/stats/cache")
+async def get_cache_stats(current_user: dict = Depends(get_current_user)):
+    """Get statistics response cache metrics"""
+    return {**stats_cache.stats(), "calendar_feed": feed_cache.stats()}
+
+@api_router.post("/admin/rollups/rebuild")
+async def rebuild_rollups_route(current_user: dict = Depends(get_current_user)):
+    """Rebuild the daily visit rollups from the visits collection"""
+    days = await rebuild_daily_rollups()
+    bump_data_version("visits")
+    return {"message": "Daily rollups rebuilt", "days": days}
+
+# ==================== COLUMNAR ANALYTICS ====================
+
+# Set ANALYTICS_ENGINE=mongo to answer statistics from MongoDB only
+ANALYTICS_ENGINE = os.environ.get('ANALYTICS_ENGINE', 'numpy').lower()
+
+ANALYTICS_VISIT_PROJECTION = {
+    "date": 1, "client_id": 1, "topic": 1, "practices": 1, "price": 1, "tips": 1, "retreat_id": 1
+}
+
+def date_ordinal(value):
+    """Convert an ISO date string to a proleptic Gregorian ordinal, or None if it is not a date"""
+    try:
+        return datetime.strptime(value[:10], "%Y-%m-%d").toordinal()
+    except (TypeError, ValueError):
+        return None
+
+class VisitAnalytics:
+    """Visits held in memory as parallel NumPy columns for vectorized statistics.
+    
+    Each visit is one row: date ordinal, client index, price, tips, topic code,
+    practices bitmask and retreat flag. Removed or replaced visits are tombstoned
+    and the table is compacted once tombstones dominate. Like the response cache,
+    the columns are kept current by this process's write routes.
+    """
+    
+    COLUMNS = {
+        "date": "int32", "client": "int32", "price": "int64", "tips": "int64",
+        "topic": "int32", "practices": "int64", "retreat": "bool", "alive": "bool",
+    }
+    MAX_PRACTICES = 63
+    
+    def __init__(self):
+        self.enabled = ANALYTICS_ENGINE == "numpy" and np is not None
+        self.ready = False
+        self.loading = False
+        self.pending = []
+        self.loaded_at = None
+        self.load_seconds = None
+        self._reset()
+    
+    def _reset(self, capacity=1024):
+        self.size = 0
+        self.cols = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()} if np else {}
+        self.row_of = {}
+        self.client_ids, self.client_codes = [], {}
+        self.topics, self.topic_codes = [], {}
+        self.practices, self.practice_bits = [], {}
+    
+    def _code(self, value, values, codes):
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+    
+    def _practice_mask(self, practices):
+        mask = 0
+        for practice in practices or []:
+            if practice not in self.practice_bits:
+                if len(self.practices) >= self.MAX_PRACTICES:
+                    logger.warning(f"Analytics engine ignores practice beyond {self.MAX_PRACTICES}: {practice}")
+                    continue
+                self._code(practice, self.practices, self.practice_bits)
+            mask |= 1 << self.practice_bits[practice]
+        return mask
+    
+    def _append(self, visit):
+        if self.size == len(self.cols["alive"]):
+            for name in self.cols:
+                self.cols[name] = np.resize(self.cols[name], self.size * 2)
+        row = self.size
+        price = visit.get("price")
+        ordinal = date_ordinal(visit.get("date"))
+        self.cols["date"][row] = ordinal if ordinal is not None else -1
+        self.cols["client"][row] = self._code(visit.get("client_id"), self.client_ids, self.client_codes)
+        self.cols["price"][row] = default_visit_price() if price is None else price
+        self.cols["tips"][row] = visit.get("tips") or 0
+        self.cols["topic"][row] = self._code(visit.get("topic") or None, self.topics, self.topic_codes)
+        self.cols["practices"][row] = self._practice_mask(visit.get("practices"))
+        self.cols["retreat"][row] = visit.get("retreat_id") is not None
+        self.cols["alive"][row] = True
+        self.row_of[str(visit["_id"])] = row
+        self.size += 1
+    
+    def _remove(self, visit):
+        row = self.row_of.pop(str(visit["_id"]), None)
+        if row is not None:
+            self.cols["alive"][row] = False
+    
+    def apply(self, removed=(), added=()):
+        """Mirror a visit write; called from track_visit_changes"""
+        if not self.enabled:
+            return
+        if self.loading:
+            self.pending.append((list(removed), list(added)))
+            return
+        for visit in removed:
+            if visit:
+                self._remove(visit)
+        for visit in added:
+            if visit:
+                self._remove(visit)
+                self._append(visit)
+        if self.size > 1024 and len(self.row_of) < self.size // 2:
+            self.compact()
+    
+    def compact(self):
+        """Drop tombstoned rows"""
+        alive = self.cols["alive"][:self.size]
+        keep = np.flatnonzero(alive)
+        capacity = max(1024, len(keep) * 2)
+        for name in self.cols:
+            column = np.zeros(capacity, dtype=self.COLUMNS[name])
+            column[:len(keep)] = self.cols[name][keep]
+            self.cols[name] = column
+        new_row = np.full(self.size, -1, dtype="int64")
+        new_row[keep] = np.arange(len(keep))
+        self.row_of = {visit_id: int(new_row[row]) for visit_id, row in self.row_of.items()}
+        self.size = len(keep)
+    
+    async def load(self):
+        """(Re)load every visit from MongoDB; writes arriving meanwhile are replayed afterwards"""
+        if not self.enabled or self.loading:
+            return
+        self.loading = True
+        self.ready = False
+        started = datetime.now(timezone.utc)
+        try:
+            self._reset(capacity=max(1024, await db.visits.estimated_document_count() + 1024))
+            async for visit in db.visits.find({}, ANALYTICS_VISIT_PROJECTION):
+                self._append(visit)
+        except Exception as e:
+            logger.error(f"Analytics engine load failed, statistics fall back to MongoDB: {str(e)}")
+            self.loading = False
+            self.pending = []
+            return
+        self.loading = False
+        for removed, added in self.pending:
+            self.apply(removed, added)
+        self.pending = []
+        self.loaded_at = datetime.now(timezone.utc)
+        self.load_seconds = (self.loaded_at - started).total_seconds()
+        self.ready = True
+        logger.info(f"Analytics engine loaded {self.size} visits in {self.load_seconds:.2f}s")
+    
+    def _mask(self, date_from=None, date_to=None):
+        mask = self.cols["alive"][:self.size].copy()
+        dates = self.cols["date"][:self.size]
+        if date_from:
+            mask &= dates >= date_ordinal(date_from)
+        if date_to:
+            mask &= (dates <= date_ordinal(date_to)) & (dates >= 0)
+        return mask
+    
+    def covers(self, *dates):
+        """Whether the engine can answer for these range bounds"""
+        return self.ready and all(d is None or date_ordinal(d) is not None for d in dates)
+    
+    def summarize(self, date_from=None, date_to=None):
+        """Same result shape as sum_daily_rollups"""
+        mask = self._mask(date_from, date_to)
+        personal = mask & ~self.cols["retreat"][:self.size]
+        retreat = mask & self.cols["retreat"][:self.size]
+        price = self.cols["price"][:self.size]
+        tips = self.cols["tips"][:self.size]
+        
+        summary = {}
+        for split, split_mask in (("", mask), ("personal_", personal), ("retreat_", retreat)):
+            summary[f"{split}visits"] = int(np.count_nonzero(split_mask))
+            summary[f"{split}revenue"] = int(price[split_mask].sum())
+            summary[f"{split}tips"] = int(tips[split_mask].sum())
+        
+        topic_counts = np.bincount(self.cols["topic"][:self.size][mask], minlength=len(self.topics))
+        summary["topics"] = Counter({
+            self.topics[code]: int(count)
+            for code, count in enumerate(topic_counts) if count and self.topics[code] is not None
+        })
+        
+        practice_masks = self.cols["practices"][:self.size][personal]
+        summary["practices"] = Counter()
+        for practice, bit in self.practice_bits.items():
+            count = int(np.count_nonzero(practice_masks & (1 << bit)))
+            if count:
+                summary["practices"][practice] = count
+        return summary
+    
+    def client_topic_groups(self, date_from, date_to):
+        """Per-client visit totals with per-topic counts, ordered by visit count"""
+        mask = self._mask(date_from, date_to)
+        clients = self.cols["client"][:self.size][mask].astype("int64")
+        topics = self.cols["topic"][:self.size][mask]
+        keys = clients * max(len(self.topics), 1) + topics
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse)
+        revenue = np.bincount(inverse, weights=self.cols["price"][:self.size][mask])
+        tips = np.bincount(inverse, weights=self.cols["tips"][:self.size][mask])
+        
+        groups = {}
+        for i in np.argsort(-counts, kind="stable"):
+            client_code, topic_code = divmod(int(unique_keys[i]), max(len(self.topics), 1))
+            group = groups.setdefault(self.client_ids[client_code], {
+                "_id": self.client_ids[client_code],
+                "visit_count": 0, "total_revenue": 0, "total_tips": 0, "topics": []
+            })
+            group["visit_count"] += int(counts[i])
+            group["total_revenue"] += int(round(revenue[i]))
+            group["total_tips"] += int(round(tips[i]))
+            group["topics"].append({"topic": self.topics[topic_code], "count": int(counts[i])})
+        return sorted(groups.values(), key=lambda g: g["visit_count"], reverse=True)
+    
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "loading": self.loading,
+            "rows": self.size,
+            "live_rows": len(self.row_of),
+            "memory_bytes": int(sum(c.nbytes for c in self.cols.values())),
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "load_seconds": self.load_seconds
+        }
+
+analytics_engine = VisitAnalytics()
+
+async def visit_summarizer(date_from=None, date_to=None):
+    """Get a summarize(date_from, date_to) function for visits within the given bounds.
+    
+    It answers from the in-memory columns when they are loaded, otherwise from the
+    daily rollups of that range.
+    """
+    if analytics_engine.covers(date_from, date_to):
+        return analytics_engine.summarize
+    rollups = await load_daily_rollups(date_from, date_to)
+    return lambda date_from=None, date_to=None: sum_daily_rollups(rollups, date_from, date_to)
+
+@api_router.get("/admin/analytics")
+async def get_analytics_status(current_user: dict = Depends(get_current_user)):
+    """Get in-memory analytics engine status"""
+    return analytics_engine.stats()
+
+# ==================== RANGE STATISTICS ====================
+
+RANGE_FIELDS = ["visits", "revenue", "tips"]
+RANGE_BUCKETS = ["day", "week", "month"]
+MAX_RANGE_BUCKETS = 3660
+
+class DailyPrefixIndex:
+    """Cumulative sums over daily visit totals; any date range sums in O(log n).
+    
+    Only days that have a rollup are kept, sorted by ordinal, so a far-off date costs
+    one entry rather than one for every day in between.
+    """
+    
+    def __init__(self, rollups):
+        days = {}
+        for day in rollups:
+            ordinal = date_ordinal(day["_id"])
+            if ordinal is not None:
+                days[ordinal] = day
+        self.ordinals = sorted(days)
+        self.cumulative = {
+            field: [0, *accumulate(days[o].get(field, 0) for o in self.ordinals)]
+            for field in RANGE_FIELDS
+        }
+    
+    def range_sum(self, field, start_ordinal, end_ordinal):
+        """Sum of a field over [start_ordinal, end_ordinal], both inclusive"""
+        start = bisect_left(self.ordinals, start_ordinal)
+        end = bisect_right(self.ordinals, end_ordinal)
+        if start >= end:
+            return 0
+        cumulative = self.cumulative[field]
+        return cumulative[end] - cumulative[start]
+    
+    def totals(self, start_ordinal, end_ordinal):
+        return {field: self.range_sum(field, start_ordinal, end_ordinal) for field in RANGE_FIELDS}
+
+prefix_index_cache = {"version": None, "index": None}
+
+async def get_daily_prefix_index():
+    """Get the prefix index, rebuilding it from the daily rollups after visit writes"""
+    version = data_versions["visits"]
+    if prefix_index_cache["version"] != version:
+        rollups = await db.visit_daily_rollups.find({}, {f: 1 for f in RANGE_FIELDS}).to_list(length=None)
+        prefix_index_cache["index"] = DailyPrefixIndex(rollups)
+        prefix_index_cache["version"] = version
+    return prefix_index_cache["index"]
+
+def date_buckets(start, end, bucket):
+    """Split [start, end] (dates) into day, ISO week or calendar month buckets, clipped to the range"""
+    current = start
+    while True:
+        if bucket == "day":
+            days_left = 0
+        elif bucket == "week":
+            days_left = 6 - current.weekday()
+        else:
+            days_left = monthrange(current.year, current.month)[1] - current.day
+        # Clip before adding, so ranges ending at date.max cannot overflow
+        bucket_end = end if (end - current).days <= days_left else current + timedelta(days=days_left)
+        yield current, bucket_end
+        if bucket_end >= end:
+            break
+        current = bucket_end + timedelta(days=1)
+
+def count_date_buckets(start, end, bucket):
+    """Number of buckets date_buckets() yields, without building them"""
+    if bucket == "day":
+        return (end - start).days + 1
+    if bucket == "week":
+        return ((end - start).days + start.weekday()) // 7 + 1
+    return (end.year - start.year) * 12 + end.month - start.month + 1
+
+@api_router.get("/stats/range")
+async def get_range_stats(
+    date_from: str,
+    date_to: str,
+    bucket: str = "month",
+    current_user: dict = Depends(get_current_user)
+):
+    """Get visit counts, revenue and tips for any date range, split into buckets"""
+    try:
+        start = datetime.strptime(date_from, "%Y-%m-%d").date()
+        end = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format, expected YYYY-MM-DD")
+    if start > end:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    if bucket not in RANGE_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of: {', '.join(RANGE_BUCKETS)}")
+    if count_date_buckets(start, end, bucket) > MAX_RANGE_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_RANGE_BUCKETS} buckets per request")
+    
+    index = await get_daily_prefix_index()
+    buckets = [
+        {
+            "start": bucket_start.isoformat(),
+            "end": bucket_end.isoformat(),
+            **index.totals(bucket_start.toordinal(), bucket_end.toordinal())
+        }
+        for bucket_start, bucket_end in date_buckets(start, end, bucket)
+    ]
+    
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "bucket": bucket,
+        "buckets": buckets,
+        "totals": index.totals(start.toordinal(), end.toordinal())
+    }
+
 # ==================== STATISTICS ROUTES ====================
 
 @api_router.get("/stats/overview")
@@ -464,63 +1526,63 @@ async def get_stats_overview(
     date_to: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    # Total clients
-    total_clients = await db.clients.count_documents({})
-    
+    return await cached_stats_overview()
+
+async def cached_stats_overview():
+    # Figures are relative to today, so the date is part of the cache key
+    return await stats_cache.get_or_compute(
+        "overview", ("clients", "visits", "retreats"), {"today": today_iso()},
+        compute_stats_overview
+    )
+
+async def compute_stats_overview():
     # Get current year
     now = datetime.now(timezone.utc)
     year_start = f"{now.year}-01-01"
+    thirty_days_ago = (now - timedelta(days=30)).strftime("%Y-%m-%d")
+    
+    # Independent queries run concurrently; visit counters come from one all-time
+    # summarizer, which the year-to-date figures below share
+    total_clients, summarize, recent_visits = await gather_limited(
+        db.clients.count_documents({}),
+        visit_summarizer(),
+        db.visits.find().sort("date", -1).limit(10).to_list(length=10)
+    )
+    financial = await get_financial_stats_ytd(summarize)
+    practices = get_practice_stats_ytd(summarize)
     
     # Visits YTD
-    visits_ytd = await db.visits.count_documents({"date": {"$gte": year_start}})
+    visits_ytd = summarize(date_from=year_start)["visits"]
     
     # Visits last 30 days
-    thirty_days_ago = (now - timedelta(days=30)).strftime("%Y-%m-%d")
-    visits_last_30 = await db.visits.count_documents({"date": {"$gte": thirty_days_ago}})
+    visits_last_30 = summarize(date_from=thirty_days_ago)["visits"]
     
     # Top topics (all time)
-    pipeline = [
-        {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-        {"$limit": 5}
-    ]
-    top_topics_cursor = db.visits.aggregate(pipeline)
-    top_topics = await top_topics_cursor.to_list(length=5)
-    top_topics = [{"topic": t["_id"], "count": t["count"]} for t in top_topics]
-    
-    # Recent visits
-    recent_visits_cursor = db.visits.find().sort("date", -1).limit(10)
-    recent_visits = await recent_visits_cursor.to_list(length=10)
+    all_time_topics = summarize()["topics"]
+    top_topics = [{"topic": topic, "count": count} for topic, count in all_time_topics.most_common(5)]
     
-    # Enrich with client names
+    # Enrich recent visits with client names
+    client_names = await ClientLoader().names(v.get("client_id") for v in recent_visits)
     enriched_visits = []
     for visit in recent_visits:
-        try:
-            client = await db.clients.find_one({"_id": ObjectId(visit["client_id"])})
-            visit_data = serialize_doc(visit)
-            if client:
-                visit_data["client_name"] = format_client_name(client)
-            enriched_visits.append(visit_data)
-        except:
-            pass
-    
-    # Visits over time (last 12 months)
-    visits_over_time = []
-    for i in range(11, -1, -1):
-        month_date = now - timedelta(days=30 * i)
-        month_start = month_date.replace(day=1).strftime("%Y-%m-%d")
-        if month_date.month == 12:
-            next_month_start = month_date.replace(year=month_date.year + 1, month=1, day=1).strftime("%Y-%m-%d")
-        else:
-            next_month_start = month_date.replace(month=month_date.month + 1, day=1).strftime("%Y-%m-%d")
-        
-        count = await db.visits.count_documents({
-            "date": {"$gte": month_start, "$lt": next_month_start}
-        })
-        visits_over_time.append({
-            "label": month_date.strftime("%b %Y"),
-            "visits": count
-        })
+        visit_data = serialize_doc(visit)
+        if visit.get("client_id") in client_names:
+            visit_data["client_name"] = client_names[visit["client_id"]]
+        enriched_visits.append(visit_data)
+    
+    # Visits over time (last 12 calendar months, including the current one)
+    index = await get_daily_prefix_index()
+    first_month = now.date().replace(day=1)
+    month_ends_on = (first_month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+    for _ in range(11):
+        first_month = (first_month - timedelta(days=1)).replace(day=1)
+    visits_over_time = [
+        {
+            "label": month_start.strftime("%b %Y"),
+            "visits": index.range_sum("visits", month_start.toordinal(), month_end.toordinal())
+        }
+        for month_start, month_end in date_buckets(first_month, month_ends_on, "month")
+    ]
     
     return {
         "total_clients": total_clients,
@@ -529,82 +1591,62 @@ async def get_stats_overview(
         "top_topics": top_topics,
         "recent_visits": enriched_visits,
         "visits_over_time": visits_over_time,
-        "financial": await get_financial_stats_ytd(),
-        "practices": await get_practice_stats_ytd()
+        "financial": financial,
+        "practices": practices
     }
 
-async def get_practice_stats_ytd():
+def get_practice_stats_ytd(summarize):
     """Get practice statistics for current year (personal visits only, excluding retreats)"""
     now = datetime.now(timezone.utc)
     year_start = f"{now.year}-01-01"
     
-    # Count practices YTD - exclude retreat visits
-    pipeline = [
-        {"$match": {"date": {"$gte": year_start}, "retreat_id": {"$eq": None}}},
-        {"$unwind": {"path": "$practices", "preserveNullAndEmptyArrays": False}},
-        {"$group": {"_id": "$practices", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ]
-    result = await db.visits.aggregate(pipeline).to_list(10)
+    # Practice counts only cover personal visits
+    practices = summarize(date_from=year_start)["practices"]
     
-    return [{"practice": p["_id"], "count": p["count"]} for p in result]
+    return [{"practice": practice, "count": count} for practice, count in practices.most_common(10)]
 
-async def get_financial_stats_ytd():
-    """Get financial statistics for current year (visits + retreats)"""
+async def get_financial_stats_ytd(summarize):
+    """Get financial statistics for current year (visits + retreats).
+    
+    summarize comes from visit_summarizer and has to cover the year and the last 30 days.
+    """
     now = datetime.now(timezone.utc)
     year_start = f"{now.year}-01-01"
     thirty_days_ago = (now - timedelta(days=30)).strftime("%Y-%m-%d")
     
+    today = now.strftime("%Y-%m-%d")
+    
+    retreat_totals, retreat_totals_30 = await gather_limited(
+        aggregate_retreat_totals(retreats_starting(year_start, f"{now.year}-12-31")),
+        aggregate_retreat_totals(retreats_starting(thirty_days_ago, today))
+    )
+    
     # Revenue from visits YTD (excluding retreat visits to avoid double counting)
-    pipeline_ytd = [
-        {"$match": {"date": {"$gte": year_start}, "retreat_id": {"$eq": None}}},
-        {"$group": {
-            "_id": None,
-            "total_revenue": {"$sum": {"$ifNull": ["$price", 15000]}},
-            "total_tips": {"$sum": {"$ifNull": ["$tips", 0]}},
-            "count": {"$sum": 1}
-        }}
-    ]
-    result_ytd = await db.visits.aggregate(pipeline_ytd).to_list(1)
-    visits_ytd_data = result_ytd[0] if result_ytd else {"total_revenue": 0, "total_tips": 0, "count": 0}
+    personal_ytd = summarize(date_from=year_start)
+    visits_ytd_data = {
+        "total_revenue": personal_ytd["personal_revenue"],
+        "total_tips": personal_ytd["personal_tips"],
+        "count": personal_ytd["personal_visits"]
+    }
     
     # Revenue from retreats YTD
-    retreat_query = {"start_date": {"$gte": year_start}}
-    retreats = await db.retreats.find(retreat_query).to_list(length=100)
-    
-    retreat_revenue = 0
-    retreat_expenses = 0
-    for retreat in retreats:
-        participants = retreat.get("participants", [])
-        expenses = retreat.get("expenses", [])
-        retreat_revenue += sum(p.get("payment", 0) for p in participants)
-        retreat_expenses += sum(e.get("amount", 0) for e in expenses)
+    retreat_revenue = retreat_totals["revenue"]
+    retreat_expenses = retreat_totals["expenses"]
     
     # Total YTD (visits + retreats)
     total_revenue_ytd = visits_ytd_data["total_revenue"] + retreat_revenue
     total_tips_ytd = visits_ytd_data["total_tips"]
     
     # Revenue last 30 days (visits only, excluding retreat visits)
-    pipeline_30 = [
-        {"$match": {"date": {"$gte": thirty_days_ago}, "retreat_id": {"$eq": None}}},
-        {"$group": {
-            "_id": None,
-            "total_revenue": {"$sum": {"$ifNull": ["$price", 15000]}},
-            "total_tips": {"$sum": {"$ifNull": ["$tips", 0]}},
-            "count": {"$sum": 1}
-        }}
-    ]
-    result_30 = await db.visits.aggregate(pipeline_30).to_list(1)
-    visits_30_data = result_30[0] if result_30 else {"total_revenue": 0, "total_tips": 0, "count": 0}
+    personal_30 = summarize(date_from=thirty_days_ago)
+    visits_30_data = {
+        "total_revenue": personal_30["personal_revenue"],
+        "total_tips": personal_30["personal_tips"],
+        "count": personal_30["personal_visits"]
+    }
     
     # Retreats last 30 days
-    retreat_query_30 = {"start_date": {"$gte": thirty_days_ago}}
-    retreats_30 = await db.retreats.find(retreat_query_30).to_list(length=50)
-    
-    retreat_revenue_30 = 0
-    for retreat in retreats_30:
-        participants = retreat.get("participants", [])
-        retreat_revenue_30 += sum(p.get("payment", 0) for p in participants)
+    retreat_revenue_30 = retreat_totals_30["revenue"]
     
     total_revenue_30 = visits_30_data["total_revenue"] + retreat_revenue_30
     total_tips_30 = visits_30_data["total_tips"]
@@ -625,10 +1667,40 @@ async def get_financial_stats_ytd():
         "visits_revenue_ytd": visits_ytd_data["total_revenue"]
     }
 
+def summarize_client_visits(rows, year, months_year):
+    """Fold (month, topic) visit counts into totals, topics and a 12-month breakdown.
+    
+    year limits totals and topics (None means all time); months_year picks the
+    year shown in visits_by_month.
+    """
+    topics = Counter()
+    by_month = Counter()
+    for row in rows:
+        month_key, count = row["_id"]["month"], row["count"]
+        if year is None or month_key[:4] == str(year):
+            topics[row["_id"]["topic"]] += count
+        if month_key[:4] == str(months_year):
+            by_month[month_key] += count
+    
+    return {
+        "total_visits": sum(topics.values()),
+        "topics": [{"topic": topic, "count": count} for topic, count in topics.most_common(100)],
+        "visits_by_month": [
+            {
+                "month": datetime(months_year, month, 1).strftime("%b"),
+                "visits": by_month[f"{months_year}-{month:02d}"]
+            }
+            for month in range(1, 13)
+        ],
+        "year": months_year
+    }
+
 @api_router.get("/stats/client/{client_id}")
 async def get_client_stats(
     client_id: str,
+    request: Request,
     year: Optional[int] = None,
+    years: Optional[str] = None,  # Comma-separated list, e.g. "2024,2025"
     current_user: dict = Depends(get_current_user)
 ):
     # Verify client exists
@@ -640,48 +1712,49 @@ async def get_client_stats(
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
     
+    requested_years = None
+    if years:
+        try:
+            requested_years = sorted({int(y) for y in years.split(",") if y.strip()})
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid years format")
+        if not requested_years or len(requested_years) > 20:
+            raise HTTPException(status_code=400, detail="Between 1 and 20 years can be requested")
+    
+    if is_closed_year(year) and not requested_years:
+        return await serve_year_snapshot(
+            request, "client-stats", year, {"client": client_id},
+            lambda: compute_client_stats(client, client_id, year, None), client_id=client_id
+        )
+    return await compute_client_stats(client, client_id, year, requested_years)
+
+async def compute_client_stats(client, client_id, year, requested_years):
     query = {"client_id": client_id}
-    if year:
+    if requested_years:
+        query["date"] = {"$gte": f"{requested_years[0]}-01-01", "$lte": f"{requested_years[-1]}-12-31"}
+    elif year:
         query["date"] = {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}
     
-    # Total visits
-    total_visits = await db.visits.count_documents(query)
-    
-    # Topics breakdown
+    # One aggregation over the (client_id, date) index yields every figure below
     pipeline = [
         {"$match": query},
-        {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
+        {"$group": {
+            "_id": {"month": {"$substrBytes": ["$date", 0, 7]}, "topic": "$topic"},
+            "count": {"$sum": 1}
+        }}
     ]
-    topics_cursor = db.visits.aggregate(pipeline)
-    topics = await topics_cursor.to_list(length=100)
-    topics = [{"topic": t["_id"], "count": t["count"]} for t in topics]
+    rows = await db.visits.aggregate(pipeline).to_list(length=None)
     
-    # Visits by month for the year
-    visits_by_month = []
-    target_year = year or datetime.now(timezone.utc).year
-    for month in range(1, 13):
-        month_start = f"{target_year}-{month:02d}-01"
-        if month == 12:
-            month_end = f"{target_year + 1}-01-01"
-        else:
-            month_end = f"{target_year}-{month + 1:02d}-01"
-        
-        count = await db.visits.count_documents({
-            "client_id": client_id,
-            "date": {"$gte": month_start, "$lt": month_end}
-        })
-        visits_by_month.append({
-            "month": datetime(target_year, month, 1).strftime("%b"),
-            "visits": count
-        })
+    if requested_years:
+        return {
+            "client": serialize_doc(client),
+            "years": [summarize_client_visits(rows, y, y) for y in requested_years]
+        }
     
+    target_year = year or datetime.now(timezone.utc).year
     return {
         "client": serialize_doc(client),
-        "total_visits": total_visits,
-        "topics": topics,
-        "visits_by_month": visits_by_month,
-        "year": target_year
+        **summarize_client_visits(rows, year, target_year)
     }
 
 @api_router.get("/clients/{client_id}/practice-stats")
@@ -690,36 +1763,50 @@ async def get_client_practice_stats(
     current_user: dict = Depends(get_current_user)
 ):
     """Get practice counts and retreat count for a specific client"""
-    # Verify client exists
     try:
-        client = await db.clients.find_one({"_id": ObjectId(client_id)})
+        client_oid = ObjectId(client_id)
     except:
         raise HTTPException(status_code=400, detail="Invalid client ID format")
     
-    if not client:
-        raise HTTPException(status_code=404, detail="Client not found")
+    # Count practices from personal visits only (excluding retreats), one bit per practice;
+    # until migration 0003 has given every visit a mask, or when some practice got no
+    # bit, unwind the arrays instead
+    bits = await get_practice_bits()
+    masks_ready = every_practice_has_bit() and await migration_done("0003_visit_practices_mask")
+    if masks_ready:
+        pipeline = [
+            {"$match": {"client_id": client_id, "retreat_id": {"$eq": None}}},
+            {"$group": {"_id": None, **practice_count_fields(bits)}}
+        ]
+    else:
+        pipeline = [
+            {"$match": {"client_id": client_id, "retreat_id": {"$eq": None}}},
+            {"$unwind": "$practices"},
+            {"$group": {"_id": "$practices", "count": {"$sum": 1}}}
+        ]
     
-    # Count practices from personal visits only (excluding retreats)
-    pipeline = [
-        {"$match": {"client_id": client_id, "retreat_id": {"$eq": None}}},
-        {"$unwind": {"path": "$practices", "preserveNullAndEmptyArrays": False}},
-        {"$group": {"_id": "$practices", "count": {"$sum": 1}}},
-        {"$sort": {"_id": 1}}
-    ]
-    practices_result = await db.visits.aggregate(pipeline).to_list(20)
-    practice_counts = {p["_id"]: p["count"] for p in practices_result}
+    # The client check and all counts are independent, so they run together
+    client, practices_result, personal_visits_count, retreat_count = await gather_limited(
+        db.clients.find_one({"_id": client_oid}, {"_id": 1}),
+        db.visits.aggregate(pipeline).to_list(length=None),
+        # Personal visits (excluding retreats)
+        db.visits.count_documents({"client_id": client_id, "retreat_id": {"$eq": None}}),
+        # Retreat participations
+        db.visits.count_documents({"client_id": client_id, "retreat_id": {"$ne": None}})
+    )
     
-    # Count personal visits (excluding retreats)
-    personal_visits_count = await db.visits.count_documents({
-        "client_id": client_id, 
-        "retreat_id": {"$eq": None}
-    })
+    if not client:
+        raise HTTPException(status_code=404, detail="Client not found")
     
-    # Count retreat participations
-    retreat_count = await db.visits.count_documents({
-        "client_id": client_id,
-        "retreat_id": {"$ne": None}
-    })
+    if masks_ready:
+        counts = practices_result[0] if practices_result else {}
+        practice_counts = {
+            practice: int(counts[f"bit_{bit}"])
+            for practice, bit in sorted(bits.items())
+            if counts.get(f"bit_{bit}")
+        }
+    else:
+        practice_counts = {row["_id"]: row["count"] for row in sorted(practices_result, key=lambda r: r["_id"])}
     
     return {
         "practice_counts": practice_counts,
@@ -733,86 +1820,60 @@ async def get_topics_stats(
     date_to: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
-    query = {}
-    if date_from or date_to:
-        date_filter = {}
-        if date_from:
-            date_filter["$gte"] = date_from
-        if date_to:
-            date_filter["$lte"] = date_to
-        query["date"] = date_filter
-    
-    pipeline = [
-        {"$match": query} if query else {"$match": {}},
-        {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ]
-    
-    topics_cursor = db.visits.aggregate(pipeline)
-    topics = await topics_cursor.to_list(length=100)
+    return await cached_topics_stats(date_from, date_to)
+
+async def cached_topics_stats(date_from=None, date_to=None):
+    return await stats_cache.get_or_compute(
+        "topics", ("visits",), {"date_from": date_from, "date_to": date_to},
+        lambda: compute_topics_stats(date_from, date_to)
+    )
+
+async def compute_topics_stats(date_from, date_to):
+    summarize = await visit_summarizer(date_from, date_to)
+    summary = summarize(date_from, date_to)
     
     return {
-        "topics": [{"topic": t["_id"], "count": t["count"]} for t in topics],
-        "total_visits": sum(t["count"] for t in topics)
+        "topics": [{"topic": topic, "count": count} for topic, count in summary["topics"].most_common(100)],
+        "total_visits": summary["visits"]
     }
 
 @api_router.get("/stats/yearly-summary")
 async def get_yearly_summary(
     year: int,
+    request: Request,
     current_user: dict = Depends(get_current_user)
 ):
     """Get year-end summary with per-client stats"""
+    if is_closed_year(year):
+        return await serve_year_snapshot(request, "yearly-summary", year, {}, lambda: compute_yearly_summary(year))
+    return await cached_yearly_summary(year)
+
+async def cached_yearly_summary(year: int):
+    return await stats_cache.get_or_compute(
+        "yearly-summary", ("clients", "visits"), {"year": year},
+        lambda: compute_yearly_summary(year)
+    )
+
+async def compute_yearly_summary(year: int):
     date_from = f"{year}-01-01"
     date_to = f"{year}-12-31"
     
-    # Get all clients with visit counts for the year
-    clients = await db.clients.find().to_list(length=1000)
-    client_summaries = []
-    
-    for client in clients:
-        client_id = str(client["_id"])
-        
-        # Get visits with financial data for year
-        pipeline = [
-            {"$match": {
-                "client_id": client_id,
-                "date": {"$gte": date_from, "$lte": date_to}
-            }},
-            {"$group": {
-                "_id": None,
-                "visit_count": {"$sum": 1},
-                "total_revenue": {"$sum": {"$ifNull": ["$price", 15000]}},
-                "total_tips": {"$sum": {"$ifNull": ["$tips", 0]}}
-            }}
-        ]
-        result = await db.visits.aggregate(pipeline).to_list(1)
-        
-        if result and result[0]["visit_count"] > 0:
-            visit_data = result[0]
-            
-            # Topics for this client this year
-            topics_pipeline = [
-                {"$match": {
-                    "client_id": client_id,
-                    "date": {"$gte": date_from, "$lte": date_to}
-                }},
-                {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
-                {"$sort": {"count": -1}}
-            ]
-            topics_cursor = db.visits.aggregate(topics_pipeline)
-            topics = await topics_cursor.to_list(length=100)
-            
-            client_summaries.append({
-                "client_id": client_id,
-                "client_name": format_client_name(client),
-                "visit_count": visit_data["visit_count"],
-                "total_revenue": visit_data["total_revenue"],
-                "total_tips": visit_data["total_tips"],
-                "topics": [{"topic": t["_id"], "count": t["count"]} for t in topics]
-            })
+    if analytics_engine.covers(date_from, date_to):
+        facets = await yearly_facets_from_engine(date_from, date_to)
+    else:
+        facets = await yearly_facets_from_mongo(date_from, date_to)
     
-    # Sort by visit count
-    client_summaries.sort(key=lambda x: x["visit_count"], reverse=True)
+    client_summaries = [
+        {
+            "client_id": c["_id"],
+            "client_name": format_client_name(c["client"]),
+            "visit_count": c["visit_count"],
+            "total_revenue": c["total_revenue"],
+            "total_tips": c["total_tips"],
+            "topics": c["topics"]
+        }
+        for c in facets["clients"]
+    ]
     
     # Overall stats
     total_visits = sum(c["visit_count"] for c in client_summaries)
@@ -820,15 +1881,6 @@ async def get_yearly_summary(
     total_tips = sum(c["total_tips"] for c in client_summaries)
     avg_check = total_revenue / total_visits if total_visits > 0 else 0
     
-    # All topics for year
-    pipeline = [
-        {"$match": {"date": {"$gte": date_from, "$lte": date_to}}},
-        {"$group": {"_id": "$topic", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}}
-    ]
-    topics_cursor = db.visits.aggregate(pipeline)
-    all_topics = await topics_cursor.to_list(length=100)
-    
     return {
         "year": year,
         "total_clients_active": len(client_summaries),
@@ -837,37 +1889,247 @@ async def get_yearly_summary(
         "total_tips": total_tips,
         "avg_check": round(avg_check),
         "client_summaries": client_summaries,
-        "topic_distribution": [{"topic": t["_id"], "count": t["count"]} for t in all_topics]
+        "topic_distribution": [{"topic": t["_id"], "count": t["count"]} for t in facets["topics"]]
     }
 
-@api_router.get("/topics")
-async def get_all_topics(current_user: dict = Depends(get_current_user)):
-    """Get all unique topics for filtering"""
+async def yearly_facets_from_engine(date_from, date_to):
+    """Per-client groups and topic distribution from the in-memory columns"""
+    groups = analytics_engine.client_topic_groups(date_from, date_to)
+    client_oids = [ObjectId(g["_id"]) for g in groups if ObjectId.is_valid(g["_id"])]
+    clients = await db.clients.find(
+        {"_id": {"$in": client_oids}}, {"first_name": 1, "middle_name": 1, "last_name": 1}
+    ).to_list(length=None)
+    clients_by_id = {str(c["_id"]): c for c in clients}
+    
+    # Visits of clients that no longer exist are left out, as in the pipeline
+    for group in groups:
+        group["client"] = clients_by_id.get(group["_id"])
+    topics = analytics_engine.summarize(date_from, date_to)["topics"].most_common(100)
+    return {
+        "clients": [g for g in groups if g["client"]],
+        "topics": [{"_id": topic, "count": count} for topic, count in topics]
+    }
+
+async def yearly_facets_from_mongo(date_from, date_to):
+    # One pass over the year's visits: group by (client, topic), then fold into
+    # per-client summaries with names joined in, and the overall topic distribution
     pipeline = [
-        {"$group": {"_id": "$topic"}},
-        {"$sort": {"_id": 1}}
+        {"$match": {"date": {"$gte": date_from, "$lte": date_to}}},
+        {"$group": {
+            "_id": {"client_id": "$client_id", "topic": "$topic"},
+            "count": {"$sum": 1},
+            "revenue": {"$sum": {"$ifNull": ["$price", default_visit_price()]}},
+            "tips": {"$sum": {"$ifNull": ["$tips", 0]}}
+        }},
+        {"$facet": {
+            "clients": [
+                {"$sort": {"count": -1}},
+                {"$group": {
+                    "_id": "$_id.client_id",
+                    "visit_count": {"$sum": "$count"},
+                    "total_revenue": {"$sum": "$revenue"},
+                    "total_tips": {"$sum": "$tips"},
+                    "topics": {"$push": {"topic": "$_id.topic", "count": "$count"}}
+                }},
+                {"$lookup": {
+                    "from": "clients",
+                    "let": {"client_oid": {"$convert": {
+                        "input": "$_id", "to": "objectId", "onError": None, "onNull": None
+                    }}},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$_id", "$$client_oid"]}}},
+                        {"$project": {"first_name": 1, "middle_name": 1, "last_name": 1}}
+                    ],
+                    "as": "client"
+                }},
+                # Visits of clients that no longer exist are left out, as before
+                {"$unwind": "$client"},
+                {"$sort": {"visit_count": -1}}
+            ],
+            "topics": [
+                {"$group": {"_id": "$_id.topic", "count": {"$sum": "$count"}}},
+                {"$sort": {"count": -1}},
+                {"$limit": 100}
+            ]
+        }}
     ]
-    topics_cursor = db.visits.aggregate(pipeline)
-    topics = await topics_cursor.to_list(length=500)
-    return {"topics": [t["_id"] for t in topics if t["_id"]]}
+    result = await db.visits.aggregate(pipeline).to_list(1)
+    return result[0] if result else {"clients": [], "topics": []}
+
+def month_index(ordinal):
+    day = datetime.fromordinal(ordinal)
+    return day.year * 12 + day.month - 1
+
+class CohortAccumulator:
+    """Folds one client's visit dates at a time into first-visit-month cohorts"""
+    
+    def __init__(self, today_ordinal, churn_days, max_months):
+        self.today_ordinal = today_ordinal
+        self.current_month = month_index(today_ordinal)
+        self.churn_days = churn_days
+        self.max_months = max_months
+        self.cohorts = {}
+        self.all_gaps = []
+    
+    def add_client(self, ordinals):
+        if not ordinals:
+            return
+        ordinals.sort()
+        first_month = month_index(ordinals[0])
+        cohort = self.cohorts.setdefault(first_month, {
+            "clients": 0, "returned": 0, "churned": 0,
+            "active_by_offset": Counter(), "gaps": [], "days_to_return": []
+        })
+        cohort["clients"] += 1
+        for offset in {month_index(o) - first_month for o in ordinals}:
+            if offset <= self.max_months:
+                cohort["active_by_offset"][offset] += 1
+        
+        gaps = [b - a for a, b in zip(ordinals, ordinals[1:]) if b > a]
+        if gaps:
+            cohort["returned"] += 1
+            cohort["days_to_return"].append(gaps[0])
+            cohort["gaps"].extend(gaps)
+            self.all_gaps.extend(gaps)
+        if self.today_ordinal - ordinals[-1] > self.churn_days:
+            cohort["churned"] += 1
+    
+    def result(self):
+        cohorts = []
+        for first_month in sorted(self.cohorts):
+            cohort = self.cohorts[first_month]
+            observed = min(self.max_months, self.current_month - first_month)
+            cohorts.append({
+                "cohort": f"{first_month // 12}-{first_month % 12 + 1:02d}",
+                "clients": cohort["clients"],
+                "returned": cohort["returned"],
+                "churned": cohort["churned"],
+                "retention": [
+                    round(cohort["active_by_offset"][offset] / cohort["clients"], 4)
+                    for offset in range(0, max(observed, 0) + 1)
+                ],
+                "median_days_between_visits": median(cohort["gaps"]) if cohort["gaps"] else None,
+                "median_days_to_return": median(cohort["days_to_return"]) if cohort["days_to_return"] else None
+            })
+        
+        total_clients = sum(c["clients"] for c in cohorts)
+        returned = sum(c["returned"] for c in cohorts)
+        churned = sum(c["churned"] for c in cohorts)
+        return {
+            "cohorts": cohorts,
+            "overall": {
+                "clients": total_clients,
+                "returned": returned,
+                "return_rate": round(returned / total_clients, 4) if total_clients > 0 else 0,
+                "churned": churned,
+                "active": total_clients - churned,
+                "median_days_between_visits": median(self.all_gaps) if self.all_gaps else None
+            }
+        }
+
+@api_router.get("/stats/cohorts")
+async def get_cohort_stats(
+    churn_days: int = 180,
+    max_months: int = 12,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get first-visit-month cohorts with retention curves, return intervals and churn"""
+    if churn_days < 1 or not 1 <= max_months <= 120:
+        raise HTTPException(status_code=400, detail="churn_days must be positive and max_months within 1..120")
+    return await stats_cache.get_or_compute(
+        "cohorts", ("visits",), {"churn_days": churn_days, "max_months": max_months, "today": today_iso()},
+        lambda: compute_cohort_stats(churn_days, max_months)
+    )
+
+async def compute_cohort_stats(churn_days: int, max_months: int):
+    accumulator = CohortAccumulator(datetime.now(timezone.utc).toordinal(), churn_days, max_months)
+    
+    # One streaming pass in (client_id, date) index order; each client's dates are
+    # folded as soon as the next client starts
+    cursor = db.visits.find({}, {"_id": 0, "client_id": 1, "date": 1}).sort([("client_id", 1), ("date", -1)])
+    current_client = None
+    ordinals = []
+    async for visit in cursor:
+        if visit.get("client_id") != current_client:
+            accumulator.add_client(ordinals)
+            current_client = visit.get("client_id")
+            ordinals = []
+        ordinal = date_ordinal(visit.get("date"))
+        if ordinal is not None:
+            ordinals.append(ordinal)
+    accumulator.add_client(ordinals)
+    
+    return {"churn_days": churn_days, "max_months": max_months, **accumulator.result()}
+
+MAX_TOPICS_LIMIT = 500
+
+@api_router.get("/topics")
+async def get_all_topics(
+    order: str = "alpha",  # alpha or usage (most used first)
+    limit: int = MAX_TOPICS_LIMIT,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get all unique topics for filtering"""
+    if order not in ("alpha", "usage"):
+        raise HTTPException(status_code=400, detail="order must be 'alpha' or 'usage'")
+    if not 1 <= limit <= MAX_TOPICS_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be within 1..{MAX_TOPICS_LIMIT}")
+    sort = [("count", -1), ("_id", 1)] if order == "usage" else [("_id", 1)]
+    
+    cursor = db.topics.find({"count": {"$gt": 0}}).sort(sort).limit(limit)
+    topics = await cursor.to_list(length=limit)
+    return {
+        "topics": [t["_id"] for t in topics],
+        "usage": [
+            {"topic": t["_id"], "count": t["count"], "last_used": t.get("last_used")}
+            for t in topics
+        ]
+    }
 
 @api_router.get("/practices")
 async def get_available_practices(current_user: dict = Depends(get_current_user)):
     """Get list of available practices"""
-    return {"practices": AVAILABLE_PRACTICES}
+    return {"practices": current_settings()["practices"]}
 
 # ==================== CALENDAR ROUTES ====================
 
+CALENDAR_PAGE_LIMIT = 5000
+
+CALENDAR_VISIT_PROJECTION = {
+    "date": 1, "client_id": 1, "topic": 1, "practices": 1, "price": 1, "tips": 1,
+    "payment_type": 1, "retreat_id": 1
+}
+
+def encode_calendar_cursor(visit):
+    return f"{visit['date']}|{visit['_id']}"
+
+def decode_calendar_cursor(cursor):
+    try:
+        date, visit_id = cursor.rsplit("|", 1)
+        return date, ObjectId(visit_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
 @api_router.get("/calendar/events")
 async def get_calendar_events(
     start_date: str,
     end_date: str,
     event_type: Optional[str] = None,  # visits, retreats, or all
     client_id: Optional[str] = None,
+    limit: int = 2000,  # Visits per page
+    cursor: Optional[str] = None,  # next_cursor of the previous page
+    include_notes: bool = False,
+    clients: ClientLoader = Depends(get_client_loader),
     current_user: dict = Depends(get_current_user)
 ):
-    """Get all events (visits and retreats) for calendar view"""
+    """Get events (visits and retreats) for calendar view, a page of visits at a time.
+    
+    Retreats come with the first page; has_more/next_cursor page through busy ranges.
+    """
+    if not 1 <= limit <= CALENDAR_PAGE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be within 1..{CALENDAR_PAGE_LIMIT}")
     events = []
+    next_cursor = None
     
     # Get visits (excluding retreat-linked visits to avoid duplicates)
     if event_type in [None, "all", "visits"]:
@@ -877,73 +2139,436 @@ async def get_calendar_events(
         }
         if client_id:
             visit_query["client_id"] = client_id
+        if cursor:
+            after_date, after_id = decode_calendar_cursor(cursor)
+            visit_query["$or"] = [
+                {"date": {"$gt": after_date}},
+                {"date": after_date, "_id": {"$gt": after_id}}
+            ]
         
-        visits_cursor = db.visits.find(visit_query).sort("date", 1)
-        visits = await visits_cursor.to_list(length=500)
+        projection = dict(CALENDAR_VISIT_PROJECTION, notes=1) if include_notes else CALENDAR_VISIT_PROJECTION
+        visits_cursor = db.visits.find(visit_query, projection).sort([("date", 1), ("_id", 1)]).limit(limit + 1)
+        visits = await visits_cursor.to_list(length=limit + 1)
+        if len(visits) > limit:
+            visits = visits[:limit]
+            next_cursor = encode_calendar_cursor(visits[-1])
+        
+        # Client names for the whole page in one query
+        client_names = await clients.names(v["client_id"] for v in visits)
+        default_price = default_visit_price()
         
         for visit in visits:
-            # Get client name
-            try:
-                client = await db.clients.find_one({"_id": ObjectId(visit["client_id"])})
-                client_name = format_client_name(client) if client else "Неизвестный"
-            except:
-                client_name = "Неизвестный"
-            
-            price = visit.get("price", DEFAULT_PRICE)
-            events.append({
+            price = visit.get("price", default_price)
+            event = {
                 "id": str(visit["_id"]),
                 "type": "visit",
                 "date": visit["date"],
                 "end_date": visit["date"],
                 "title": visit.get("topic", "Визит"),
                 "client_id": visit["client_id"],
-                "client_name": client_name,
+                "client_name": client_names.get(visit["client_id"], "Неизвестный"),
                 "practices": visit.get("practices", []),
                 "price": price,
                 "tips": visit.get("tips", 0),
-                "notes": visit.get("notes", ""),
+                "payment_type": visit.get("payment_type"),
                 "retreat_id": visit.get("retreat_id"),
-                "payment_status": "charity" if price == 0 else ("discount" if price < DEFAULT_PRICE else "regular")
-            })
+                "payment_status": "charity" if price == 0 else ("discount" if price < default_price else "regular")
+            }
+            if include_notes:
+                event["notes"] = visit.get("notes", "")
+            events.append(event)
     
     # Get retreats
-    if event_type in [None, "all", "retreats"]:
-        retreat_query = {
-            "$or": [
-                {"start_date": {"$gte": start_date, "$lte": end_date}},
-                {"end_date": {"$gte": start_date, "$lte": end_date}},
-                {"$and": [{"start_date": {"$lte": start_date}}, {"end_date": {"$gte": end_date}}]}
-            ]
-        }
-        
-        retreats_cursor = db.retreats.find(retreat_query).sort("start_date", 1)
-        retreats = await retreats_cursor.to_list(length=100)
+    if event_type in [None, "all", "retreats"] and not cursor:
+        # Only the figures the calendar shows, not the embedded arrays
+        pipeline = [
+            {"$match": retreats_overlapping(start_date, end_date)},
+            {"$sort": {"start_date": 1}},
+            {"$project": {
+                "name": 1,
+                "start_date": 1,
+                "end_date": 1,
+                "participant_count": "$total_participants",
+                "total_revenue": 1
+            }}
+        ]
+        retreats = await db.retreats.aggregate(pipeline).to_list(length=None)
         
         for retreat in retreats:
-            participants = retreat.get("participants", [])
-            total_revenue = sum(p.get("payment", 0) for p in participants)
-            
             events.append({
                 "id": str(retreat["_id"]),
                 "type": "retreat",
                 "date": retreat["start_date"],
                 "end_date": retreat["end_date"],
                 "title": retreat["name"],
-                "participant_count": len(participants),
-                "total_revenue": total_revenue
+                "participant_count": retreat.get("participant_count", 0),
+                "total_revenue": retreat.get("total_revenue", 0)
             })
     
-    return {"events": events}
+    return {"events": events, "has_more": next_cursor is not None, "next_cursor": next_cursor}
+
+@api_router.get("/calendar/heatmap")
+async def get_calendar_heatmap(
+    date_from: str,
+    date_to: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get per-day activity for a date range as parallel arrays (index 0 is date_from).
+    
+    Visits and revenue cover personal visits, as the calendar shows them; retreat-linked
+    visits appear as retreat occupancy instead.
+    """
+    try:
+        start = datetime.strptime(date_from, "%Y-%m-%d").date()
+        end = datetime.strptime(date_to, "%Y-%m-%d").date()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format, expected YYYY-MM-DD")
+    if start > end:
+        raise HTTPException(status_code=400, detail="date_from must not be after date_to")
+    if (end - start).days + 1 > MAX_RANGE_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_RANGE_BUCKETS} days per request")
+    
+    return await stats_cache.get_or_compute(
+        "calendar-heatmap", ("visits", "retreats"), {"date_from": date_from, "date_to": date_to},
+        lambda: compute_calendar_heatmap(start, end)
+    )
+
+async def compute_calendar_heatmap(start, end):
+    date_from, date_to = start.isoformat(), end.isoformat()
+    days = (end - start).days + 1
+    rollups, retreats = await gather_limited(
+        db.visit_daily_rollups.find(
+            {"_id": {"$gte": date_from, "$lte": date_to}},
+            {"personal_visits": 1, "personal_revenue": 1, "personal_tips": 1}
+        ).to_list(length=None),
+        db.retreats.aggregate([
+            {"$match": retreats_overlapping(date_from, date_to)},
+            {"$project": {
+                "start_date": 1,
+                "end_date": 1,
+                "participants": {"$ifNull": ["$total_participants", 0]}
+            }}
+        ]).to_list(length=None)
+    )
+    
+    visits = [0] * days
+    revenue = [0] * days
+    for day in rollups:
+        ordinal = date_ordinal(day["_id"])
+        # Rollups of mistyped legacy dates fall inside the string range without being days in it
+        if ordinal is None or not start.toordinal() <= ordinal <= end.toordinal():
+            continue
+        offset = ordinal - start.toordinal()
+        visits[offset] = day.get("personal_visits", 0)
+        revenue[offset] = day.get("personal_revenue", 0) + day.get("personal_tips", 0)
+    
+    # Difference arrays: +n on a retreat's first day in range, -n the day after its last
+    retreat_delta = [0] * (days + 1)
+    occupancy_delta = [0] * (days + 1)
+    for retreat in retreats:
+        retreat_start, retreat_end = date_ordinal(retreat.get("start_date")), date_ordinal(retreat.get("end_date"))
+        if retreat_start is None or retreat_end is None:
+            continue
+        first = max(retreat_start, start.toordinal()) - start.toordinal()
+        last = min(retreat_end, end.toordinal()) - start.toordinal()
+        if first > last:
+            continue
+        retreat_delta[first] += 1
+        retreat_delta[last + 1] -= 1
+        occupancy_delta[first] += retreat["participants"]
+        occupancy_delta[last + 1] -= retreat["participants"]
+    
+    return {
+        "date_from": date_from,
+        "date_to": date_to,
+        "days": days,
+        "visits": visits,
+        "revenue": revenue,
+        "retreats": list(accumulate(retreat_delta[:days])),
+        "retreat_participants": list(accumulate(occupancy_delta[:days]))
+    }
+
+# ==================== CALENDAR FEED ====================
+
+# Calendar apps poll the feed, so a rendered body is cached per window and data
+# version. Windows longer than FEED_CACHE_MAX_DAYS are streamed instead of cached.
+FEED_CACHE_MAX_DAYS = int(os.environ.get('FEED_CACHE_MAX_DAYS', '400'))
+FEED_MAX_DAYS = 3650
+FEED_BATCH_SIZE = 500
+FEED_COLLECTIONS = ("visits", "retreats", "clients")
+
+feed_cache = ResponseCache(max_entries=int(os.environ.get('FEED_CACHE_SIZE', '16')))
+
+def ics_escape(text):
+    return (str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+def ics_line(line):
+    """Fold a content line at 75 octets as RFC 5545 requires"""
+    data = line.encode("utf-8")
+    if len(data) <= 75:
+        return line + "\r\n"
+    parts = []
+    while data:
+        limit = 75 if not parts else 74  # continuation lines start with a space
+        cut = min(limit, len(data))
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:  # don't split a UTF-8 sequence
+            cut -= 1
+        parts.append(data[:cut].decode("utf-8"))
+        data = data[cut:]
+    return "\r\n ".join(parts) + "\r\n"
+
+def ics_date(date_str, days=0):
+    date = datetime.strptime(date_str, "%Y-%m-%d") + timedelta(days=days)
+    return date.strftime("%Y%m%d")
+
+def ics_event(uid, summary, start_date, end_date, dtstamp, description=None):
+    """All-day VEVENT; DTEND is exclusive, hence the day after end_date"""
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{uid}@kinesio-crm",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART;VALUE=DATE:{ics_date(start_date)}",
+        f"DTEND;VALUE=DATE:{ics_date(end_date, days=1)}",
+        f"SUMMARY:{ics_escape(summary)}",
+    ]
+    if description:
+        lines.append(f"DESCRIPTION:{ics_escape(description)}")
+    lines.append("END:VEVENT")
+    return "".join(ics_line(line) for line in lines)
+
+async def render_calendar_feed(date_from, date_to, dtstamp):
+    """Yield the iCalendar body chunk by chunk, a batch of visits at a time"""
+    clients = ClientLoader()
+    yield "".join(ics_line(line) for line in [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//KinesioCRM//Calendar Feed//RU",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:KinesioCRM",
+    ])
+    
+    retreats = db.retreats.find(
+        retreats_overlapping(date_from, date_to), {"name": 1, "start_date": 1, "end_date": 1}
+    ).sort("start_date", 1)
+    async for retreat in retreats:
+        yield ics_event(f"retreat-{retreat['_id']}", f"Ретрит: {retreat['name']}",
+                        retreat["start_date"], retreat["end_date"], dtstamp)
+    
+    # Retreat-linked visits are covered by their retreat, as in the calendar view
+    visits = db.visits.find(
+        {"date": {"$gte": date_from, "$lte": date_to}, "retreat_id": {"$eq": None}},
+        {"date": 1, "client_id": 1, "topic": 1, "practices": 1}
+    ).sort("date", 1).batch_size(FEED_BATCH_SIZE)
+    while True:
+        batch = await visits.to_list(length=FEED_BATCH_SIZE)
+        if not batch:
+            break
+        client_names = await clients.names(v["client_id"] for v in batch)
+        yield "".join(
+            ics_event(
+                f"visit-{visit['_id']}",
+                f"{client_names.get(visit['client_id'], 'Неизвестный')} — {visit.get('topic', 'Визит')}",
+                visit["date"], visit["date"], dtstamp,
+                description=", ".join(visit.get("practices", [])) or None
+            )
+            for visit in batch
+        )
+    
+    yield ics_line("END:VCALENDAR")
+
+@api_router.post("/calendar/feed-token")
+async def create_calendar_feed_token(current_user: dict = Depends(get_current_user)):
+    """Issue a new calendar feed token, revoking the previous one"""
+    token = secrets.token_urlsafe(32)
+    await db.users.update_one({"email": current_user["email"]}, {"$set": {"calendar_feed_token": token}})
+    return {"token": token, "url": f"/api/calendar/feed.ics?token={token}"}
+
+@api_router.delete("/calendar/feed-token")
+async def revoke_calendar_feed_token(current_user: dict = Depends(get_current_user)):
+    """Revoke the calendar feed token"""
+    await db.users.update_one({"email": current_user["email"]}, {"$unset": {"calendar_feed_token": ""}})
+    return {"message": "Calendar feed token revoked"}
+
+@api_router.get("/calendar/feed.ics")
+async def get_calendar_feed(request: Request, token: str, days_back: int = 60, days_ahead: int = 180):
+    """iCalendar feed of visits and retreats for a window around today.
+    
+    Calendar apps cannot send bearer headers, so the feed authenticates by its own token.
+    """
+    if days_back < 0 or days_ahead < 0 or days_back + days_ahead > FEED_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"Feed window must be within {FEED_MAX_DAYS} days")
+    if not await db.users.find_one({"calendar_feed_token": token}, {"_id": 1}):
+        raise HTTPException(status_code=401, detail="Invalid calendar feed token")
+    
+    today = datetime.now(timezone.utc)
+    date_from = (today - timedelta(days=days_back)).strftime("%Y-%m-%d")
+    date_to = (today + timedelta(days=days_ahead)).strftime("%Y-%m-%d")
+    
+    # Validators come from data versions, so a poll that changes nothing renders nothing
+    changed_at = last_changed_at(FEED_COLLECTIONS)
+    version = [data_versions[c] for c in FEED_COLLECTIONS]
+    etag = body_etag({"from": date_from, "to": date_to, "versions": version, "changed_at": changed_at})
+    # The window moves at midnight, so the feed is never older than today
+    last_modified = max(changed_at, today.replace(hour=0, minute=0, second=0, microsecond=0))
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "private, max-age=300"
+    }
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    
+    dtstamp = changed_at.strftime("%Y%m%dT%H%M%SZ")
+    media_type = "text/calendar; charset=utf-8"
+    if days_back + days_ahead > FEED_CACHE_MAX_DAYS:
+        async def stream():
+            async for chunk in render_calendar_feed(date_from, date_to, dtstamp):
+                yield chunk.encode("utf-8")
+        return StreamingResponse(stream(), media_type=media_type, headers=headers)
+    
+    async def compute():
+        return "".join([chunk async for chunk in render_calendar_feed(date_from, date_to, dtstamp)]).encode("utf-8")
+    
+    body = await feed_cache.get_or_compute(
+        "calendar-feed", FEED_COLLECTIONS, {"date_from": date_from, "date_to": date_to, "today": today_iso()}, compute
+    )
+    return Response(content=body, media_type=media_type, headers=headers)
 
 # ==================== RETREAT ROUTES ====================
 
 DEFAULT_RETREAT_PRICE = 30000  # Default price per participant
 
+def retreats_overlapping(range_start, range_end):
+    """Retreats sharing at least one day with [range_start, range_end] (dates as YYYY-MM-DD).
+    
+    Bounded by the (end_date, start_date) index: ranges near the present only
+    walk the retreats that have not ended before them.
+    """
+    return {"end_date": {"$gte": range_start}, "start_date": {"$lte": range_end}}
+
+def retreats_starting(range_start, range_end):
+    """Retreats starting within [range_start, range_end]: the money of a retreat belongs to
+    the period it starts in, so one running across New Year is counted in one year only"""
+    return {"start_date": {"$gte": range_start, "$lte": range_end}}
+
+# Totals kept on each retreat document and maintained with $inc by the participant and
+# expense routes, so lists and statistics never sum participants or expenses
+RETREAT_TOTAL_FIELDS = ["total_participants", "total_revenue", "total_expenses", "net_profit"]
+
+def retreat_totals(retreat):
+    """Compute the stored totals of a retreat from its embedded participants and expenses"""
+    participants = retreat.get("participants") or []
+    revenue = sum(p.get("payment", 0) for p in participants)
+    expenses = sum(e.get("amount", 0) for e in retreat.get("expenses") or [])
+    return {
+        "total_participants": len(participants),
+        "total_revenue": revenue,
+        "total_expenses": expenses,
+        "net_profit": revenue - expenses
+    }
+
+def retreat_totals_increment(participants=0, revenue=0, expenses=0):
+    return {
+        "total_participants": participants,
+        "total_revenue": revenue,
+        "total_expenses": expenses,
+        "net_profit": revenue - expenses
+    }
+
+async def repair_retreat_totals():
+    """Recompute the stored totals of every retreat from its participants and expenses.
+    
+    A participant or expense change between the sums and the $set would be overwritten,
+    so run it only while retreats are not being edited.
+    """
+    participant_totals = {
+        row["_id"]: row async for row in db.retreat_participants.aggregate([
+            {"$group": {"_id": "$retreat_id", "count": {"$sum": 1}, "revenue": {"$sum": "$payment"}}}
+        ])
+    }
+    
+    operations = []
+    # Participants not yet moved out by migration 0005 still count
+    async for retreat in db.retreats.find({}, {"participants.payment": 1, "expenses.amount": 1}):
+        stored = participant_totals.get(str(retreat["_id"]), {})
+        embedded = retreat_totals(retreat)
+        operations.append(UpdateOne({"_id": retreat["_id"]}, {"$set": retreat_totals_increment(
+            participants=stored.get("count", 0) + embedded["total_participants"],
+            revenue=stored.get("revenue", 0) + embedded["total_revenue"],
+            expenses=embedded["total_expenses"]
+        )}))
+    if operations:
+        await db.retreats.bulk_write(operations, ordered=False)
+    bump_data_version("retreats")
+    logger.info(f"Repaired totals of {len(operations)} retreats")
+    return len(operations)
+
+async def update_retreat_entry(retreat, array, key, value, build_update, attempts=3):
+    """Update one embedded entry (an expense) guarded on the entry as it was read.
+    
+    build_update(entry) returns the update including its $inc of the totals; if the entry
+    changed in between, the retreat is re-read and the update rebuilt. Returns the entry
+    as it was before the update, or None when there is no such entry.
+    """
+    for _ in range(attempts):
+        entry = next((e for e in retreat.get(array) or [] if e.get(key) == value), None)
+        if entry is None:
+            return None
+        result = await db.retreats.update_one(
+            {"_id": retreat["_id"], array: {"$elemMatch": entry}}, build_update(entry)
+        )
+        if result.matched_count:
+            return entry
+        retreat = await db.retreats.find_one({"_id": retreat["_id"]}, {array: 1})
+        if not retreat:
+            return None
+    raise HTTPException(status_code=409, detail="Retreat was changed concurrently, please retry")
+
+def with_default_payment(participant):
+    """Fill in the configured default retreat price when no payment was given"""
+    if participant.payment is not None:
+        return participant
+    return participant.model_copy(update={"payment": default_retreat_price()})
+
+def participant_doc(retreat_id, participant):
+    """A db.retreat_participants document, keyed by (retreat_id, client_id)"""
+    return {
+        "retreat_id": retreat_id,
+        "client_id": participant.client_id,
+        "payment": participant.payment,
+        "payment_status": participant.payment_status,
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
+    }
+
+async def move_embedded_participants(retreats, context):
+    """Copy embedded participants into db.retreat_participants, then drop the arrays"""
+    operations = []
+    for retreat in retreats:
+        for p in retreat.get("participants") or []:
+            operations.append(UpdateOne(
+                {"retreat_id": str(retreat["_id"]), "client_id": p["client_id"]},
+                {"$setOnInsert": {
+                    "payment": p.get("payment", default_retreat_price()),
+                    "payment_status": p.get("payment_status", "not_paid"),
+                    "created_at": retreat.get("created_at") or datetime.now(timezone.utc),
+                    "updated_at": datetime.now(timezone.utc)
+                }},
+                upsert=True
+            ))
+    if operations:
+        await db.retreat_participants.bulk_write(operations, ordered=False)
+    await db.retreats.update_many({"_id": {"$in": [r["_id"] for r in retreats]}}, {"$unset": {"participants": ""}})
+
 class RetreatParticipant(BaseModel):
     client_id: str
-    payment: int = Field(default=DEFAULT_RETREAT_PRICE, ge=0)
+    payment: Optional[int] = Field(None, ge=0)  # The configured default if omitted
     payment_status: str = Field(default="not_paid")  # paid, partial, not_paid
 
+class RetreatParticipantsBulk(BaseModel):
+    participants: List[RetreatParticipant] = Field(..., min_length=1, max_length=500)
+
 class RetreatExpense(BaseModel):
     name: str = Field(..., min_length=1, max_length=200)
     amount: int = Field(..., ge=0)
@@ -958,6 +2583,23 @@ class RetreatUpdate(BaseModel):
     start_date: Optional[str] = None
     end_date: Optional[str] = None
 
+async def aggregate_retreat_totals(query):
+    """Sum the stored head counts, revenue and expenses of matching retreats in MongoDB"""
+    pipeline = [
+        {"$match": query},
+        {"$group": {
+            "_id": None,
+            "retreats": {"$sum": 1},
+            "participants": {"$sum": "$total_participants"},
+            "revenue": {"$sum": "$total_revenue"},
+            "expenses": {"$sum": "$total_expenses"}
+        }}
+    ]
+    result = await db.retreats.aggregate(pipeline).to_list(1)
+    if not result:
+        return {"retreats": 0, "participants": 0, "revenue": 0, "expenses": 0}
+    return result[0]
+
 @api_router.get("/retreats")
 async def get_retreats(
     page: int = 1,
@@ -968,26 +2610,19 @@ async def get_retreats(
     """Get all retreats with pagination"""
     query = {}
     if year:
-        query["start_date"] = {"$gte": f"{year}-01-01", "$lte": f"{year}-12-31"}
+        query = retreats_overlapping(f"{year}-01-01", f"{year}-12-31")
     
     total = await db.retreats.count_documents(query)
     skip = (page - 1) * page_size
     
-    cursor = db.retreats.find(query).sort("start_date", -1).skip(skip).limit(page_size)
+    # The stored totals stand in for the participant and expense arrays
+    cursor = db.retreats.find(query, {"participants": 0, "expenses": 0}).sort("start_date", -1).skip(skip).limit(page_size)
     retreats = await cursor.to_list(length=page_size)
     
-    # Enrich with calculated totals
     enriched_retreats = []
     for retreat in retreats:
         retreat_data = serialize_doc(retreat)
-        participants = retreat.get("participants", [])
-        expenses = retreat.get("expenses", [])
-        
-        retreat_data["total_participants"] = len(participants)
-        retreat_data["total_revenue"] = sum(p.get("payment", 0) for p in participants)
-        retreat_data["total_expenses"] = sum(e.get("amount", 0) for e in expenses)
-        retreat_data["net_profit"] = retreat_data["total_revenue"] - retreat_data["total_expenses"]
-        
+        retreat_data.update({field: retreat.get(field, 0) for field in RETREAT_TOTAL_FIELDS})
         enriched_retreats.append(retreat_data)
     
     return {
@@ -1008,18 +2643,20 @@ async def create_retreat(
         "name": retreat_data.name,
         "start_date": retreat_data.start_date,
         "end_date": retreat_data.end_date,
-        "participants": [],
         "expenses": [],
+        **retreat_totals_increment(),
         "created_at": datetime.now(timezone.utc),
         "updated_at": datetime.now(timezone.utc)
     }
     result = await db.retreats.insert_one(retreat_doc)
     retreat_doc["_id"] = result.inserted_id
-    return serialize_doc(retreat_doc)
+    await track_retreat_write(retreat_doc)
+    return {**serialize_doc(retreat_doc), "participants": []}
 
 @api_router.get("/retreats/{retreat_id}")
 async def get_retreat(
     retreat_id: str,
+    clients: ClientLoader = Depends(get_client_loader),
     current_user: dict = Depends(get_current_user)
 ):
     """Get a single retreat with full details"""
@@ -1034,27 +2671,20 @@ async def get_retreat(
     retreat_data = serialize_doc(retreat)
     
     # Enrich participants with client names
-    enriched_participants = []
-    for p in retreat.get("participants", []):
-        try:
-            client = await db.clients.find_one({"_id": ObjectId(p["client_id"])})
-            participant_data = {
-                "client_id": p["client_id"],
-                "payment": p.get("payment", DEFAULT_RETREAT_PRICE),
-                "payment_status": p.get("payment_status", "not_paid"),
-                "client_name": format_client_name(client) if client else "Неизвестный клиент"
-            }
-            enriched_participants.append(participant_data)
-        except:
-            pass
+    participants = await db.retreat_participants.find({"retreat_id": str(retreat["_id"])}).sort("_id", 1).to_list(length=None)
+    client_names = await clients.names(p["client_id"] for p in participants)
+    enriched_participants = [
+        {
+            "client_id": p["client_id"],
+            "payment": p.get("payment", default_retreat_price()),
+            "payment_status": p.get("payment_status", "not_paid"),
+            "client_name": client_names.get(p["client_id"], "Неизвестный клиент")
+        }
+        for p in participants
+    ]
     
     retreat_data["participants"] = enriched_participants
-    
-    # Calculate totals
-    retreat_data["total_participants"] = len(enriched_participants)
-    retreat_data["total_revenue"] = sum(p.get("payment", 0) for p in enriched_participants)
-    retreat_data["total_expenses"] = sum(e.get("amount", 0) for e in retreat.get("expenses", []))
-    retreat_data["net_profit"] = retreat_data["total_revenue"] - retreat_data["total_expenses"]
+    retreat_data.update({field: retreat.get(field, 0) for field in RETREAT_TOTAL_FIELDS})
     
     return retreat_data
 
@@ -1082,6 +2712,7 @@ async def update_retreat(
     )
     
     updated_retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)})
+    await track_retreat_write(retreat, updated_retreat)
     return serialize_doc(updated_retreat)
 
 @api_router.delete("/retreats/{retreat_id}")
@@ -1099,13 +2730,50 @@ async def delete_retreat(
         raise HTTPException(status_code=404, detail="Retreat not found")
     
     # Delete associated visits
+    visits = await db.visits.find({"retreat_id": retreat_id}, ROLLUP_VISIT_PROJECTION).to_list(length=None)
     await db.visits.delete_many({"retreat_id": retreat_id})
+    await track_visit_changes(removed=visits)
     
-    # Delete the retreat
+    # Delete the retreat and its participants
+    await db.retreat_participants.delete_many({"retreat_id": str(retreat["_id"])})
     await db.retreats.delete_one({"_id": ObjectId(retreat_id)})
+    await track_retreat_write(retreat)
     
     return {"message": "Retreat deleted successfully"}
 
+def retreat_visit_doc(retreat, participant):
+    """Visit record standing for a participant's attendance of a retreat"""
+    return {
+        "client_id": participant.client_id,
+        "date": retreat["start_date"],
+        "topic": f"Ретрит: {retreat['name']}",
+        "practices": [],
+        "practices_mask": 0,
+        "notes": f"Дыхательный ретрит {retreat['start_date']} - {retreat['end_date']}",
+        "price": participant.payment,
+        "tips": 0,
+        "retreat_id": str(retreat["_id"]),
+        "created_at": datetime.now(timezone.utc),
+        "updated_at": datetime.now(timezone.utc)
+    }
+
+async def create_retreat_visits(retreat, participants):
+    """Create the visit of each participant unless it already exists.
+    
+    Upserts on (retreat_id, client_id), which a unique index covers, so a retried or
+    concurrent registration never leaves two visits for one participant.
+    """
+    visit_docs = [retreat_visit_doc(retreat, p) for p in participants]
+    result = await db.visits.bulk_write([
+        UpdateOne({"retreat_id": doc["retreat_id"], "client_id": doc["client_id"]}, {"$setOnInsert": doc}, upsert=True)
+        for doc in visit_docs
+    ], ordered=False)
+    created = []
+    for index, visit_id in result.upserted_ids.items():
+        visit_docs[index]["_id"] = visit_id
+        created.append(visit_docs[index])
+    await track_visit_changes(added=created)
+
 @api_router.post("/retreats/{retreat_id}/participants")
 async def add_retreat_participant(
     retreat_id: str,
@@ -1113,8 +2781,9 @@ async def add_retreat_participant(
     current_user: dict = Depends(get_current_user)
 ):
     """Add a participant to retreat and create a visit record"""
+    participant = with_default_payment(participant)
     try:
-        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)})
+        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)}, {"expenses": 0})
     except:
         raise HTTPException(status_code=400, detail="Invalid retreat ID format")
     
@@ -1123,50 +2792,95 @@ async def add_retreat_participant(
     
     # Verify client exists
     try:
-        client = await db.clients.find_one({"_id": ObjectId(participant.client_id)})
+        client = await db.clients.find_one({"_id": ObjectId(participant.client_id)}, {"_id": 1})
     except:
         raise HTTPException(status_code=400, detail="Invalid client ID format")
     
     if not client:
         raise HTTPException(status_code=404, detail="Client not found")
     
-    # Check if already a participant
-    existing = [p for p in retreat.get("participants", []) if p["client_id"] == participant.client_id]
-    if existing:
+    # Add participant; the unique (retreat_id, client_id) index rejects a duplicate atomically
+    try:
+        await db.retreat_participants.insert_one(participant_doc(str(retreat["_id"]), participant))
+    except DuplicateKeyError:
         raise HTTPException(status_code=400, detail="Client is already a participant")
-    
-    # Add participant
-    participant_doc = {
-        "client_id": participant.client_id,
-        "payment": participant.payment,
-        "payment_status": participant.payment_status
-    }
-    
     await db.retreats.update_one(
-        {"_id": ObjectId(retreat_id)},
+        {"_id": retreat["_id"]},
         {
-            "$push": {"participants": participant_doc},
+            "$inc": retreat_totals_increment(participants=1, revenue=participant.payment),
             "$set": {"updated_at": datetime.now(timezone.utc)}
         }
     )
+    await track_retreat_write(retreat)
     
     # Create a visit record for this participant
-    visit_doc = {
-        "client_id": participant.client_id,
-        "date": retreat["start_date"],
-        "topic": f"Ретрит: {retreat['name']}",
-        "practices": [],
-        "notes": f"Дыхательный ретрит {retreat['start_date']} - {retreat['end_date']}",
-        "price": participant.payment,
-        "tips": 0,
-        "retreat_id": retreat_id,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc)
-    }
-    await db.visits.insert_one(visit_doc)
+    await create_retreat_visits(retreat, [participant])
     
     return {"message": "Participant added successfully"}
 
+@api_router.post("/retreats/{retreat_id}/participants/bulk")
+async def add_retreat_participants_bulk(
+    retreat_id: str,
+    data: RetreatParticipantsBulk,
+    current_user: dict = Depends(get_current_user)
+):
+    """Add many participants to a retreat at once, skipping those already registered"""
+    try:
+        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)}, {"name": 1, "start_date": 1, "end_date": 1})
+    except:
+        raise HTTPException(status_code=400, detail="Invalid retreat ID format")
+    
+    if not retreat:
+        raise HTTPException(status_code=404, detail="Retreat not found")
+    
+    # Verify all clients exist with one query
+    requested = {}
+    for participant in map(with_default_payment, data.participants):
+        if not ObjectId.is_valid(participant.client_id):
+            raise HTTPException(status_code=400, detail=f"Invalid client ID format: {participant.client_id}")
+        requested.setdefault(participant.client_id, participant)  # first entry wins
+    found = await db.clients.distinct("_id", {"_id": {"$in": [ObjectId(cid) for cid in requested]}})
+    missing = set(requested) - {str(oid) for oid in found}
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Clients not found: {', '.join(sorted(missing))}")
+    
+    retreat_key = str(retreat["_id"])
+    existing = set(await db.retreat_participants.distinct(
+        "client_id", {"retreat_id": retreat_key, "client_id": {"$in": list(requested)}}
+    ))
+    new_participants = [p for cid, p in requested.items() if cid not in existing]
+    if new_participants:
+        # The unique (retreat_id, client_id) index turns concurrent registrations into skips
+        try:
+            await db.retreat_participants.insert_many(
+                [participant_doc(retreat_key, p) for p in new_participants], ordered=False
+            )
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            duplicates = {error["index"] for error in errors}
+            existing.update(new_participants[i].client_id for i in duplicates)
+            new_participants = [p for i, p in enumerate(new_participants) if i not in duplicates]
+    skipped = [cid for cid in requested if cid in existing]
+    if not new_participants:
+        return {"message": "No new participants", "added": 0, "skipped": skipped}
+    
+    await db.retreats.update_one(
+        {"_id": retreat["_id"]},
+        {
+            "$inc": retreat_totals_increment(
+                participants=len(new_participants), revenue=sum(p.payment for p in new_participants)
+            ),
+            "$set": {"updated_at": datetime.now(timezone.utc)}
+        }
+    )
+    await track_retreat_write(retreat)
+    
+    await create_retreat_visits(retreat, new_participants)
+    
+    return {"message": "Participants added successfully", "added": len(new_participants), "skipped": skipped}
+
 @api_router.put("/retreats/{retreat_id}/participants/{client_id}")
 async def update_retreat_participant(
     retreat_id: str,
@@ -1175,31 +2889,41 @@ async def update_retreat_participant(
     current_user: dict = Depends(get_current_user)
 ):
     """Update participant payment info"""
+    participant = with_default_payment(participant)
     try:
-        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)})
+        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)}, {"start_date": 1, "end_date": 1})
     except:
         raise HTTPException(status_code=400, detail="Invalid retreat ID format")
     
     if not retreat:
         raise HTTPException(status_code=404, detail="Retreat not found")
     
-    # Update participant in array
-    await db.retreats.update_one(
-        {"_id": ObjectId(retreat_id), "participants.client_id": client_id},
-        {
-            "$set": {
-                "participants.$.payment": participant.payment,
-                "participants.$.payment_status": participant.payment_status,
-                "updated_at": datetime.now(timezone.utc)
-            }
-        }
+    # Update the participant, moving the revenue totals by the payment change
+    old_participant = await db.retreat_participants.find_one_and_update(
+        {"retreat_id": str(retreat["_id"]), "client_id": client_id},
+        {"$set": {
+            "payment": participant.payment,
+            "payment_status": participant.payment_status,
+            "updated_at": datetime.now(timezone.utc)
+        }}
     )
+    if old_participant:
+        await db.retreats.update_one(
+            {"_id": retreat["_id"]},
+            {
+                "$inc": retreat_totals_increment(revenue=participant.payment - old_participant.get("payment", 0)),
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            }
+        )
+    await track_retreat_write(retreat)
     
     # Update the visit record too
-    await db.visits.update_one(
+    old_visit = await db.visits.find_one_and_update(
         {"retreat_id": retreat_id, "client_id": client_id},
         {"$set": {"price": participant.payment, "updated_at": datetime.now(timezone.utc)}}
     )
+    if old_visit:
+        await track_visit_changes(removed=[old_visit], added=[{**old_visit, "price": participant.payment}])
     
     return {"message": "Participant updated successfully"}
 
@@ -1211,26 +2935,60 @@ async def remove_retreat_participant(
 ):
     """Remove a participant from retreat"""
     try:
-        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)})
+        retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)}, {"start_date": 1, "end_date": 1})
     except:
         raise HTTPException(status_code=400, detail="Invalid retreat ID format")
     
     if not retreat:
         raise HTTPException(status_code=404, detail="Retreat not found")
     
-    await db.retreats.update_one(
-        {"_id": ObjectId(retreat_id)},
-        {
-            "$pull": {"participants": {"client_id": client_id}},
-            "$set": {"updated_at": datetime.now(timezone.utc)}
-        }
+    removed_participant = await db.retreat_participants.find_one_and_delete(
+        {"retreat_id": str(retreat["_id"]), "client_id": client_id}
     )
+    if removed_participant:
+        await db.retreats.update_one(
+            {"_id": retreat["_id"]},
+            {
+                "$inc": retreat_totals_increment(participants=-1, revenue=-removed_participant.get("payment", 0)),
+                "$set": {"updated_at": datetime.now(timezone.utc)}
+            }
+        )
+    await track_retreat_write(retreat)
     
     # Remove the visit record
-    await db.visits.delete_one({"retreat_id": retreat_id, "client_id": client_id})
+    removed_visit = await db.visits.find_one_and_delete({"retreat_id": retreat_id, "client_id": client_id})
+    if removed_visit:
+        await track_visit_changes(removed=[removed_visit])
     
     return {"message": "Participant removed successfully"}
 
+@api_router.get("/clients/{client_id}/retreats")
+async def get_client_retreats(
+    client_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the retreats a client attended, newest first"""
+    participations = await db.retreat_participants.find({"client_id": client_id}).to_list(length=None)
+    retreat_oids = [ObjectId(p["retreat_id"]) for p in participations if ObjectId.is_valid(p["retreat_id"])]
+    retreats = {
+        str(r["_id"]): r
+        async for r in db.retreats.find({"_id": {"$in": retreat_oids}}, {"name": 1, "start_date": 1, "end_date": 1})
+    }
+    
+    result = [
+        {
+            "retreat_id": p["retreat_id"],
+            "name": retreats[p["retreat_id"]]["name"],
+            "start_date": retreats[p["retreat_id"]]["start_date"],
+            "end_date": retreats[p["retreat_id"]]["end_date"],
+            "payment": p.get("payment", default_retreat_price()),
+            "payment_status": p.get("payment_status", "not_paid")
+        }
+        for p in participations if p["retreat_id"] in retreats
+    ]
+    result.sort(key=lambda r: r["start_date"], reverse=True)
+    return {"retreats": result}
+
 @api_router.post("/retreats/{retreat_id}/expenses")
 async def add_retreat_expense(
     retreat_id: str,
@@ -1256,9 +3014,11 @@ async def add_retreat_expense(
         {"_id": ObjectId(retreat_id)},
         {
             "$push": {"expenses": expense_doc},
+            "$inc": retreat_totals_increment(expenses=expense.amount),
             "$set": {"updated_at": datetime.now(timezone.utc)}
         }
     )
+    await track_retreat_write(retreat)
     
     return {"message": "Expense added successfully", "expense": expense_doc}
 
@@ -1277,41 +3037,42 @@ async def remove_retreat_expense(
     if not retreat:
         raise HTTPException(status_code=404, detail="Retreat not found")
     
-    await db.retreats.update_one(
-        {"_id": ObjectId(retreat_id)},
-        {
-            "$pull": {"expenses": {"id": expense_id}},
-            "$set": {"updated_at": datetime.now(timezone.utc)}
-        }
-    )
+    await update_retreat_entry(retreat, "expenses", "id", expense_id, lambda entry: {
+        "$pull": {"expenses": {"id": expense_id}},
+        "$inc": retreat_totals_increment(expenses=-entry.get("amount", 0)),
+        "$set": {"updated_at": datetime.now(timezone.utc)}
+    })
+    await track_retreat_write(retreat)
     
     return {"message": "Expense removed successfully"}
 
 @api_router.get("/stats/retreats")
 async def get_retreat_stats(
+    request: Request,
     year: Optional[int] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get retreat statistics"""
-    now = datetime.now(timezone.utc)
-    target_year = year or now.year
-    
-    query = {"start_date": {"$gte": f"{target_year}-01-01", "$lte": f"{target_year}-12-31"}}
-    
-    retreats = await db.retreats.find(query).to_list(length=100)
-    
-    total_retreats = len(retreats)
-    total_participants = 0
-    total_revenue = 0
-    total_expenses = 0
+    target_year = year or datetime.now(timezone.utc).year
+    if is_closed_year(target_year):
+        return await serve_year_snapshot(
+            request, "retreat-stats", target_year, {}, lambda: compute_retreat_stats(target_year), source="retreats"
+        )
+    return await cached_retreat_stats(target_year)
+
+async def cached_retreat_stats(target_year: int):
+    return await stats_cache.get_or_compute(
+        "retreats", ("retreats",), {"year": target_year},
+        lambda: compute_retreat_stats(target_year)
+    )
+
+async def compute_retreat_stats(target_year: int):
+    totals = await aggregate_retreat_totals(retreats_starting(f"{target_year}-01-01", f"{target_year}-12-31"))
     
-    for retreat in retreats:
-        participants = retreat.get("participants", [])
-        expenses = retreat.get("expenses", [])
-        
-        total_participants += len(participants)
-        total_revenue += sum(p.get("payment", 0) for p in participants)
-        total_expenses += sum(e.get("amount", 0) for e in expenses)
+    total_retreats = totals["retreats"]
+    total_participants = totals["participants"]
+    total_revenue = totals["revenue"]
+    total_expenses = totals["expenses"]
     
     avg_participants = total_participants / total_retreats if total_retreats > 0 else 0
     
@@ -1342,22 +3103,38 @@ class BackupData(BaseModel):
     retreats: List[dict]
     settings: Optional[dict] = None
 
+# Settings are read on every visit and participant write and by the aggregations, so
+# they are kept in this process: loaded at startup and reloaded by update_settings and
+# restore. Like the response cache, this assumes the single-worker deployment.
+settings_cache = {"values": None}
+
+def default_settings():
+    return {
+        "default_visit_price": DEFAULT_PRICE,
+        "default_retreat_price": DEFAULT_RETREAT_PRICE,
+        "practices": AVAILABLE_PRACTICES
+    }
+
+async def load_settings():
+    settings = await db.settings.find_one({"type": "app_settings"}) or {}
+    values = default_settings()
+    values.update({key: settings[key] for key in values if settings.get(key) is not None})
+    settings_cache["values"] = values
+    return values
+
+def current_settings():
+    return settings_cache["values"] or default_settings()
+
+def default_visit_price():
+    return current_settings()["default_visit_price"]
+
+def default_retreat_price():
+    return current_settings()["default_retreat_price"]
+
 @api_router.get("/settings")
 async def get_settings(current_user: dict = Depends(get_current_user)):
     """Get application settings"""
-    settings = await db.settings.find_one({"type": "app_settings"})
-    if not settings:
-        # Return defaults
-        return {
-            "default_visit_price": DEFAULT_PRICE,
-            "default_retreat_price": DEFAULT_RETREAT_PRICE,
-            "practices": AVAILABLE_PRACTICES
-        }
-    return {
-        "default_visit_price": settings.get("default_visit_price", DEFAULT_PRICE),
-        "default_retreat_price": settings.get("default_retreat_price", DEFAULT_RETREAT_PRICE),
-        "practices": settings.get("practices", AVAILABLE_PRACTICES)
-    }
+    return dict(current_settings())
 
 @api_router.put("/settings")
 async def update_settings(
@@ -1368,11 +3145,15 @@ async def update_settings(
     update_doc = {"type": "app_settings", "updated_at": datetime.now(timezone.utc)}
     
     if settings_data.default_visit_price is not None:
+        # Rollups and the engine priced any visit still without a price at the old
+        # default; store that price on it before the default moves
+        await finish_migration("0001_visit_financial_defaults")
         update_doc["default_visit_price"] = settings_data.default_visit_price
     if settings_data.default_retreat_price is not None:
         update_doc["default_retreat_price"] = settings_data.default_retreat_price
     if settings_data.practices is not None:
         update_doc["practices"] = settings_data.practices
+        await get_practice_bits(settings_data.practices)
     
     await db.settings.update_one(
         {"type": "app_settings"},
@@ -1380,6 +3161,7 @@ async def update_settings(
         upsert=True
     )
     
+    await load_settings()
     return await get_settings(current_user)
 
 @api_router.put("/auth/change-password")
@@ -1409,40 +3191,34 @@ async def change_password(
 @api_router.get("/stats/database")
 async def get_database_stats(current_user: dict = Depends(get_current_user)):
     """Get database statistics"""
-    # Counts
-    clients_count = await db.clients.count_documents({})
-    visits_count = await db.visits.count_documents({})
-    retreats_count = await db.retreats.count_documents({})
+    return await cached_database_stats()
+
+async def cached_database_stats():
+    return await stats_cache.get_or_compute(
+        "database", ("clients", "visits", "retreats"), {},
+        compute_database_stats
+    )
+
+async def compute_database_stats():
+    collections = [db.clients, db.visits, db.retreats]
+    
+    # Counts, oldest and latest record of each collection: nine independent queries
+    results = await gather_limited(
+        *(c.count_documents({}) for c in collections),
+        *(c.find_one({}, {"created_at": 1}, sort=[("created_at", 1)]) for c in collections),
+        *(c.find_one({}, {"updated_at": 1}, sort=[("updated_at", -1)]) for c in collections)
+    )
+    clients_count, visits_count, retreats_count = results[0:3]
+    oldest_docs = results[3:6]
+    latest_docs = results[6:9]
     total_records = clients_count + visits_count + retreats_count
     
     # Oldest record
-    oldest_client = await db.clients.find_one({}, sort=[("created_at", 1)])
-    oldest_visit = await db.visits.find_one({}, sort=[("created_at", 1)])
-    oldest_retreat = await db.retreats.find_one({}, sort=[("created_at", 1)])
-    
-    oldest_dates = []
-    if oldest_client and oldest_client.get("created_at"):
-        oldest_dates.append(oldest_client["created_at"])
-    if oldest_visit and oldest_visit.get("created_at"):
-        oldest_dates.append(oldest_visit["created_at"])
-    if oldest_retreat and oldest_retreat.get("created_at"):
-        oldest_dates.append(oldest_retreat["created_at"])
-    
+    oldest_dates = [d["created_at"] for d in oldest_docs if d and d.get("created_at")]
     oldest_record = min(oldest_dates).isoformat() if oldest_dates else None
     
     # Latest update
-    latest_client = await db.clients.find_one({}, sort=[("updated_at", -1)])
-    latest_visit = await db.visits.find_one({}, sort=[("updated_at", -1)])
-    latest_retreat = await db.retreats.find_one({}, sort=[("updated_at", -1)])
-    
-    latest_dates = []
-    if latest_client and latest_client.get("updated_at"):
-        latest_dates.append(latest_client["updated_at"])
-    if latest_visit and latest_visit.get("updated_at"):
-        latest_dates.append(latest_visit["updated_at"])
-    if latest_retreat and latest_retreat.get("updated_at"):
-        latest_dates.append(latest_retreat["updated_at"])
-    
+    latest_dates = [d["updated_at"] for d in latest_docs if d and d.get("updated_at")]
     last_update = max(latest_dates).isoformat() if latest_dates else None
     
     return {
@@ -1463,6 +3239,23 @@ async def download_backup(current_user: dict = Depends(get_current_user)):
     retreats = await db.retreats.find({}).to_list(length=10000)
     settings = await db.settings.find_one({"type": "app_settings"})
     
+    # Backups keep participants embedded in their retreats, as before the separate collection
+    participants = defaultdict(list)
+    async for p in db.retreat_participants.find({}).sort("_id", 1):
+        participants[p["retreat_id"]].append({
+            "client_id": p["client_id"],
+            "payment": p.get("payment", default_retreat_price()),
+            "payment_status": p.get("payment_status", "not_paid")
+        })
+    for retreat in retreats:
+        # Keep any participants still embedded, e.g. when migration 0005 failed midway;
+        # the collection row is the current one for clients found in both
+        merged = {p["client_id"]: p for p in participants.get(str(retreat["_id"]), [])}
+        for p in retreat.get("participants") or []:
+            if p.get("client_id"):
+                merged.setdefault(p["client_id"], p)
+        retreat["participants"] = list(merged.values())
+    
     # Serialize
     backup_data = {
         "version": "1.0",
@@ -1475,86 +3268,77 @@ async def download_backup(current_user: dict = Depends(get_current_user)):
     
     return backup_data
 
+def stored_document(doc):
+    """Turn a backup document back into its stored form: _id from id, datetimes from ISO strings"""
+    doc = dict(doc)
+    if "id" in doc:
+        try:
+            doc["_id"] = ObjectId(doc.pop("id"))
+        except:
+            doc.pop("id", None)
+    # Retreats need their _id before insert, to key their participants
+    doc.setdefault("_id", ObjectId())
+    for field in ("created_at", "updated_at"):
+        if isinstance(doc.get(field), str):
+            try:
+                doc[field] = datetime.fromisoformat(doc[field].replace("Z", "+00:00"))
+            except:
+                doc[field] = datetime.now(timezone.utc)
+    return doc
+
+def check_unique_ids(name, docs):
+    seen = set()
+    for doc in docs:
+        if doc["_id"] in seen:
+            raise HTTPException(status_code=400, detail=f"Некорректная резервная копия: повторяющийся id {doc['_id']} в {name}")
+        seen.add(doc["_id"])
+
 @api_router.post("/restore")
 async def restore_backup(
     backup_data: BackupData,
     current_user: dict = Depends(get_current_user)
 ):
-    """Restore database from backup JSON"""
+    """Restore database from backup JSON.
+    
+    The whole backup is converted and checked before anything is deleted, so a backup
+    that cannot be restored leaves the current data in place.
+    """
+    clients = [stored_document(c) for c in backup_data.clients]
+    retreats = [stored_document(r) for r in backup_data.retreats]
+    # A client attends a retreat once (unique index on visits); keep the first such visit
+    visits = []
+    retreat_visits = set()
+    skipped_visits = 0
+    for visit in map(stored_document, backup_data.visits):
+        if isinstance(visit.get("retreat_id"), str):
+            key = (visit["retreat_id"], visit.get("client_id"))
+            if key in retreat_visits:
+                skipped_visits += 1
+                continue
+            retreat_visits.add(key)
+        visits.append(visit)
+    for name, docs in (("clients", clients), ("visits", visits), ("retreats", retreats)):
+        check_unique_ids(name, docs)
+    
+    # Participants go to their own collection, one per client
+    participants = []
+    try:
+        for retreat in retreats:
+            embedded = {p["client_id"]: p for p in retreat.pop("participants", None) or [] if p.get("client_id")}
+            participants.extend((str(retreat["_id"]), RetreatParticipant(**p)) for p in embedded.values())
+    except (ValidationError, TypeError, AttributeError) as e:
+        raise HTTPException(status_code=400, detail=f"Некорректная резервная копия: участник ретрита: {str(e)}")
+    
     try:
         # Clear existing data
         await db.clients.delete_many({})
         await db.visits.delete_many({})
         await db.retreats.delete_many({})
+        await db.retreat_participants.delete_many({})
+        bump_data_version("clients", "visits", "retreats")
+        await invalidate_year_snapshots()
         
-        restored_counts = {"clients": 0, "visits": 0, "retreats": 0}
-        
-        # Restore clients
-        if backup_data.clients:
-            for client in backup_data.clients:
-                # Convert id back to _id and handle ObjectId
-                if "id" in client:
-                    try:
-                        client["_id"] = ObjectId(client.pop("id"))
-                    except:
-                        client.pop("id", None)
-                # Convert date strings back to datetime
-                if "created_at" in client and isinstance(client["created_at"], str):
-                    try:
-                        client["created_at"] = datetime.fromisoformat(client["created_at"].replace("Z", "+00:00"))
-                    except:
-                        client["created_at"] = datetime.now(timezone.utc)
-                if "updated_at" in client and isinstance(client["updated_at"], str):
-                    try:
-                        client["updated_at"] = datetime.fromisoformat(client["updated_at"].replace("Z", "+00:00"))
-                    except:
-                        client["updated_at"] = datetime.now(timezone.utc)
-                await db.clients.insert_one(client)
-                restored_counts["clients"] += 1
-        
-        # Restore visits
-        if backup_data.visits:
-            for visit in backup_data.visits:
-                if "id" in visit:
-                    try:
-                        visit["_id"] = ObjectId(visit.pop("id"))
-                    except:
-                        visit.pop("id", None)
-                if "created_at" in visit and isinstance(visit["created_at"], str):
-                    try:
-                        visit["created_at"] = datetime.fromisoformat(visit["created_at"].replace("Z", "+00:00"))
-                    except:
-                        visit["created_at"] = datetime.now(timezone.utc)
-                if "updated_at" in visit and isinstance(visit["updated_at"], str):
-                    try:
-                        visit["updated_at"] = datetime.fromisoformat(visit["updated_at"].replace("Z", "+00:00"))
-                    except:
-                        visit["updated_at"] = datetime.now(timezone.utc)
-                await db.visits.insert_one(visit)
-                restored_counts["visits"] += 1
-        
-        # Restore retreats
-        if backup_data.retreats:
-            for retreat in backup_data.retreats:
-                if "id" in retreat:
-                    try:
-                        retreat["_id"] = ObjectId(retreat.pop("id"))
-                    except:
-                        retreat.pop("id", None)
-                if "created_at" in retreat and isinstance(retreat["created_at"], str):
-                    try:
-                        retreat["created_at"] = datetime.fromisoformat(retreat["created_at"].replace("Z", "+00:00"))
-                    except:
-                        retreat["created_at"] = datetime.now(timezone.utc)
-                if "updated_at" in retreat and isinstance(retreat["updated_at"], str):
-                    try:
-                        retreat["updated_at"] = datetime.fromisoformat(retreat["updated_at"].replace("Z", "+00:00"))
-                    except:
-                        retreat["updated_at"] = datetime.now(timezone.utc)
-                await db.retreats.insert_one(retreat)
-                restored_counts["retreats"] += 1
-        
-        # Restore settings
+        # Restore settings first: missing prices below take the restored defaults
         if backup_data.settings:
             settings = backup_data.settings
             if "id" in settings:
@@ -1565,20 +3349,403 @@ async def restore_backup(
                 {"$set": settings},
                 upsert=True
             )
+        await load_settings()
+        
+        for visit in visits:
+            visit.update(visit_financial_defaults(visit, None))
+        participant_docs = [participant_doc(retreat_id, with_default_payment(p)) for retreat_id, p in participants]
+        for collection, docs in ((db.clients, clients), (db.visits, visits), (db.retreats, retreats),
+                                 (db.retreat_participants, participant_docs)):
+            if docs:
+                await collection.insert_many(docs)
+        restored_counts = {"clients": len(clients), "visits": len(visits), "retreats": len(retreats)}
+        
+        # Derived collections are rebuilt from the restored visits
+        await load_practice_bits()
+        await backfill_practice_masks(recompute=True)
+        await rebuild_daily_rollups()
+        await rebuild_topic_dictionary()
+        await repair_retreat_totals()
+        await analytics_engine.load()
+        bump_data_version("clients", "visits", "retreats")
         
         return {
             "message": "Данные успешно восстановлены",
-            "restored": restored_counts
+            "restored": restored_counts,
+            "skipped_duplicate_retreat_visits": skipped_visits
         }
     except Exception as e:
         logger.error(f"Restore failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Ошибка восстановления: {str(e)}")
 
+# ==================== MIGRATIONS ====================
+
+# Data migrations are applied in order and recorded in db.schema_migrations. Each one
+# walks its matching documents in _id order in small batches, saving its position after
+# every batch, so it can run in the background, pause between batches and resume after
+# a restart. The scheduler's leader runs a bounded number of batches per tick.
+MIGRATION_BATCH_SIZE = int(os.environ.get('MIGRATION_BATCH_SIZE', '500'))
+MIGRATION_BATCH_PAUSE = float(os.environ.get('MIGRATION_BATCH_PAUSE', '0.2'))
+MIGRATION_BATCHES_PER_RUN = int(os.environ.get('MIGRATION_BATCHES_PER_RUN', '50'))
+# How often a worker waiting on another worker's startup migration checks for it
+MIGRATION_WAIT_SECONDS = 1
+
+class Migration:
+    def __init__(self, id, description, collection, query, transform=None, prepare=None, apply_batch=None):
+        self.id = id
+        self.description = description
+        self.collection = collection
+        self.query = query
+        # transform(doc, context) -> fields to $set; prepare() -> context, once per run;
+        # apply_batch(docs, context) replaces transform for migrations that move data elsewhere
+        self.transform = transform
+        self.prepare = prepare
+        self.apply_batch = apply_batch
+
+def visit_financial_defaults(visit, context):
+    fields = {}
+    if visit.get("price") is None:
+        fields["price"] = default_visit_price()
+    if visit.get("tips") is None:
+        fields["tips"] = 0
+    return fields
+
+async def pending_practice_bits():
+    return await get_practice_bits(await db.visits.distinct("practices", {"practices_mask": {"$exists": False}}))
+
+MIGRATIONS = [
+    Migration(
+        "0001_visit_financial_defaults",
+        "Store the default price and zero tips on visits created before financial tracking",
+        "visits",
+        {"$or": [{"price": None}, {"tips": None}]},
+        visit_financial_defaults
+    ),
+    Migration(
+        "0002_visit_retreat_id",
+        "Store an explicit null retreat_id on personal visits",
+        "visits",
+        {"retreat_id": {"$exists": False}},
+        lambda visit, context: {"retreat_id": None}
+    ),
+    Migration(
+        "0003_visit_practices_mask",
+        "Backfill practices_mask from the practices array",
+        "visits",
+        {"practices_mask": {"$exists": False}},
+        lambda visit, context: {"practices_mask": practices_mask(visit.get("practices"), context)},
+        prepare=pending_practice_bits
+    ),
+    Migration(
+        "0004_retreat_totals",
+        "Store participant, revenue and expense totals on retreats",
+        "retreats",
+        {"total_revenue": {"$exists": False}},
+        lambda retreat, context: retreat_totals(retreat)
+    ),
+    Migration(
+        "0005_retreat_participants_collection",
+        "Move embedded retreat participants into the retreat_participants collection",
+        "retreats",
+        {"participants": {"$exists": True}},
+        apply_batch=move_embedded_participants
+    ),
+]
+
+completed_migrations = set()
+
+async def migration_done(migration_id):
+    """Whether a migration has finished; remembered once true, as migrations never undo"""
+    if migration_id not in completed_migrations:
+        state = await db.schema_migrations.find_one({"_id": migration_id}, {"status": 1})
+        if not state or state["status"] != "done":
+            return False
+        completed_migrations.add(migration_id)
+    return True
+
+async def run_migration(migration, max_batches):
+    """Apply up to max_batches batches of one migration; returns the batches used"""
+    collection = db[migration.collection]
+    state = await db.schema_migrations.find_one({"_id": migration.id})
+    if state and state["status"] == "done":
+        return 0
+    if not state:
+        state = {
+            "_id": migration.id,
+            "description": migration.description,
+            "status": "running",
+            "last_id": None,
+            "processed": 0,
+            "total": await collection.count_documents(migration.query),
+            "started_at": datetime.now(timezone.utc),
+            "finished_at": None,
+            "error": None
+        }
+        # Workers starting together may both get here; the first upsert wins
+        await db.schema_migrations.update_one(
+            {"_id": migration.id},
+            {"$setOnInsert": {k: v for k, v in state.items() if k != "_id"}},
+            upsert=True
+        )
+        state = await db.schema_migrations.find_one({"_id": migration.id})
+    
+    context = await migration.prepare() if migration.prepare else None
+    batches = 0
+    try:
+        while batches < max_batches:
+            query = dict(migration.query)
+            if state["last_id"] is not None:
+                query["_id"] = {"$gt": state["last_id"]}
+            docs = await collection.find(query).sort("_id", 1).limit(MIGRATION_BATCH_SIZE).to_list(MIGRATION_BATCH_SIZE)
+            if not docs:
+                state.update(status="done", finished_at=datetime.now(timezone.utc), error=None)
+                await db.schema_migrations.replace_one({"_id": migration.id}, state)
+                logger.info(f"Migration {migration.id} done ({state['processed']} documents)")
+                break
+            
+            if migration.apply_batch:
+                await migration.apply_batch(docs, context)
+            else:
+                operations = []
+                for doc in docs:
+                    fields = migration.transform(doc, context)
+                    if fields:
+                        operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": fields}))
+                if operations:
+                    await collection.bulk_write(operations, ordered=False)
+            state.update(status="running", last_id=docs[-1]["_id"], processed=state["processed"] + len(docs), error=None)
+            await db.schema_migrations.replace_one({"_id": migration.id}, state)
+            batches += 1
+            await asyncio.sleep(MIGRATION_BATCH_PAUSE)
+    except Exception as e:
+        state.update(status="failed", error=str(e))
+        await db.schema_migrations.replace_one({"_id": migration.id}, state)
+        raise
+    return batches
+
+async def finish_migration(migration_id):
+    """Run one migration to completion now, ahead of its turn in the background queue.
+    
+    Batches run only on the worker holding the scheduler lease; the others wait for it.
+    """
+    migration = next(m for m in MIGRATIONS if m.id == migration_id)
+    while not await migration_done(migration_id):
+        if await scheduler.acquire_leadership():
+            await run_migration(migration, MIGRATION_BATCHES_PER_RUN)
+        else:
+            await asyncio.sleep(MIGRATION_WAIT_SECONDS)
+
+async def run_pending_migrations(max_batches=MIGRATION_BATCHES_PER_RUN):
+    """Advance pending migrations in order within a batch budget"""
+    for migration in MIGRATIONS:
+        max_batches -= await run_migration(migration, max_batches)
+        state = await db.schema_migrations.find_one({"_id": migration.id}, {"status": 1})
+        if max_batches <= 0 or state["status"] != "done":
+            return False
+    return True
+
+async def run_all_migrations():
+    """Apply every pending migration to completion"""
+    while not await run_pending_migrations():
+        pass
+    return [m.id for m in MIGRATIONS]
+
+@api_router.get("/admin/migrations")
+async def get_migration_status(current_user: dict = Depends(get_current_user)):
+    """Get applied migrations and backfill progress"""
+    states = {s["_id"]: s for s in await db.schema_migrations.find().to_list(length=None)}
+    migrations = []
+    for migration in MIGRATIONS:
+        state = states.get(migration.id, {})
+        total = state.get("total")
+        processed = state.get("processed", 0)
+        migrations.append({
+            "id": migration.id,
+            "description": migration.description,
+            "status": state.get("status", "pending"),
+            "processed": processed,
+            "total": total,
+            "progress": round(min(processed / total, 1), 4) if total else (1 if state.get("status") == "done" else 0),
+            "started_at": state["started_at"].isoformat() if state.get("started_at") else None,
+            "finished_at": state["finished_at"].isoformat() if state.get("finished_at") else None,
+            "error": state.get("error")
+        })
+    schema_version = 0
+    for m in migrations:
+        if m["status"] != "done":
+            break
+        schema_version += 1
+    return {"schema_version": schema_version, "latest_version": len(MIGRATIONS), "migrations": migrations}
+
+# ==================== SCHEDULER ====================
+
+# Periodic jobs run inside the app. Jobs that maintain shared data run only on the
+# worker holding the leader lease in MongoDB; jobs that warm or prune this process's
+# memory run on every worker. SCHEDULER_<JOB>_INTERVAL (seconds, 0 disables) overrides
+# a job's default interval, e.g. SCHEDULER_WARM_STATISTICS_INTERVAL=300.
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_TICK_SECONDS = 15
+SCHEDULER_LEASE_SECONDS = 60
+
+class ScheduledJob:
+    def __init__(self, name, interval, func, leader_only=False, run_at_start=True):
+        env_name = f"SCHEDULER_{name.upper().replace('-', '_')}_INTERVAL"
+        self.name = name
+        self.interval = int(os.environ.get(env_name, interval))
+        self.func = func
+        self.leader_only = leader_only
+        self.next_run = datetime.now(timezone.utc) if run_at_start else datetime.now(timezone.utc) + timedelta(seconds=self.interval)
+        self.runs = 0
+        self.failures = 0
+        self.running = False
+        self.last_started = None
+        self.last_duration = None
+        self.last_error = None
+    
+    def status(self):
+        return {
+            "name": self.name,
+            "interval_seconds": self.interval,
+            "leader_only": self.leader_only,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "last_started": self.last_started.isoformat() if self.last_started else None,
+            "last_duration_seconds": self.last_duration,
+            "last_error": self.last_error,
+            "next_run": self.next_run.isoformat() if self.interval > 0 else None
+        }
+
+class Scheduler:
+    """Async job loop with a single-leader lease stored in db.scheduler_locks"""
+    
+    def __init__(self):
+        self.jobs = {}
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{ObjectId()}"
+        self.is_leader = False
+        self.task = None
+    
+    def add_job(self, name, interval, func, leader_only=False, run_at_start=True):
+        self.jobs[name] = ScheduledJob(name, interval, func, leader_only, run_at_start)
+    
+    async def acquire_leadership(self):
+        """Take or renew the leader lease; returns whether this worker holds it"""
+        now = datetime.now(timezone.utc)
+        try:
+            await db.scheduler_locks.update_one(
+                {"_id": "scheduler", "$or": [{"holder": self.worker_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"holder": self.worker_id, "expires_at": now + timedelta(seconds=SCHEDULER_LEASE_SECONDS)}},
+                upsert=True
+            )
+            self.is_leader = True
+        except DuplicateKeyError:
+            # Another worker holds an unexpired lease, so the upsert collided with it
+            self.is_leader = False
+        return self.is_leader
+    
+    async def run_job(self, job):
+        job.running = True
+        job.last_started = datetime.now(timezone.utc)
+        try:
+            await job.func()
+            job.last_error = None
+        except Exception as e:
+            job.failures += 1
+            job.last_error = str(e)
+            logger.error(f"Scheduled job {job.name} failed: {str(e)}")
+        finally:
+            job.running = False
+            job.runs += 1
+            job.last_duration = round((datetime.now(timezone.utc) - job.last_started).total_seconds(), 3)
+            job.next_run = job.last_started + timedelta(seconds=job.interval)
+    
+    async def loop(self):
+        while True:
+            try:
+                now = datetime.now(timezone.utc)
+                due = [j for j in self.jobs.values() if j.interval > 0 and j.next_run <= now]
+                # Renew every tick so the lease never lapses while this worker leads
+                await self.acquire_leadership()
+                for job in due:
+                    if job.leader_only and not self.is_leader:
+                        job.next_run = now + timedelta(seconds=job.interval)
+                        continue
+                    await self.run_job(job)
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {str(e)}")
+            await asyncio.sleep(SCHEDULER_TICK_SECONDS)
+    
+    def start(self):
+        if SCHEDULER_ENABLED and self.task is None:
+            self.task = asyncio.create_task(self.loop())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.is_leader:
+            await db.scheduler_locks.delete_one({"_id": "scheduler", "holder": self.worker_id})
+            self.is_leader = False
+    
+    def status(self):
+        return {
+            "enabled": SCHEDULER_ENABLED,
+            "worker_id": self.worker_id,
+            "is_leader": self.is_leader,
+            "jobs": [job.status() for job in self.jobs.values()]
+        }
+
+async def warm_statistics():
+    """Precompute the dashboard and current-year statistics into this worker's cache"""
+    year = datetime.now(timezone.utc).year
+    await cached_stats_overview()
+    await cached_topics_stats()
+    await cached_yearly_summary(year)
+    await cached_retreat_stats(year)
+    await cached_database_stats()
+
+async def prune_caches():
+    pruned = stats_cache.prune() + feed_cache.prune()
+    if pruned:
+        logger.info(f"Pruned {pruned} stale statistics cache entries")
+
+scheduler = Scheduler()
+scheduler.add_job("warm-statistics", 600, warm_statistics)
+scheduler.add_job("prune-caches", 900, prune_caches, run_at_start=False)
+scheduler.add_job("run-migrations", 30, run_pending_migrations, leader_only=True)
+
+@api_router.get("/admin/scheduler")
+async def get_scheduler_status(current_user: dict = Depends(get_current_user)):
+    """Get scheduled job run times and durations"""
+    return scheduler.status()
+
 # Health check
 @api_router.get("/health")
 async def health_check():
     return {"status": "healthy"}
 
+READINESS_TIMEOUT = float(os.environ.get('READINESS_TIMEOUT', '2'))
+
+@api_router.get("/health/ready")
+async def readiness_check():
+    """Ping MongoDB and report round-trip latency and connection pool utilisation"""
+    pool = {
+        "open": pool_monitor.open,
+        "in_use": pool_monitor.in_use,
+        "max_size": MONGO_MAX_POOL_SIZE,
+        "utilisation": round(pool_monitor.in_use / MONGO_MAX_POOL_SIZE, 4) if MONGO_MAX_POOL_SIZE else None
+    }
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(db.command("ping"), READINESS_TIMEOUT)
+    except Exception as e:
+        return JSONResponse(
+            {"status": "unavailable", "mongo": {"error": str(e) or type(e).__name__, "pool": pool}},
+            status_code=503
+        )
+    latency = (time.perf_counter() - started) * 1000
+    return {"status": "ready", "mongo": {"latency_ms": round(latency, 2), "pool": pool}}
+
 # Include router
 app.include_router(api_router)
 
@@ -1590,8 +3757,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Strong references to fire-and-forget tasks started by the app
+background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def warm_up_connection_pool():
+    """Open MONGO_MIN_POOL_SIZE connections now, so first requests skip the handshakes"""
+    started = time.perf_counter()
+    await asyncio.gather(*(db.command("ping") for _ in range(max(MONGO_MIN_POOL_SIZE, 1))))
+    logger.info(
+        f"MongoDB pool warmed up: {pool_monitor.open} connections "
+        f"in {(time.perf_counter() - started) * 1000:.0f} ms"
+    )
+
 @app.on_event("startup")
 async def startup_db_client():
+    await warm_up_connection_pool()
+    
     # Create indexes
     await db.clients.create_index([("last_name", 1), ("first_name", 1)])
     await db.clients.create_index([("first_name", 1)])
@@ -1599,10 +3786,84 @@ async def startup_db_client():
     await db.visits.create_index([("topic", 1)])
     await db.visits.create_index([("date", 1)])
     await db.visits.create_index([("retreat_id", 1)])
+    try:
+        await db.visits.create_index(
+            [("retreat_id", 1), ("client_id", 1)],
+            unique=True,
+            partialFilterExpression={"retreat_id": {"$type": "string"}}
+        )
+    except OperationFailure as e:
+        # Duplicates from before the index have to be cleaned up by hand first
+        logger.warning(f"Unique retreat visit index not created: {e}")
+    await db.visits.create_index([("practices_mask", 1)])
+    await db.visits.create_index([("updated_at", 1)])
+    await db.retreats.create_index([("updated_at", 1)])
+    await db.year_snapshots.create_index([("year", 1), ("kind", 1)])
+    await db.year_snapshots.create_index([("client_id", 1)])
     await db.retreats.create_index([("start_date", -1)])
+    await db.retreats.create_index([("end_date", 1), ("start_date", 1)])
+    await db.retreat_participants.create_index([("retreat_id", 1), ("client_id", 1)], unique=True)
+    await db.retreat_participants.create_index([("client_id", 1)])
     await db.users.create_index([("email", 1)], unique=True)
+    await db.users.create_index([("calendar_feed_token", 1)], unique=True, sparse=True)
+    await create_topic_indexes()
     logger.info("Database indexes created")
+    
+    # Known practices get their bits before visits are backfilled
+    await load_settings()
+    await get_practice_bits(current_settings()["practices"])
+    
+    # Rollups and the engine price visits at their stored price, so every visit has to
+    # carry one before they are built; otherwise a later change of the default would
+    # leave the rollups out of step with the visits
+    await finish_migration("0001_visit_financial_defaults")
+    
+    # First start after upgrade: derive rollups from the existing visits
+    if await db.visit_daily_rollups.estimated_document_count() == 0 and await db.visits.estimated_document_count() > 0:
+        await rebuild_daily_rollups()
+    if await db.topics.estimated_document_count() == 0 and await db.visits.estimated_document_count() > 0:
+        await rebuild_topic_dictionary()
+    
+    # Participant and expense routes $inc the stored retreat totals, so every retreat has
+    # to carry them before the first request is served
+    await finish_migration("0004_retreat_totals")
+    # The participant routes only know db.retreat_participants, so embedded arrays have
+    # to be moved out first (after 0004, which totals them)
+    await finish_migration("0005_retreat_participants_collection")
+    
+    # Statistics use MongoDB until the in-memory columns finish loading
+    run_in_background(analytics_engine.load())
+    scheduler.start()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await scheduler.stop()
     client.close()
+
+# ==================== MAINTENANCE COMMANDS ====================
+
+MAINTENANCE_COMMANDS = {
+    "rebuild-rollups": rebuild_daily_rollups,
+    "backfill-practice-masks": backfill_practice_masks,
+    "rebuild-topics": rebuild_topic_dictionary,
+    "repair-retreat-totals": repair_retreat_totals,
+    "migrate": run_all_migrations,
+}
+
+async def run_maintenance_command(name):
+    """Run a maintenance command against the stored settings, as the server would.
+    
+    Only the database changes: a running server keeps its settings, practice bits,
+    prefix index and in-memory statistics until restarted. Prefer the admin endpoints
+    (/api/admin/rollups/rebuild, /api/admin/topics/rebuild) while the server is up.
+    """
+    await load_settings()
+    return await MAINTENANCE_COMMANDS[name]()
+
+if __name__ == "__main__":
+    # Usage: python server.py <command>
+    if len(sys.argv) != 2 or sys.argv[1] not in MAINTENANCE_COMMANDS:
+        print(f"Usage: python server.py [{'|'.join(MAINTENANCE_COMMANDS)}]")
+        sys.exit(1)
+    result = asyncio.run(run_maintenance_command(sys.argv[1]))
+    print(f"{sys.argv[1]}: {result}")
@@ -25,7 +25,7 @@ git reset --hard origin/main
 echo "Updating backend..."
 cd "$APP_DIR/backend"
 source venv/bin/activate
-pip install fastapi uvicorn pymongo bcrypt python-jose passlib python-multipart -q
+pip install fastapi uvicorn pymongo bcrypt python-jose passlib python-multipart numpy -q
 
 # Build frontend
 echo "Building frontend..."
@@ -68,12 +68,20 @@ export default function CalendarPage() {
         endDate = currentDate.format('YYYY-MM-DD');
       }
 
-      const response = await calendarApi.getEvents({
-        start_date: startDate,
-        end_date: endDate,
-        event_type: eventFilter === 'all' ? undefined : eventFilter
-      });
-      setEvents(response.data.events);
+      // The API pages long ranges; follow next_cursor until the whole window is loaded
+      const allEvents = [];
+      let cursor;
+      do {
+        const response = await calendarApi.getEvents({
+          start_date: startDate,
+          end_date: endDate,
+          event_type: eventFilter === 'all' ? undefined : eventFilter,
+          cursor
+        });
+        allEvents.push(...response.data.events);
+        cursor = response.data.has_more ? response.data.next_cursor : undefined;
+      } while (cursor);
+      setEvents(allEvents);
     } catch (err) {
       toast.error('Не удалось загрузить события');
     } finally {
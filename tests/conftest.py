@@ -0,0 +1,78 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from bson import ObjectId
+from starlette.requests import Request
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("SCHEDULER_ENABLED", "false")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+from mongomock_motor import AsyncCommandCursor, AsyncCursor, AsyncLatentCommandCursor, AsyncMongoMockClient  # noqa: E402
+
+
+async def to_list(self, length=None):
+    """Cursor.to_list as motor has it: at most `length` documents, the rest left for later calls"""
+    docs = []
+    async for doc in self:
+        docs.append(doc)
+        if length is not None and len(docs) >= length:
+            break
+    return docs
+
+
+# mongomock-motor returns every document whatever the length
+AsyncCursor.to_list = to_list
+AsyncCommandCursor.to_list = to_list
+AsyncLatentCommandCursor.to_list = to_list
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Point the server at a fresh in-memory database and reset process-wide state"""
+    mock_db = AsyncMongoMockClient()["kinesio_crm_test"]
+    monkeypatch.setattr(server, "db", mock_db)
+    monkeypatch.setattr(server, "analytics_engine", server.VisitAnalytics())
+    monkeypatch.setattr(server, "data_versions", server.Counter())
+    monkeypatch.setattr(server, "data_changed_at", {})
+    monkeypatch.setitem(server.settings_cache, "values", None)
+    monkeypatch.setitem(server.practice_bit_cache, "order", None)
+    monkeypatch.setitem(server.prefix_index_cache, "version", None)
+    monkeypatch.setattr(server, "completed_migrations", set())
+    monkeypatch.setattr(server, "MIGRATION_BATCH_PAUSE", 0)
+    monkeypatch.setattr(server, "scheduler", server.Scheduler())
+    server.stats_cache.clear()
+    server.feed_cache.clear()
+    return mock_db
+
+
+@pytest.fixture
+def user():
+    return {"id": "test", "email": "admin@example.com"}
+
+
+@pytest.fixture
+def insert_clients(db):
+    """Insert `count` clients named Имя<i> Фамилия<i> and return their ids"""
+    async def insert(count):
+        clients = [{"_id": ObjectId(), "first_name": f"Имя{i}", "last_name": f"Фамилия{i}"} for i in range(count)]
+        await db.clients.insert_many(clients)
+        return [str(c["_id"]) for c in clients]
+    return insert
+
+
+@pytest.fixture
+def request_with():
+    """Build a GET request carrying the given headers, for handlers that read conditional headers"""
+    def build(**headers):
+        raw = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+        return Request({"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": raw})
+    return build
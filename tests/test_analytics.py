@@ -0,0 +1,268 @@
+"""The in-memory analytics engine must answer exactly what the daily rollups answer"""
+import random
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+import pytest
+from bson import ObjectId
+from pydantic import ValidationError
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+TOPICS = ["Спина", "Шея", "Колено", "Стресс", ""]
+PRACTICES = ["Коррекция", "ТСЯ", "Лепило", "Ребефинг"]
+CLIENTS = [str(ObjectId()) for _ in range(12)]
+RANGES = [
+    (None, None),
+    ("2023-01-01", "2023-12-31"),
+    ("2023-06-15", "2024-02-10"),
+    ("2024-03-01", "2024-03-01"),
+    ("2022-01-01", "2022-12-31"),
+]
+
+
+def random_visit(rng):
+    visit = {
+        "_id": ObjectId(),
+        "client_id": rng.choice(CLIENTS),
+        "date": (date(2023, 1, 1) + timedelta(days=rng.randrange(500))).isoformat(),
+        "topic": rng.choice(TOPICS),
+        "practices": rng.sample(PRACTICES, rng.randrange(3)),
+        "tips": rng.choice([0, 0, 500, 1000]),
+        "retreat_id": rng.choice([None, None, None, str(ObjectId())]),
+    }
+    if rng.random() < 0.9:  # some visits predate financial tracking
+        visit["price"] = rng.choice([0, 10000, 15000, 20000])
+    return visit
+
+
+async def insert_visits(db, visits):
+    await db.visits.insert_many([dict(v) for v in visits])
+    await server.track_visit_changes(added=visits)
+
+
+def reference_client_topic_groups(visits, date_from, date_to):
+    groups = {}
+    for v in visits:
+        if not date_from <= v["date"] <= date_to:
+            continue
+        group = groups.setdefault(v["client_id"], {
+            "visit_count": 0, "total_revenue": 0, "total_tips": 0, "topics": Counter()
+        })
+        group["visit_count"] += 1
+        group["total_revenue"] += v.get("price", server.DEFAULT_PRICE)
+        group["total_tips"] += v["tips"]
+        group["topics"][v["topic"] or None] += 1
+    return groups
+
+
+@pytest.fixture
+def visits():
+    rng = random.Random(20240101)
+    return [random_visit(rng) for _ in range(400)]
+
+
+async def test_engine_matches_rollups(db, visits):
+    await insert_visits(db, visits)
+    await server.analytics_engine.load()
+    assert server.analytics_engine.ready
+
+    rollups = await server.load_daily_rollups()
+    for date_from, date_to in RANGES:
+        assert server.analytics_engine.summarize(date_from, date_to) == \
+            server.sum_daily_rollups(rollups, date_from, date_to), (date_from, date_to)
+
+
+async def test_engine_and_rollups_stay_in_sync_through_writes(db, visits):
+    await insert_visits(db, visits[:300])
+    await server.analytics_engine.load()
+    rng = random.Random(7)
+
+    # Changes and deletions of existing visits, then visits added afterwards
+    existing = rng.sample(visits[:300], 100)
+    for visit in existing[:60]:
+        changed = {**visit, "price": rng.choice([0, 5000]), "topic": rng.choice(TOPICS), "date": "2024-01-05"}
+        await db.visits.replace_one({"_id": visit["_id"]}, changed)
+        await server.track_visit_changes(removed=[visit], added=[changed])
+    for visit in existing[60:]:
+        await db.visits.delete_one({"_id": visit["_id"]})
+        await server.track_visit_changes(removed=[visit])
+    await insert_visits(db, visits[300:])
+
+    rollups = await server.load_daily_rollups()
+    for date_from, date_to in RANGES:
+        assert server.analytics_engine.summarize(date_from, date_to) == \
+            server.sum_daily_rollups(rollups, date_from, date_to), (date_from, date_to)
+
+    # A fresh load of the final state agrees with the incrementally maintained engine
+    fresh = server.VisitAnalytics()
+    server.analytics_engine, incremental = fresh, server.analytics_engine
+    await fresh.load()
+    for date_from, date_to in RANGES:
+        assert fresh.summarize(date_from, date_to) == incremental.summarize(date_from, date_to)
+
+
+async def test_rebuilt_rollups_match_incremental_rollups(db, visits):
+    await insert_visits(db, visits)
+    incremental = await server.load_daily_rollups()
+    await server.rebuild_daily_rollups()
+    rebuilt = await server.load_daily_rollups()
+    for date_from, date_to in RANGES:
+        assert server.sum_daily_rollups(rebuilt, date_from, date_to) == \
+            server.sum_daily_rollups(incremental, date_from, date_to)
+
+
+async def test_summarizer_answers_the_same_with_and_without_engine(db, visits):
+    await insert_visits(db, visits)
+    from_rollups = (await server.visit_summarizer("2023-01-01", "2024-12-31"))("2023-03-01", "2023-09-30")
+    await server.analytics_engine.load()
+    from_engine = (await server.visit_summarizer("2023-01-01", "2024-12-31"))("2023-03-01", "2023-09-30")
+    assert from_engine == from_rollups
+
+
+async def test_client_topic_groups_match_reference(db, visits):
+    await insert_visits(db, visits)
+    await server.analytics_engine.load()
+
+    groups = server.analytics_engine.client_topic_groups("2023-01-01", "2023-12-31")
+    expected = reference_client_topic_groups(visits, "2023-01-01", "2023-12-31")
+    assert {g["_id"] for g in groups} == set(expected)
+    counts = [g["visit_count"] for g in groups]
+    assert counts == sorted(counts, reverse=True)
+    for group in groups:
+        reference = expected[group["_id"]]
+        assert group["visit_count"] == reference["visit_count"]
+        assert group["total_revenue"] == reference["total_revenue"]
+        assert group["total_tips"] == reference["total_tips"]
+        assert Counter({t["topic"]: t["count"] for t in group["topics"]}) == reference["topics"]
+
+
+async def test_yearly_summary_engine_path_leaves_out_deleted_clients(db, visits):
+    await insert_visits(db, visits)
+    await db.clients.insert_many([
+        {"_id": ObjectId(cid), "first_name": "Имя", "last_name": f"Клиент{i}"} for i, cid in enumerate(CLIENTS[:-1])
+    ])
+    await server.analytics_engine.load()
+
+    facets = await server.yearly_facets_from_engine("2023-01-01", "2023-12-31")
+    assert {g["_id"] for g in facets["clients"]} == \
+        set(reference_client_topic_groups(visits, "2023-01-01", "2023-12-31")) - {CLIENTS[-1]}
+    topics = Counter(v["topic"] for v in visits if "2023-01-01" <= v["date"] <= "2023-12-31" and v["topic"])
+    assert {t["_id"]: t["count"] for t in facets["topics"]} == dict(topics)
+
+
+def test_daily_prefix_index_matches_brute_force():
+    rng = random.Random(3)
+    days = defaultdict(Counter)
+    for _ in range(300):
+        day = (date(2024, 1, 1) + timedelta(days=rng.randrange(120))).isoformat()
+        days[day].update({"visits": 1, "revenue": rng.choice([0, 15000]), "tips": rng.choice([0, 100])})
+    index = server.DailyPrefixIndex([{"_id": d, **c} for d, c in days.items()])
+
+    for _ in range(200):
+        start = date(2023, 12, 1) + timedelta(days=rng.randrange(180))
+        end = start + timedelta(days=rng.randrange(60))
+        expected = Counter()
+        for d, c in days.items():
+            if start.isoformat() <= d <= end.isoformat():
+                expected.update(c)
+        totals = index.totals(start.toordinal(), end.toordinal())
+        assert totals == {field: expected[field] for field in server.RANGE_FIELDS}
+
+
+def test_empty_prefix_index_sums_to_zero():
+    index = server.DailyPrefixIndex([])
+    assert index.totals(date(2024, 1, 1).toordinal(), date(2024, 12, 31).toordinal()) == \
+        {"visits": 0, "revenue": 0, "tips": 0}
+
+
+@pytest.mark.parametrize("bucket", server.RANGE_BUCKETS)
+def test_date_buckets_tile_the_range(bucket):
+    rng = random.Random(bucket)
+    for _ in range(200):
+        start = date(2020, 1, 1) + timedelta(days=rng.randrange(1500))
+        end = start + timedelta(days=rng.randrange(800))
+        buckets = list(server.date_buckets(start, end, bucket))
+        assert len(buckets) == server.count_date_buckets(start, end, bucket)
+        assert buckets[0][0] == start and buckets[-1][1] == end
+        for (_, previous_end), (next_start, _) in zip(buckets, buckets[1:]):
+            assert next_start == previous_end + timedelta(days=1)
+
+
+@pytest.mark.parametrize("bucket", server.RANGE_BUCKETS)
+def test_date_buckets_reach_the_last_representable_day(bucket):
+    assert list(server.date_buckets(date(9999, 12, 20), date.max, bucket))[-1][1] == date.max
+
+
+async def test_range_stats_reject_too_many_buckets(db, user):
+    with pytest.raises(server.HTTPException) as error:
+        await server.get_range_stats("1000-01-01", "9999-11-30", bucket="week", current_user=user)
+    assert error.value.status_code == 400
+
+def test_prefix_index_keeps_far_off_days_sparse():
+    index = server.DailyPrefixIndex([
+        {"_id": "2024-01-10", "visits": 2, "revenue": 30000, "tips": 0},
+        {"_id": "9024-01-01", "visits": 1, "revenue": 15000, "tips": 100},
+        {"_id": "not-a-date", "visits": 5, "revenue": 0, "tips": 0},
+    ])
+    assert len(index.ordinals) == 2
+    assert index.totals(date(2024, 1, 1).toordinal(), date(2024, 12, 31).toordinal()) == \
+        {"visits": 2, "revenue": 30000, "tips": 0}
+    assert index.totals(date(2024, 1, 1).toordinal(), date.max.toordinal()) == \
+        {"visits": 3, "revenue": 45000, "tips": 100}
+
+
+@pytest.mark.parametrize("value", ["2024-1-5", "05.01.2024", "2024-02-30", "2024-01-05T10:00", ""])
+def test_visit_dates_must_be_iso_dates(value):
+    with pytest.raises(ValidationError):
+        server.VisitCreate(date=value, topic="Спина")
+    with pytest.raises(ValidationError):
+        server.VisitUpdate(date=value)
+    assert server.VisitCreate(date="2024-02-29", topic="Спина").date == "2024-02-29"
+
+
+def test_cohort_accumulator():
+    today = date(2024, 6, 30).toordinal()
+    accumulator = server.CohortAccumulator(today, churn_days=90, max_months=3)
+    accumulator.add_client([date(2024, 1, 10).toordinal(), date(2024, 1, 20).toordinal(), date(2024, 3, 1).toordinal()])
+    accumulator.add_client([date(2024, 1, 5).toordinal()])
+    accumulator.add_client([date(2024, 6, 1).toordinal(), date(2024, 6, 1).toordinal()])
+    accumulator.add_client([])
+    result = accumulator.result()
+
+    january, june = result["cohorts"]
+    assert january["cohort"] == "2024-01"
+    assert (january["clients"], january["returned"], january["churned"]) == (2, 1, 2)
+    assert january["retention"] == [1.0, 0.0, 0.5, 0.0]
+    assert january["median_days_to_return"] == 10
+    assert january["median_days_between_visits"] == 25.5
+    assert june["cohort"] == "2024-06"
+    assert (june["clients"], june["returned"], june["churned"]) == (1, 0, 0)
+    assert june["retention"] == [1.0]
+    assert result["overall"] == {
+        "clients": 3, "returned": 1, "return_rate": 0.3333,
+        "churned": 2, "active": 1, "median_days_between_visits": 25.5
+    }
+
+
+async def test_cohort_stats_group_each_clients_visits(db, monkeypatch):
+    visits = [
+        ("a", "2024-01-10"), ("b", "2024-01-05"), ("a", "2024-03-01"), ("c", "2024-06-01"),
+        ("a", "2024-01-20"), ("c", "2024-06-01"), ("b", "bad date"),
+    ]
+    await db.visits.insert_many([{"client_id": client, "date": day} for client, day in visits])
+
+    class FixedDatetime(server.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return server.datetime(2024, 6, 30, tzinfo=tz)
+
+    monkeypatch.setattr(server, "datetime", FixedDatetime)
+    stats = await server.compute_cohort_stats(churn_days=90, max_months=3)
+    assert [c["cohort"] for c in stats["cohorts"]] == ["2024-01", "2024-06"]
+    assert stats["overall"] == {
+        "clients": 3, "returned": 1, "return_rate": 0.3333,
+        "churned": 2, "active": 1, "median_days_between_visits": 25.5
+    }
@@ -0,0 +1,132 @@
+"""Response cache keyed by data versions, and year snapshots"""
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class Computation:
+    """Stands in for an expensive statistics query, counting its calls"""
+
+    def __init__(self):
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        return {"call": self.calls}
+
+
+async def test_cached_response_is_reused_until_its_collections_change(db):
+    cache = server.ResponseCache()
+    compute = Computation()
+
+    assert await cache.get_or_compute("overview", ("visits", "clients"), {"year": 2024}, compute) == {"call": 1}
+    assert await cache.get_or_compute("overview", ("visits", "clients"), {"year": 2024}, compute) == {"call": 1}
+    server.bump_data_version("retreats")
+    assert await cache.get_or_compute("overview", ("visits", "clients"), {"year": 2024}, compute) == {"call": 1}
+    server.bump_data_version("clients")
+    assert await cache.get_or_compute("overview", ("visits", "clients"), {"year": 2024}, compute) == {"call": 2}
+    assert await cache.get_or_compute("overview", ("visits", "clients"), {"year": 2025}, compute) == {"call": 3}
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+async def test_least_recently_used_entry_is_evicted(db):
+    cache = server.ResponseCache(max_entries=2)
+    compute = Computation()
+
+    await cache.get_or_compute("topics", ("visits",), {"key": "a"}, compute)
+    await cache.get_or_compute("topics", ("visits",), {"key": "b"}, compute)
+    await cache.get_or_compute("topics", ("visits",), {"key": "a"}, compute)
+    await cache.get_or_compute("topics", ("visits",), {"key": "c"}, compute)
+
+    assert [dict(key[1])["key"] for key in cache.entries] == ["a", "c"]
+    assert cache.evictions == 1
+    await cache.get_or_compute("topics", ("visits",), {"key": "a"}, compute)
+    assert compute.calls == 3
+
+
+async def test_prune_drops_entries_of_old_versions_and_past_days(db, monkeypatch):
+    cache = server.ResponseCache()
+    compute = Computation()
+    monkeypatch.setattr(server, "today_iso", lambda: "2024-05-01")
+    await cache.get_or_compute("overview", ("visits",), {"today": "2024-05-01"}, compute)
+    await cache.get_or_compute("retreats", ("retreats",), {"year": 2024}, compute)
+    await cache.get_or_compute("topics", ("visits",), {}, compute)
+
+    server.bump_data_version("visits")
+    assert cache.prune() == 2
+    monkeypatch.setattr(server, "today_iso", lambda: "2024-05-02")
+    await cache.get_or_compute("overview", ("visits",), {"today": "2024-05-01"}, compute)
+    assert cache.prune() == 1
+    assert [key[0] for key in cache.entries] == ["retreats"]
+
+
+async def test_visit_writes_retire_cached_statistics(db):
+    visit = {"_id": ObjectId(), "client_id": str(ObjectId()), "date": "2024-03-01", "topic": "Спина",
+             "practices": [], "price": 15000, "tips": 0, "retreat_id": None}
+    assert (await server.cached_topics_stats())["total_visits"] == 0
+
+    await db.visits.insert_one(dict(visit))
+    await server.track_visit_changes(added=[visit])
+    assert await server.cached_topics_stats() == {"topics": [{"topic": "Спина", "count": 1}], "total_visits": 1}
+
+    await db.visits.delete_one({"_id": visit["_id"]})
+    await server.track_visit_changes(removed=[visit])
+    assert (await server.cached_topics_stats())["total_visits"] == 0
+
+
+async def test_closed_year_snapshot_is_materialized_once(db, request_with):
+    compute = Computation()
+
+    first = await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    second = await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+
+    assert compute.calls == 1
+    assert first.body == second.body
+    assert first.headers["etag"] == second.headers["etag"] == server.body_etag({"call": 1})
+    assert await db.year_snapshots.count_documents({}) == 1
+
+
+async def test_visit_writes_retire_their_years_snapshots(db, request_with):
+    compute = Computation()
+    await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    await server.serve_year_snapshot(request_with(), "yearly-summary", 2021, {}, compute)
+
+    visit = {"_id": ObjectId(), "client_id": str(ObjectId()), "date": "2020-06-01", "topic": "Спина",
+             "practices": [], "price": 15000, "tips": 0, "retreat_id": None}
+    await db.visits.insert_one(dict(visit))
+    await server.track_visit_changes(added=[visit])
+
+    assert [s["year"] for s in await db.year_snapshots.find().to_list(None)] == [2021]
+    await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    assert compute.calls == 3
+
+
+async def test_writes_that_skip_invalidation_are_caught_by_updated_at(db, request_with):
+    compute = Computation()
+    await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    await db.visits.insert_one({"client_id": str(ObjectId()), "date": "2020-06-01", "price": 15000,
+                                "updated_at": server.datetime.now(server.timezone.utc) + server.timedelta(seconds=1)})
+
+    await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    assert compute.calls == 2
+
+
+async def test_snapshot_answers_conditional_requests_with_304(db, request_with):
+    compute = Computation()
+    response = await server.serve_year_snapshot(request_with(), "yearly-summary", 2020, {}, compute)
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    async def serve(**headers):
+        return (await server.serve_year_snapshot(request_with(**headers), "yearly-summary", 2020, {}, compute)).status_code
+
+    assert await serve(if_none_match=etag) == 304
+    assert await serve(if_none_match=f'W/{etag}, "other"') == 304
+    assert await serve(if_none_match='"other"') == 200
+    assert await serve(if_modified_since=last_modified) == 304
+    assert await serve(if_modified_since="Mon, 01 Jan 2001 00:00:00 GMT") == 200
+    assert await serve(if_modified_since="not a date") == 200
+    # If-None-Match decides whenever it is sent
+    assert await serve(if_none_match='"other"', if_modified_since=last_modified) == 200
@@ -0,0 +1,207 @@
+"""Calendar feed encoding, conditional feed requests, client batching, calendar paging and the heatmap"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def unfold(text):
+    return text.replace("\r\n ", "")
+
+
+@pytest.mark.parametrize("line", [
+    "SUMMARY:short",
+    "SUMMARY:" + "x" * 67,
+    "SUMMARY:" + "x" * 68,
+    "DESCRIPTION:" + "Коррекция, ТСЯ, Лепило, Ребефинг; " * 10,
+    "SUMMARY:" + "a" + "ё" * 100,
+    "SUMMARY:" + "🙂" * 40,
+])
+def test_ics_line_folds_at_75_octets(line):
+    folded = server.ics_line(line)
+    assert folded.endswith("\r\n")
+    physical = folded[:-2].split("\r\n")
+    assert all(len(part.encode("utf-8")) <= 75 for part in physical)
+    assert all(part.startswith(" ") for part in physical[1:])
+    assert unfold(folded[:-2]) == line
+
+
+def test_ics_escape():
+    assert server.ics_escape("Шея, спина; плечи\\\nдалее\r\nконец") == \
+        "Шея\\, спина\\; плечи\\\\\\nдалее\\nконец"
+
+
+def test_ics_event_end_date_is_exclusive():
+    event = server.ics_event("visit-1", "Иванов — Спина", "2024-02-28", "2024-02-29", "20240101T000000Z")
+    assert "DTSTART;VALUE=DATE:20240228\r\n" in event
+    assert "DTEND;VALUE=DATE:20240301\r\n" in event
+    assert "DESCRIPTION" not in event
+
+
+@pytest.fixture
+async def feed_token(db):
+    await db.users.insert_one({"email": "admin@example.com", "calendar_feed_token": "feed-token"})
+    return "feed-token"
+
+
+async def test_feed_renders_visits(db, insert_clients, feed_token, request_with):
+    client_ids = await insert_clients(1)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    await db.visits.insert_one({"client_id": client_ids[0], "date": today, "topic": "Спина",
+                                "practices": [], "price": 15000, "tips": 0, "retreat_id": None})
+
+    response = await server.get_calendar_feed(request_with(), feed_token)
+    body = unfold(response.body.decode("utf-8"))
+    assert body.startswith("BEGIN:VCALENDAR\r\n") and body.endswith("END:VCALENDAR\r\n")
+    assert "SUMMARY:Имя0 Фамилия0 — Спина\r\n" in body
+
+
+async def test_feed_answers_conditional_requests_with_304(db, feed_token, request_with):
+    response = await server.get_calendar_feed(request_with(), feed_token)
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    async def status(**headers):
+        return (await server.get_calendar_feed(request_with(**headers), feed_token)).status_code
+
+    assert await status(if_none_match=etag) == 304
+    assert await status(if_modified_since=last_modified) == 304
+    assert await status(if_modified_since="Mon, 01 Jan 2001 00:00:00 GMT") == 200
+
+    # A write moves both validators on (Last-Modified by whole seconds)
+    server.bump_data_version("visits")
+    server.data_changed_at["visits"] += timedelta(seconds=2)
+    later = format_datetime(server.data_changed_at["visits"], usegmt=True)
+    assert await status(if_none_match=etag) == 200
+    assert await status(if_modified_since=last_modified) == 200
+    assert await status(if_modified_since=later) == 304
+
+
+@pytest.fixture
+def find_calls(db, monkeypatch):
+    """Record the queries sent to the clients collection"""
+    calls = []
+    collection_type = type(db.clients)
+    find = collection_type.find
+
+    def recording_find(self, *args, **kwargs):
+        if self.name == "clients":
+            calls.append(args[0] if args else kwargs.get("filter"))
+        return find(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "find", recording_find)
+    return calls
+
+
+async def test_client_loader_batches_concurrent_loads(db, find_calls, insert_clients):
+    client_ids = await insert_clients(5)
+    loader = server.ClientLoader()
+
+    clients = await asyncio.gather(*(loader.load(cid) for cid in client_ids))
+    assert [str(c["_id"]) for c in clients] == client_ids
+    assert len(find_calls) == 1
+
+
+async def test_client_loader_fetches_each_client_once(db, find_calls, insert_clients):
+    client_ids = await insert_clients(3)
+    loader = server.ClientLoader()
+
+    await loader.load_many(client_ids[:2])
+    await loader.load_many(client_ids)
+    assert len(find_calls) == 2
+    assert find_calls[1]["_id"]["$in"] == [ObjectId(client_ids[2])]
+
+
+async def test_client_loader_resolves_missing_and_invalid_ids_to_none(db, find_calls, insert_clients):
+    client_ids = await insert_clients(1)
+    loader = server.ClientLoader()
+
+    missing = str(ObjectId())
+    assert await loader.load_many([client_ids[0], missing, "not-an-id", ""]) == \
+        [await loader.load(client_ids[0]), None, None, None]
+    assert len(find_calls) == 1
+    assert await loader.names([client_ids[0], missing, client_ids[0]]) == {client_ids[0]: "Имя0 Фамилия0"}
+
+
+async def test_calendar_events_pages_through_visits(db, user, insert_clients):
+    client_ids = await insert_clients(3)
+    visits = [
+        {"_id": ObjectId(), "client_id": client_ids[i % 3], "date": f"2024-03-{1 + i // 4:02d}",
+         "topic": "Спина", "practices": [], "price": 15000, "tips": 0, "retreat_id": None}
+        for i in range(25)
+    ]
+    await db.visits.insert_many(visits)
+    await db.visits.insert_one({"_id": ObjectId(), "client_id": client_ids[0], "date": "2024-03-02",
+                                "retreat_id": str(ObjectId()), "price": 0})
+    await db.retreats.insert_one({"name": "Весна", "start_date": "2024-03-05", "end_date": "2024-03-08",
+                                  "total_participants": 4, "total_revenue": 100000})
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        page = await server.get_calendar_events("2024-03-01", "2024-03-31", limit=10, cursor=cursor,
+                                                clients=server.ClientLoader(), current_user=user)
+        pages += 1
+        retreats = [e for e in page["events"] if e["type"] == "retreat"]
+        assert len(retreats) == (1 if cursor is None else 0)
+        seen += [e for e in page["events"] if e["type"] == "visit"]
+        if not page["has_more"]:
+            break
+        cursor = page["next_cursor"]
+
+    assert pages == 3
+    assert [e["id"] for e in seen] == [str(v["_id"]) for v in sorted(visits, key=lambda v: (v["date"], v["_id"]))]
+    assert all(e["client_name"].startswith("Имя") for e in seen)
+
+
+async def test_calendar_events_reject_bad_limit_and_cursor(db, user):
+    for kwargs in ({"limit": 0}, {"limit": server.CALENDAR_PAGE_LIMIT + 1}, {"cursor": "garbage"}):
+        with pytest.raises(server.HTTPException) as error:
+            await server.get_calendar_events("2024-03-01", "2024-03-31", clients=server.ClientLoader(),
+                                             current_user=user, **kwargs)
+        assert error.value.status_code == 400
+
+
+async def test_heatmap_spreads_visits_and_retreats_over_days(db, user):
+    visits = [
+        {"_id": ObjectId(), "client_id": str(ObjectId()), "date": date, "topic": "Спина", "practices": [],
+         "price": 15000, "tips": tips, "retreat_id": retreat_id}
+        for date, tips, retreat_id in [("2024-03-01", 500, None), ("2024-03-01", 0, None),
+                                       ("2024-03-03", 0, None), ("2024-03-03", 0, "r1"), ("2024-04-01", 0, None)]
+    ]
+    await db.visits.insert_many([dict(v) for v in visits])
+    await server.track_visit_changes(added=visits)
+    await db.retreats.insert_many([
+        {"start_date": "2024-02-28", "end_date": "2024-03-02", "total_participants": 4},
+        {"start_date": "2024-03-02", "end_date": "2024-03-10", "total_participants": 6},
+    ])
+
+    heatmap = await server.get_calendar_heatmap("2024-03-01", "2024-03-04", current_user=user)
+    assert heatmap["days"] == 4
+    assert heatmap["visits"] == [2, 0, 1, 0]
+    assert heatmap["revenue"] == [30500, 0, 15000, 0]
+    assert heatmap["retreats"] == [1, 2, 1, 1]
+    assert heatmap["retreat_participants"] == [4, 10, 6, 6]
+
+
+async def test_heatmap_skips_rollups_of_mistyped_dates(db, user):
+    await db.visit_daily_rollups.insert_many([
+        {"_id": "2024-03-02", "personal_visits": 1, "personal_revenue": 15000, "personal_tips": 0},
+        {"_id": "2024-03-0x", "personal_visits": 1, "personal_revenue": 15000, "personal_tips": 0},
+        {"_id": "2024-03-1", "personal_visits": 1, "personal_revenue": 15000, "personal_tips": 0},
+    ])
+
+    heatmap = await server.get_calendar_heatmap("2024-03-01", "2024-03-03", current_user=user)
+    assert heatmap["visits"] == [0, 1, 0]
+
+
+@pytest.mark.parametrize("date_from, date_to", [("2024-03-xx", "2024-03-04"), ("2024-03-05", "2024-03-04"),
+                                                 ("2010-01-01", "2024-12-31")])
+async def test_heatmap_rejects_bad_ranges(db, user, date_from, date_to):
+    with pytest.raises(server.HTTPException) as error:
+        await server.get_calendar_heatmap(date_from, date_to, current_user=user)
+    assert error.value.status_code == 400
@@ -0,0 +1,98 @@
+"""Batched schema migrations: progress, resuming and completion"""
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+def migration(migration_id):
+    return next(m for m in server.MIGRATIONS if m.id == migration_id)
+
+
+async def insert_legacy_visits(db, count):
+    """Visits as stored before prices, retreat_id and practices_mask existed"""
+    visits = [{"_id": ObjectId(), "client_id": str(ObjectId()), "date": f"2019-01-{i + 1:02d}", "topic": "Спина",
+               "practices": ["ТСЯ", "Шея"] if i % 2 else ["ТСЯ"]} for i in range(count)]
+    await db.visits.insert_many([dict(v) for v in visits])
+    return [v["_id"] for v in visits]
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(server, "MIGRATION_BATCH_SIZE", 2)
+
+
+async def test_financial_defaults_resume_where_they_stopped(db, small_batches):
+    ids = await insert_legacy_visits(db, 5)
+    await db.settings.insert_one({"type": "app_settings", "default_visit_price": 12000})
+    await server.load_settings()
+
+    assert await server.run_migration(migration("0001_visit_financial_defaults"), 1) == 1
+    state = await db.schema_migrations.find_one({"_id": "0001_visit_financial_defaults"})
+    assert (state["status"], state["processed"], state["total"], state["last_id"]) == ("running", 2, 5, ids[1])
+    assert await db.visits.count_documents({"price": 12000, "tips": 0}) == 2
+    assert not await server.migration_done("0001_visit_financial_defaults")
+
+    await server.run_migration(migration("0001_visit_financial_defaults"), 10)
+    state = await db.schema_migrations.find_one({"_id": "0001_visit_financial_defaults"})
+    assert (state["status"], state["processed"]) == ("done", 5)
+    assert await db.visits.count_documents({"price": 12000, "tips": 0}) == 5
+    assert await server.migration_done("0001_visit_financial_defaults")
+    assert await server.run_migration(migration("0001_visit_financial_defaults"), 10) == 0
+
+
+async def test_financial_defaults_keep_stored_prices(db):
+    visit_id = ObjectId()
+    await db.visits.insert_one({"_id": visit_id, "client_id": str(ObjectId()), "date": "2019-01-01", "price": 9000})
+
+    await server.finish_migration("0001_visit_financial_defaults")
+    visit = await db.visits.find_one({"_id": visit_id})
+    assert (visit["price"], visit["tips"]) == (9000, 0)
+
+
+async def test_retreat_id_backfill_resumes(db, small_batches):
+    await insert_legacy_visits(db, 3)
+    await db.visits.insert_one({"client_id": str(ObjectId()), "date": "2019-02-01", "retreat_id": "r1"})
+
+    await server.run_migration(migration("0002_visit_retreat_id"), 1)
+    assert await db.visits.count_documents({"retreat_id": {"$exists": False}}) == 1
+    await server.finish_migration("0002_visit_retreat_id")
+    assert await db.visits.count_documents({"retreat_id": None}) == 3
+    assert await db.visits.count_documents({"retreat_id": "r1"}) == 1
+
+
+async def test_practices_mask_backfill_resumes(db, small_batches):
+    ids = await insert_legacy_visits(db, 5)
+
+    await server.run_migration(migration("0003_visit_practices_mask"), 2)
+    assert await db.visits.count_documents({"practices_mask": {"$exists": False}}) == 1
+    await server.finish_migration("0003_visit_practices_mask")
+
+    bits = await server.get_practice_bits()
+    for visit in await db.visits.find({"_id": {"$in": ids}}).to_list(None):
+        assert visit["practices_mask"] == server.practices_mask(visit["practices"], bits)
+    assert set(bits) == {"ТСЯ", "Шея"}
+
+
+async def test_failed_batch_is_recorded_and_retried(db, small_batches):
+    await insert_legacy_visits(db, 3)
+    calls = []
+
+    def transform(visit, context):
+        calls.append(visit["_id"])
+        if len(calls) == 3:
+            raise RuntimeError("boom")
+        return {"done": True}
+
+    failing = server.Migration("9999_test", "Fails once", "visits", {"done": {"$exists": False}}, transform)
+    with pytest.raises(RuntimeError):
+        await server.run_migration(failing, 10)
+    state = await db.schema_migrations.find_one({"_id": "9999_test"})
+    assert (state["status"], state["processed"], state["error"]) == ("failed", 2, "boom")
+
+    await server.run_migration(failing, 10)
+    state = await db.schema_migrations.find_one({"_id": "9999_test"})
+    assert (state["status"], state["processed"]) == ("done", 3)
+    assert await db.visits.count_documents({"done": True}) == 3
@@ -0,0 +1,206 @@
+"""Stored retreat totals, participant adds, the participants collection and its migration"""
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+async def retreat(db, user):
+    await db.retreat_participants.create_index([("retreat_id", 1), ("client_id", 1)], unique=True)
+    created = await server.create_retreat(
+        server.RetreatCreate(name="Весна", start_date="2024-03-05", end_date="2024-03-08"), current_user=user
+    )
+    return created["id"]
+
+
+async def stored_totals(db, retreat_id):
+    retreat = await db.retreats.find_one({"_id": ObjectId(retreat_id)})
+    return {field: retreat[field] for field in server.RETREAT_TOTAL_FIELDS}
+
+
+async def test_participant_changes_keep_totals_and_visits_in_step(db, user, retreat, insert_clients):
+    client_ids = await insert_clients(3)
+    for cid, payment in zip(client_ids, [20000, 15000, 0]):
+        await server.add_retreat_participant(retreat, server.RetreatParticipant(client_id=cid, payment=payment),
+                                             current_user=user)
+    await server.update_retreat_participant(retreat, client_ids[1], server.RetreatParticipant(
+        client_id=client_ids[1], payment=10000, payment_status="paid"), current_user=user)
+    await server.remove_retreat_participant(retreat, client_ids[2], current_user=user)
+    await server.add_retreat_expense(retreat, server.RetreatExpense(name="Аренда", amount=12000), current_user=user)
+
+    assert await stored_totals(db, retreat) == {
+        "total_participants": 2, "total_revenue": 30000, "total_expenses": 12000, "net_profit": 18000
+    }
+    visits = await db.visits.find({"retreat_id": retreat}).to_list(None)
+    assert {v["client_id"]: v["price"] for v in visits} == {client_ids[0]: 20000, client_ids[1]: 10000}
+
+    details = await server.get_retreat(retreat, clients=server.ClientLoader(), current_user=user)
+    assert [p["client_name"] for p in details["participants"]] == ["Имя0 Фамилия0", "Имя1 Фамилия1"]
+    assert details["total_revenue"] == 30000
+
+    # The stored totals are what a full recount gives
+    await server.repair_retreat_totals()
+    assert await stored_totals(db, retreat) == {
+        "total_participants": 2, "total_revenue": 30000, "total_expenses": 12000, "net_profit": 18000
+    }
+
+
+async def test_totals_migration_survives_a_concurrent_start(db, monkeypatch):
+    await db.retreats.insert_one({"name": "Осень", "start_date": "2023-10-01", "end_date": "2023-10-03",
+                                  "expenses": [{"id": "e", "amount": 5000}]})
+    migration = next(m for m in server.MIGRATIONS if m.id == "0004_retreat_totals")
+    collection_type = type(db.retreats)
+    count_documents = collection_type.count_documents
+
+    async def racing_count(self, *args, **kwargs):
+        # Another worker records the migration's state between our read and our write
+        await db.schema_migrations.insert_one({"_id": migration.id, "status": "running", "last_id": None,
+                                               "processed": 0, "total": 1})
+        monkeypatch.setattr(collection_type, "count_documents", count_documents)
+        return await count_documents(self, *args, **kwargs)
+
+    monkeypatch.setattr(collection_type, "count_documents", racing_count)
+    await server.run_migration(migration, 10)
+
+    assert await server.migration_done(migration.id)
+    assert (await db.retreats.find_one())["net_profit"] == -5000
+
+
+async def test_startup_migration_waits_for_the_lease_holder(db, monkeypatch):
+    monkeypatch.setattr(server, "MIGRATION_WAIT_SECONDS", 0.01)
+    await db.retreats.insert_one({"name": "Осень", "start_date": "2023-10-01", "end_date": "2023-10-03"})
+    await db.scheduler_locks.insert_one({"_id": "scheduler", "holder": "another-worker",
+                                         "expires_at": server.datetime.now(server.timezone.utc) + server.timedelta(minutes=1)})
+
+    waiting = asyncio.create_task(server.finish_migration("0004_retreat_totals"))
+    await asyncio.sleep(0.05)
+    assert not waiting.done()
+    assert await db.schema_migrations.count_documents({}) == 0
+
+    await db.scheduler_locks.delete_one({"_id": "scheduler"})
+    await asyncio.wait_for(waiting, 1)
+    assert (await db.retreats.find_one())["total_participants"] == 0
+
+
+async def test_bulk_add_skips_registered_participants(db, user, retreat, insert_clients):
+    client_ids = await insert_clients(3)
+    await server.add_retreat_participant(retreat, server.RetreatParticipant(client_id=client_ids[0], payment=5000),
+                                         current_user=user)
+    result = await server.add_retreat_participants_bulk(retreat, server.RetreatParticipantsBulk(participants=[
+        server.RetreatParticipant(client_id=cid, payment=20000) for cid in client_ids + client_ids[1:2]
+    ]), current_user=user)
+
+    assert (result["added"], result["skipped"]) == (2, [client_ids[0]])
+    assert await stored_totals(db, retreat) == {
+        "total_participants": 3, "total_revenue": 45000, "total_expenses": 0, "net_profit": 45000
+    }
+    assert await db.visits.count_documents({"retreat_id": retreat}) == 3
+
+
+async def test_embedded_participants_move_to_their_collection(db):
+    await db.retreat_participants.create_index([("retreat_id", 1), ("client_id", 1)], unique=True)
+    embedded = [
+        {"client_id": "a", "payment": 20000, "payment_status": "paid"},
+        {"client_id": "b", "payment": 15000},
+    ]
+    result = await db.retreats.insert_one({"name": "Осень", "start_date": "2023-10-01", "end_date": "2023-10-03",
+                                           "participants": embedded, "expenses": [{"id": "e", "amount": 5000}]})
+    retreat_id = str(result.inserted_id)
+
+    await server.finish_migration("0004_retreat_totals")
+    await server.finish_migration("0005_retreat_participants_collection")
+
+    retreat = await db.retreats.find_one({"_id": result.inserted_id})
+    assert "participants" not in retreat
+    assert {field: retreat[field] for field in server.RETREAT_TOTAL_FIELDS} == {
+        "total_participants": 2, "total_revenue": 35000, "total_expenses": 5000, "net_profit": 30000
+    }
+    moved = await db.retreat_participants.find({"retreat_id": retreat_id}).to_list(None)
+    assert {(p["client_id"], p["payment"], p["payment_status"]) for p in moved} == \
+        {("a", 20000, "paid"), ("b", 15000, "not_paid")}
+    assert await server.migration_done("0005_retreat_participants_collection")
+
+
+async def test_backup_keeps_participants_from_both_places(db, user, retreat, insert_clients):
+    client_ids = await insert_clients(2)
+    await server.add_retreat_participant(retreat, server.RetreatParticipant(client_id=client_ids[0], payment=20000),
+                                         current_user=user)
+    # A retreat the participants migration has not reached yet
+    await db.retreats.update_one({"_id": ObjectId(retreat)}, {"$set": {"participants": [
+        {"client_id": client_ids[0], "payment": 1, "payment_status": "not_paid"},
+        {"client_id": client_ids[1], "payment": 15000, "payment_status": "paid"},
+    ]}})
+
+    backup = await server.download_backup(current_user=user)
+    (backed_up,) = backup["retreats"]
+    assert {p["client_id"]: p["payment"] for p in backed_up["participants"]} == \
+        {client_ids[0]: 20000, client_ids[1]: 15000}
+
+
+async def test_adding_a_participant_twice_is_rejected(db, user, retreat, insert_clients):
+    client_ids = await insert_clients(1)
+    participant = server.RetreatParticipant(client_id=client_ids[0], payment=20000)
+    results = await asyncio.gather(
+        *(server.add_retreat_participant(retreat, participant, current_user=user) for _ in range(2)),
+        return_exceptions=True
+    )
+
+    assert sorted(getattr(r, "status_code", 200) for r in results) == [200, 400]
+    assert (await stored_totals(db, retreat))["total_participants"] == 1
+    assert await db.visits.count_documents({"retreat_id": retreat}) == 1
+
+
+async def test_retreat_visit_is_created_once(db, retreat, insert_clients):
+    client_ids = await insert_clients(1)
+    stored = await db.retreats.find_one({"_id": ObjectId(retreat)})
+    participant = server.RetreatParticipant(client_id=client_ids[0], payment=20000)
+
+    await server.create_retreat_visits(stored, [participant])
+    await server.create_retreat_visits(stored, [participant])
+    assert await db.visits.count_documents({"retreat_id": retreat}) == 1
+
+
+@pytest.fixture
+async def retreat_visit_index(db):
+    await db.visits.create_index([("retreat_id", 1), ("client_id", 1)], unique=True,
+                                 partialFilterExpression={"retreat_id": {"$type": "string"}})
+
+
+async def test_restore_keeps_one_visit_per_retreat_participant(db, user, retreat_visit_index):
+    retreat_id, client_id = str(ObjectId()), str(ObjectId())
+    visit = {"client_id": client_id, "date": "2024-03-05", "topic": "Ретрит", "practices": [],
+             "price": 20000, "tips": 0, "retreat_id": retreat_id}
+    backup = server.BackupData(
+        clients=[{"id": client_id, "first_name": "Имя", "last_name": "Фамилия"}],
+        visits=[{**visit, "id": str(ObjectId())}, {**visit, "id": str(ObjectId()), "price": 1},
+                {**visit, "id": str(ObjectId()), "retreat_id": None}],
+        retreats=[{"id": retreat_id, "name": "Весна", "start_date": "2024-03-05", "end_date": "2024-03-08",
+                   "participants": [{"client_id": client_id, "payment": 20000}]}]
+    )
+
+    result = await server.restore_backup(backup, current_user=user)
+    assert result["restored"] == {"clients": 1, "visits": 2, "retreats": 1}
+    assert result["skipped_duplicate_retreat_visits"] == 1
+    assert [v["price"] for v in await db.visits.find({"retreat_id": retreat_id}).to_list(None)] == [20000]
+    assert await db.retreat_participants.count_documents({"retreat_id": retreat_id}) == 1
+
+
+@pytest.mark.parametrize("broken", [
+    {"visits": [{"id": "65f000000000000000000001", "date": "2024-03-05"},
+                {"id": "65f000000000000000000001", "date": "2024-03-06"}]},
+    {"retreats": [{"name": "Весна", "participants": [{"client_id": "a", "payment": "много"}]}]},
+    {"retreats": [{"name": "Весна", "participants": ["a"]}]},
+])
+async def test_invalid_backup_leaves_the_data_in_place(db, user, insert_clients, broken):
+    await insert_clients(2)
+    backup = server.BackupData(**{"clients": [], "visits": [], "retreats": [], **broken})
+
+    with pytest.raises(server.HTTPException) as error:
+        await server.restore_backup(backup, current_user=user)
+    assert error.value.status_code == 400
+    assert await db.clients.count_documents({}) == 2
@@ -0,0 +1,56 @@
+"""Scheduler leader lease and job runs"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_only_one_worker_holds_the_lease(db):
+    first, second = server.Scheduler(), server.Scheduler()
+
+    assert await first.acquire_leadership()
+    assert not await second.acquire_leadership()
+    # The holder renews its own lease
+    assert await first.acquire_leadership()
+    assert not await second.acquire_leadership()
+    lock = await db.scheduler_locks.find_one({"_id": "scheduler"})
+    assert lock["holder"] == first.worker_id
+
+
+async def test_expired_lease_passes_to_another_worker(db):
+    first, second = server.Scheduler(), server.Scheduler()
+    await first.acquire_leadership()
+    await db.scheduler_locks.update_one(
+        {"_id": "scheduler"}, {"$set": {"expires_at": datetime.now(timezone.utc) - timedelta(seconds=1)}}
+    )
+
+    assert await second.acquire_leadership()
+    assert not await first.acquire_leadership()
+    lock = await db.scheduler_locks.find_one({"_id": "scheduler"})
+    assert lock["holder"] == second.worker_id
+
+
+async def test_stop_releases_the_lease(db):
+    first, second = server.Scheduler(), server.Scheduler()
+    await first.acquire_leadership()
+
+    await first.stop()
+    assert not first.is_leader
+    assert await second.acquire_leadership()
+
+
+async def test_failing_job_is_recorded_and_rescheduled(db):
+    scheduler = server.Scheduler()
+
+    async def fail():
+        raise RuntimeError("boom")
+
+    scheduler.add_job("broken", 60, fail)
+    job = scheduler.jobs["broken"]
+    await scheduler.run_job(job)
+
+    assert (job.runs, job.failures, job.last_error, job.running) == (1, 1, "boom", False)
+    assert job.next_run == job.last_started + timedelta(seconds=60)
@@ -0,0 +1,72 @@
+"""Cached settings and the defaults they apply on writes"""
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def rollup_revenue(db):
+    return sum(day.get("revenue", 0) for day in await db.visit_daily_rollups.find().to_list(None))
+
+
+async def test_settings_are_cached_until_they_change(db, user):
+    assert server.current_settings() == server.default_settings()
+    await db.settings.insert_one({"type": "app_settings", "default_visit_price": 12000})
+    assert server.default_visit_price() == server.DEFAULT_PRICE
+    assert (await server.load_settings())["default_visit_price"] == 12000
+
+    updated = await server.update_settings(server.SettingsUpdate(default_retreat_price=40000), current_user=user)
+    assert (updated["default_visit_price"], updated["default_retreat_price"]) == (12000, 40000)
+    assert server.default_retreat_price() == 40000
+
+
+async def test_new_visits_take_the_current_default_price(db, user, insert_clients):
+    (client_id,) = await insert_clients(1)
+    await server.update_settings(server.SettingsUpdate(default_visit_price=17000), current_user=user)
+
+    await server.create_visit(client_id, server.VisitCreate(date="2024-03-01", topic="Спина"), current_user=user)
+    visit = await db.visits.find_one({"client_id": client_id})
+    assert (visit["price"], visit["tips"]) == (17000, 0)
+    assert await rollup_revenue(db) == 17000
+
+
+async def test_changing_the_default_price_leaves_no_revenue_drift(db, user):
+    # A visit from before financial tracking, rolled up at the default of the time
+    visit = {"_id": ObjectId(), "client_id": str(ObjectId()), "date": "2024-03-01", "topic": "Спина",
+             "practices": [], "retreat_id": None}
+    await db.visits.insert_one(dict(visit))
+    await server.track_visit_changes(added=[visit])
+    assert await rollup_revenue(db) == server.DEFAULT_PRICE
+
+    await server.update_settings(server.SettingsUpdate(default_visit_price=20000), current_user=user)
+    assert (await db.visits.find_one({"_id": visit["_id"]}))["price"] == server.DEFAULT_PRICE
+
+    await server.delete_visit(str(visit["_id"]), current_user=user)
+    assert await rollup_revenue(db) == 0
+
+
+async def test_maintenance_commands_use_the_stored_settings(db):
+    await db.settings.insert_one({"type": "app_settings", "default_visit_price": 12000})
+    await db.visits.insert_one({"client_id": str(ObjectId()), "date": "2024-03-01"})
+
+    await server.run_maintenance_command("migrate")
+    assert (await db.visits.find_one())["price"] == 12000
+
+
+async def test_restore_prices_visits_at_the_restored_defaults(db, user):
+    retreat_id, client_id = str(ObjectId()), str(ObjectId())
+    backup = server.BackupData(
+        clients=[{"id": client_id, "first_name": "Имя", "last_name": "Фамилия"}],
+        visits=[{"id": str(ObjectId()), "client_id": client_id, "date": "2024-03-01", "topic": "Спина"}],
+        retreats=[{"id": retreat_id, "name": "Весна", "start_date": "2024-03-05", "end_date": "2024-03-08",
+                   "participants": [{"client_id": client_id}]}],
+        settings={"default_visit_price": 11000, "default_retreat_price": 33000}
+    )
+
+    await server.restore_backup(backup, current_user=user)
+    visit = await db.visits.find_one({"client_id": client_id, "retreat_id": {"$exists": False}})
+    assert (visit["price"], visit["tips"]) == (11000, 0)
+    assert (await db.retreat_participants.find_one())["payment"] == 33000
+    assert await rollup_revenue(db) == 11000
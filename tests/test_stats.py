@@ -0,0 +1,86 @@
+"""Statistics handlers: query fan-out and the overview"""
+import asyncio
+import contextvars
+from datetime import datetime, timezone
+
+import pytest
+from bson import ObjectId
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+class Queries:
+    """Fake queries that record how many of them run at the same time"""
+
+    def __init__(self):
+        self.running = 0
+        self.peak = 0
+
+    async def query(self, value):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        await asyncio.sleep(0.001)
+        self.running -= 1
+        return value
+
+    async def fan_out(self, values):
+        return await server.gather_limited(*(self.query(v) for v in values))
+
+
+def in_new_request(coro):
+    """Run a coroutine in its own task and context, as each HTTP request is"""
+    return asyncio.create_task(coro, context=contextvars.Context())
+
+
+async def test_nested_fan_out_shares_the_request_bound():
+    queries = Queries()
+
+    async def handler():
+        return await server.gather_limited(
+            *(queries.query(i) for i in range(3)),
+            *(queries.fan_out([f"{i}.{j}" for j in range(3)]) for i in range(6))
+        )
+
+    result = await in_new_request(handler())
+    assert result == [0, 1, 2, *([f"{i}.{j}" for j in range(3)] for i in range(6))]
+    assert queries.peak == server.QUERY_CONCURRENCY
+
+
+async def test_requests_have_their_own_bound():
+    queries = Queries()
+
+    async def handler():
+        return await server.gather_limited(*(queries.query(i) for i in range(server.QUERY_CONCURRENCY)))
+
+    await asyncio.gather(in_new_request(handler()), in_new_request(handler()))
+    assert queries.peak == 2 * server.QUERY_CONCURRENCY
+
+
+async def test_overview_reads_the_rollups_once(db, monkeypatch):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    visits = [
+        {"_id": ObjectId(), "client_id": str(ObjectId()), "date": today, "topic": "Спина",
+         "practices": ["ТСЯ"], "price": 15000, "tips": 500, "retreat_id": None},
+        {"_id": ObjectId(), "client_id": str(ObjectId()), "date": "2001-01-01", "topic": "Шея",
+         "practices": [], "price": 10000, "tips": 0, "retreat_id": None},
+    ]
+    await db.visits.insert_many([dict(v) for v in visits])
+    await server.track_visit_changes(added=visits)
+
+    reads = []
+    load_daily_rollups = server.load_daily_rollups
+
+    async def counting_load(*args, **kwargs):
+        reads.append(args)
+        return await load_daily_rollups(*args, **kwargs)
+
+    monkeypatch.setattr(server, "load_daily_rollups", counting_load)
+    overview = await in_new_request(server.compute_stats_overview())
+
+    assert len(reads) == 1
+    assert (overview["visits_ytd"], overview["visits_last_30"]) == (1, 1)
+    assert overview["financial"]["visits_revenue_ytd"] == 15000
+    assert overview["practices"] == [{"practice": "ТСЯ", "count": 1}]
+    assert {t["topic"] for t in overview["top_topics"]} == {"Спина", "Шея"}
@@ -0,0 +1,74 @@
+"""Visit routes, practice bitmasks and the statistics read from them"""
+import pytest
+
+import server
+
+pytestmark = pytest.mark.anyio
+
+
+async def create_visits(client_id, user, *visits):
+    for date, practices in visits:
+        await server.create_visit(
+            client_id, server.VisitCreate(date=date, topic="Спина", practices=practices), current_user=user
+        )
+
+
+async def test_practice_stats_count_every_practice_before_masks_are_backfilled(db, user, insert_clients):
+    (client_id,) = await insert_clients(1)
+    await create_visits(client_id, user, ("2024-01-10", ["ТСЯ", "Лепило"]), ("2024-02-10", ["ТСЯ"]))
+
+    assert not await server.migration_done("0003_visit_practices_mask")
+    stats = await server.get_client_practice_stats(client_id, current_user=user)
+    assert stats["practice_counts"] == {"Лепило": 1, "ТСЯ": 2}
+    assert stats["personal_visits_count"] == 2
+
+
+async def test_practices_beyond_the_bit_limit_are_still_counted(db, user, insert_clients, monkeypatch):
+    monkeypatch.setattr(server, "MAX_PRACTICE_BITS", 2)
+    (client_id,) = await insert_clients(1)
+    await create_visits(client_id, user, ("2024-01-10", ["ТСЯ", "Лепило"]), ("2024-02-10", ["Ребефинг", "ТСЯ"]))
+    await server.finish_migration("0003_visit_practices_mask")
+
+    assert not server.every_practice_has_bit()
+    stats = await server.get_client_practice_stats(client_id, current_user=user)
+    assert stats["practice_counts"] == {"Лепило": 1, "Ребефинг": 1, "ТСЯ": 2}
+    page = await server.get_client_visits(client_id, practice="Ребефинг", current_user=user)
+    assert [v["date"] for v in page["visits"]] == ["2024-02-10"]
+
+
+async def test_practice_stats_use_masks_once_backfilled(db, user, insert_clients):
+    (client_id,) = await insert_clients(1)
+    await create_visits(client_id, user, ("2024-01-10", ["ТСЯ", "Лепило"]), ("2024-02-10", ["ТСЯ"]))
+    await server.finish_migration("0003_visit_practices_mask")
+
+    assert server.every_practice_has_bit()
+    stats = await server.get_client_practice_stats(client_id, current_user=user)
+    assert stats["practice_counts"] == {"Лепило": 1, "ТСЯ": 2}
+
+
+async def test_topic_dictionary_follows_visit_writes(db, user, insert_clients):
+    (client_id,) = await insert_clients(1)
+    created = []
+    for date, topic in [("2024-01-10", "Спина"), ("2024-03-01", "Шея"), ("2024-02-01", "Спина"), ("2024-02-05", "Стресс")]:
+        created.append(await server.create_visit(
+            client_id, server.VisitCreate(date=date, topic=topic), current_user=user
+        ))
+    await server.update_visit(created[3]["id"], server.VisitUpdate(topic="Шея"), current_user=user)
+    await server.delete_visit(created[1]["id"], current_user=user)
+
+    by_usage = await server.get_all_topics(order="usage", current_user=user)
+    assert by_usage["topics"] == ["Спина", "Шея"]
+    assert [(t["topic"], t["count"]) for t in by_usage["usage"]] == [("Спина", 2), ("Шея", 1)]
+    assert by_usage["usage"][0]["last_used"] == "2024-02-01"
+    assert (await server.get_all_topics(order="alpha", limit=1, current_user=user))["topics"] == ["Спина"]
+
+    incremental = await db.topics.find({"count": {"$gt": 0}}, {"_id": 1, "count": 1}).sort("_id", 1).to_list(None)
+    await server.rebuild_topic_dictionary()
+    assert await db.topics.find({}, {"_id": 1, "count": 1}).sort("_id", 1).to_list(None) == incremental
+
+
+@pytest.mark.parametrize("kwargs", [{"limit": 0}, {"limit": server.MAX_TOPICS_LIMIT + 1}, {"order": "random"}])
+async def test_topics_reject_bad_parameters(db, user, kwargs):
+    with pytest.raises(server.HTTPException) as error:
+        await server.get_all_topics(current_user=user, **kwargs)
+    assert error.value.status_code == 400